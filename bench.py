@@ -0,0 +1,1470 @@
+"""Бенчмарки горячих путей бота.
+
+Запуск: python bench.py [db writer ...] [-n ITERATIONS]
+Микробенчмарки: python bench.py micro --save baseline.json
+Проверка регрессий: python bench.py micro --baseline baseline.json [--threshold 0.3]
+"""
+import argparse
+import asyncio
+import collections
+import gzip
+import json
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import signal
+import sys
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+os.environ.setdefault("BOT_TOKEN", "123456:bench")  # bot.py создает Bot() при импорте
+
+import aiosqlite
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import ContentType
+
+import bot
+from broadcast import DONE, Broadcaster
+from db import Database
+from export import export_all, export_in_process
+from journal import Journal
+from logs import ROOT
+from matchmaking import TAG_SCAN, MatchQueue, match_bounds, rating_key
+from metrics import ACTION_SECONDS
+from migrations import HOT_QUERIES, full_scans
+from perf import LoopMonitor, TimingMiddleware, cprofile, sample
+from sender import BULK, NOTICE, RELAY, OutboundScheduler
+from state import NAMESPACES, MemoryStateStore, SqliteStateStore, create_store
+from stats import rebuild_stats
+from timers import TimerWheel
+from writer import WriteBehind
+
+
+def report(name, samples):
+    samples = sorted(samples)
+    p50 = samples[len(samples) // 2]
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    print(f"{name:<40} n={len(samples):<7} mean={statistics.fmean(samples) * 1e6:9.1f}us "
+          f"p50={p50 * 1e6:9.1f}us p99={p99 * 1e6:9.1f}us")
+    return {"mean": statistics.fmean(samples), "p50": p50, "p99": p99}
+
+
+def reset_state(journal=None):
+    """Чистое состояние в памяти (очередь, пары, словари диалогов)"""
+    bot.store = create_store("memory", journal=journal)
+    bot.sessions = bot.store.sessions
+    for name in ("waiting_users",) + NAMESPACES:
+        setattr(bot, name, getattr(bot.store, name))
+
+
+class StubBot:
+    """Вместо aiogram.Bot: запросы к Telegram ничего не делают"""
+
+    def __init__(self):
+        self.calls = 0
+
+    async def _call(self, *args, **kwargs):
+        self.calls += 1
+
+    send_message = copy_message = send_media_group = _call
+
+
+class StubMessage:
+    """Минимум types.Message, который нужен handle_all_messages"""
+
+    class User:
+        def __init__(self, user_id):
+            self.id = user_id
+
+    media_group_id = None
+    message_id = 0
+    content_type = ContentType.TEXT
+
+    def __init__(self, user_id, text):
+        self.from_user = self.chat = self.User(user_id)
+        self.text = text
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+
+async def use_temp_db(tmpdir):
+    """Переключить bot.py на чистую базу во временной папке"""
+    path = os.path.join(tmpdir, "bench.db")
+    bot.DB_PATH = path
+    bot.db = Database(path)
+    bot.writer = WriteBehind(bot.db, bot.DB_FLUSH_INTERVAL, bot.DB_FLUSH_BATCH)
+    bot.profiles.clear()
+    await bot.init_db()
+    return path
+
+
+# --- БАЗА: соединение на каждый запрос против общего соединения ---
+async def bench_db(iterations):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = await use_temp_db(tmpdir)
+        users = 1000
+        await bot.db.executemany(
+            "INSERT INTO users(user_id, gender, age) VALUES(?,?,?)",
+            [(uid, "M", 20) for uid in range(users)]
+        )
+
+        # До: как раньше, aiosqlite.connect() в каждом хелпере
+        async def old_get_user_rating(user_id):
+            async with aiosqlite.connect(path) as conn:
+                cur = await conn.execute("SELECT rating, rating_count FROM users WHERE user_id=?", (user_id,))
+                return await cur.fetchone()
+
+        async def old_log_chat_start(user1, user2):
+            async with aiosqlite.connect(path) as conn:
+                await conn.execute(
+                    "INSERT INTO chats(user1, user2, start_time) VALUES(?,?,?)", (user1, user2, "2024-01-01T00:00:00")
+                )
+                await conn.commit()
+
+        before_read, before_write = [], []
+        for i in range(iterations):
+            t = time.perf_counter()
+            await old_get_user_rating(i % users)
+            before_read.append(time.perf_counter() - t)
+            t = time.perf_counter()
+            await old_log_chat_start(i % users, (i + 1) % users)
+            before_write.append(time.perf_counter() - t)
+
+        # После: общее соединение из db.py
+        after_read, after_write = [], []
+        for i in range(iterations):
+            t = time.perf_counter()
+            await bot.get_user_rating(i % users)
+            after_read.append(time.perf_counter() - t)
+            t = time.perf_counter()
+            await bot.log_chat_start(i % users, (i + 1) % users)
+            after_write.append(time.perf_counter() - t)
+        await bot.writer.stop()
+        await bot.db.close()
+
+    return {
+        "read_before": report("get_user_rating: connect per call", before_read),
+        "read_after": report("get_user_rating: current helper", after_read),
+        "write_before": report("log_chat_start: connect per call", before_write),
+        "write_after": report("log_chat_start: current helper", after_write),
+    }
+
+
+# --- ГРУППОВОЙ КОММИТ: коммит на каждую запись против WriteBehind ---
+async def bench_writer(iterations):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        await use_temp_db(tmpdir)
+        sql = "INSERT INTO ratings(from_user, to_user, rating) VALUES(?,?,?)"
+
+        t = time.perf_counter()
+        for i in range(iterations):
+            await bot.db.execute(sql, (i, i + 1, 5))
+        per_row = time.perf_counter() - t
+
+        t = time.perf_counter()
+        for i in range(iterations):
+            bot.writer.submit(sql, (i, i + 1, 5))
+            if i % 100 == 0:
+                await asyncio.sleep(0)  # как между апдейтами в живом боте
+        await bot.writer.stop()
+        grouped = time.perf_counter() - t
+        batches = bot.writer.batches
+
+        # Одна плохая строка посреди пачки: остальные записываются, она одна уходит в dead_letter
+        dead_letter = os.path.join(tmpdir, "dead.jsonl")
+        writer = WriteBehind(bot.db, retry_delay=0, dead_letter=dead_letter)
+        await bot.db.execute("DELETE FROM ratings")
+        for i in range(100):
+            writer.submit(sql, (i, i + 1) if i == 50 else (i, i + 1, 5))  # 50-й - без одного параметра
+        await writer.flush()
+        (kept,) = await bot.db.fetchone("SELECT COUNT(*) FROM ratings")
+        with open(dead_letter) as f:
+            buried = [json.loads(line) for line in f]
+        await bot.db.close()
+
+    print(f"commit per row: {iterations / per_row:10.0f} rows/s")
+    print(f"write-behind:   {iterations / grouped:10.0f} rows/s ({batches} transactions)")
+    print(f"failing row:    {kept} of 99 good rows kept, {len(buried)} in dead letter")
+    if kept != 99 or len(buried) != 1 or buried[0]["params"] != [50, 51]:
+        raise SystemExit("плохая строка потеряла пачку")
+    return {"per_row_rps": iterations / per_row, "grouped_rps": iterations / grouped}
+
+
+# --- ЛОГИ: print() против логгера через QueueHandler ---
+async def bench_logging(iterations):
+    import contextlib
+
+    from logs import get_logger, setup_logging
+
+    queue_size = 1000
+    queue = [(uid, "M", 20) for uid in range(queue_size)]
+    results = {}
+    with open(os.devnull, "w") as devnull:
+        # До: print с форматированием всей очереди, как было в find_pair
+        with contextlib.redirect_stdout(devnull):
+            t = time.perf_counter()
+            for i in range(iterations):
+                print(f"🔍 Поиск пары для {i} (M, 20 лет)")
+                print(f"📋 Очередь ожидания: {queue}")
+            results["print_queue"] = (time.perf_counter() - t) / iterations
+
+        log = get_logger("matchmaking")
+        cases = (
+            ("debug_disabled", "matchmaking=INFO", 20),
+            ("debug_sampled", "matchmaking=DEBUG", 20),
+            ("debug_all", "matchmaking=DEBUG", 0),
+        )
+        for name, levels, rate in cases:
+            listener = setup_logging("INFO", levels, json_format=True, debug_rate=rate, stream=devnull)
+            t = time.perf_counter()
+            for i in range(iterations):
+                log.debug("Поиск пары для %s (%s, %s лет)", i, "M", 20, extra={"queue": queue_size})
+            results[name] = (time.perf_counter() - t) / iterations
+            listener.stop()
+        logging.getLogger().handlers.clear()
+
+    for name, seconds in results.items():
+        print(f"{name:<20} {seconds * 1e6:8.2f}us/call")
+    return results
+
+
+# --- СТАТИСТИКА: полные проходы по таблицам против счетчиков на триггерах ---
+STATS_ROWS = int(os.environ.get("BENCH_STATS_ROWS", 1_000_000))  # строк в chats
+
+
+async def old_admin_stats():
+    """Запросы get_admin_stats до счетчиков"""
+    await bot.db.fetchone("SELECT COUNT(*) FROM chats")
+    await bot.db.fetchone("SELECT AVG(duration) FROM chats WHERE duration > 0")
+    await bot.db.fetchall(
+        "SELECT strftime('%H', start_time) as hour, COUNT(*) as count FROM chats GROUP BY hour ORDER BY count DESC LIMIT 3"
+    )
+    await bot.db.fetchone("SELECT COUNT(*) FROM users")
+    await bot.db.fetchone("SELECT COUNT(*) FROM users WHERE banned = 0")
+    await bot.db.fetchone("SELECT COUNT(*) FROM users WHERE banned = 1")
+
+
+async def bench_stats(iterations):
+    iterations = min(iterations, 50)  # старый вариант на миллионе строк идет сотни миллисекунд
+    with tempfile.TemporaryDirectory() as tmpdir:
+        await use_temp_db(tmpdir)
+        users = max(STATS_ROWS // 100, 1)
+        t = time.perf_counter()
+        await bot.db.executemany(
+            "INSERT INTO users(user_id, banned) VALUES(?,?)", ((uid, int(uid % 50 == 0)) for uid in range(users))
+        )
+        await bot.db.executemany(
+            "INSERT INTO chats(user1, user2, start_time, end_time, duration) VALUES(?,?,?,?,?)",
+            ((i % users, (i + 1) % users, f"2024-01-01T{i % 24:02d}:00:00", None, i % 600) for i in range(STATS_ROWS))
+        )
+        print(f"filled {STATS_ROWS} chats / {users} users in {time.perf_counter() - t:.1f}s (triggers on)")
+
+        before, after = [], []
+        for _ in range(iterations):
+            t = time.perf_counter()
+            await old_admin_stats()
+            before.append(time.perf_counter() - t)
+        for _ in range(iterations):
+            t = time.perf_counter()
+            stats = await bot.get_admin_stats()
+            after.append(time.perf_counter() - t)
+
+        t = time.perf_counter()
+        await rebuild_stats(bot.db)
+        rebuild = time.perf_counter() - t
+        assert await bot.get_admin_stats() == stats, "счетчики разошлись с пересчетом"
+        await bot.writer.stop()
+        await bot.db.close()
+
+    print(f"rebuild_stats: {rebuild * 1e3:.0f}ms")
+    return {
+        "full_scan": report("admin stats: full table scans", before),
+        "counters": report("admin stats: trigger counters", after),
+        "rebuild_s": rebuild,
+    }
+
+
+# --- МИКРОБЕНЧМАРКИ: отдельные горячие функции, Telegram заменен заглушкой ---
+async def bench_find_pair(iterations):
+    rnd = random.Random(1)
+    real_bot, bot.bot = bot.bot, StubBot()
+    results = {}
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            await use_temp_db(tmpdir)
+            for size in (10, 1000, 100_000):
+                reset_state()
+                waiting = {}  # user_id -> (пол, возраст, рейтинг)
+                next_uid = 1
+
+                def add_waiting(gender, age, rating):
+                    nonlocal next_uid
+                    bot.waiting_users.add(next_uid, gender, age, None, rating)
+                    waiting[next_uid] = (gender, age, rating)
+                    next_uid += 1
+
+                for i in range(size):
+                    # хотя бы один подходящий партнер есть всегда
+                    age = 25 if i == 0 else rnd.randint(14, 60)
+                    add_waiting(rnd.choice("MF"), age, round(rnd.uniform(0, 5), 1))
+                samples = []
+                for i in range(iterations):
+                    uid = 10_000_000 + size + i
+                    bot.user_gender[uid] = "M"
+                    bot.user_age[uid] = 20
+                    bot.user_filters[uid] = {"min_rating": 0, "min_age": 20, "max_age": 30}
+                    t = time.perf_counter()
+                    await bot.find_pair(uid)
+                    samples.append(time.perf_counter() - t)
+                    # Очередь не меняется: забранного партнера заменяем таким же
+                    partner_id = bot.active_chats.get(uid)
+                    if partner_id is not None:
+                        add_waiting(*waiting.pop(partner_id))
+                    else:
+                        bot.waiting_users.remove(uid)
+                results[f"queue_{size}"] = report(f"find_pair, queue {size}", samples)
+            await bot.writer.stop()
+            await bot.db.close()
+    finally:
+        bot.bot = real_bot
+    return results
+
+
+def _oldest_scan(queue, user_id, user_rating, filters):
+    """Без корзин: самый давний подходящий ожидающий"""
+    min_key, min_age, max_age = match_bounds(user_rating, filters)
+    return min((entry for entry in queue if entry.user_id != user_id and min_age <= entry.age <= max_age
+                and rating_key(entry.rating) >= min_key), key=lambda entry: entry.seq, default=None)
+
+
+def _queue_rating_moves(iterations, users=2000):
+    """update_rating в очереди: ожидающий, переложенный в другую корзину, не теряет места"""
+    queue = MatchQueue()
+    queue.add(1, "M", 20, None, 3.0)
+    queue.add(2, "M", 20, None, 4.0)
+    queue.update_rating(1, 4.0)  # 1 ждет дольше, но попадает в корзину, где уже есть 2
+    assert queue.find(0, 0).user_id == 1, "переложенный ожидающий встал в конец корзины"
+
+    rnd = random.Random(2)
+    queue = MatchQueue()
+    for uid in range(users):
+        queue.add(uid, "M", rnd.randint(18, 22), None, round(rnd.uniform(0, 5), 1))
+    samples, mismatches = [], 0
+    for i in range(iterations):
+        uid = rnd.randrange(users)
+        t = time.perf_counter()
+        queue.update_rating(uid, round(rnd.uniform(0, 5), 1))
+        samples.append(time.perf_counter() - t)
+        if i % 10 == 0:
+            filters = {"min_rating": rnd.choice((0, 2, 4)), "min_age": rnd.randint(18, 20), "max_age": 22}
+            found = queue.find(-1, 0, filters)
+            if found is not _oldest_scan(queue, -1, 0, filters):
+                mismatches += 1
+            if found is not None:  # забираем и ставим обратно в конец - порядок в корзинах меняется
+                queue.remove(found.user_id)
+                queue.add(found.user_id, found.gender, found.age, None, found.rating)
+    assert mismatches == 0, f"find разошелся с полным проходом {mismatches} раз"
+    return samples
+
+
+async def bench_rating(iterations):
+    users = 1000
+    with tempfile.TemporaryDirectory() as tmpdir:
+        await use_temp_db(tmpdir)
+        reset_state()
+        await bot.db.executemany("INSERT INTO users(user_id) VALUES(?)", [(uid,) for uid in range(users)])
+        writes, reads = [], []
+        for i in range(iterations):
+            t = time.perf_counter()
+            await bot.update_rating(i % users, i % 5 + 1, from_user=(i + 1) % users)
+            writes.append(time.perf_counter() - t)
+            t = time.perf_counter()
+            await bot.get_user_rating(i % users)
+            reads.append(time.perf_counter() - t)
+        await bot.writer.stop()
+        await bot.db.close()
+    return {
+        "update_rating": report("update_rating", writes),
+        "get_user_rating": report("get_user_rating", reads),
+        "queue_update_rating": report("MatchQueue.update_rating", _queue_rating_moves(iterations)),
+    }
+
+
+CHATS_ROWS = int(os.environ.get("BENCH_CHATS_ROWS", 200_000))  # строк в chats для chat_log и admin_stats
+
+
+async def fill_chats(rows):
+    await bot.db.executemany(
+        "INSERT INTO chats(user1, user2, start_time, end_time, duration) VALUES(?,?,?,?,?)",
+        ((i, i + 1, f"2024-01-01T{i % 24:02d}:00:00", "2024-01-01T00:10:00", i % 600) for i in range(rows))
+    )
+
+
+async def bench_chat_log(iterations):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        await use_temp_db(tmpdir)
+        reset_state()
+        await fill_chats(CHATS_ROWS)
+        starts, ends = [], []
+        for i in range(iterations):
+            t = time.perf_counter()
+            await bot.log_chat_start(2 * i, 2 * i + 1)
+            starts.append(time.perf_counter() - t)
+            t = time.perf_counter()
+            await bot.log_chat_end(2 * i + 1, 2 * i)
+            ends.append(time.perf_counter() - t)
+        t = time.perf_counter()
+        await bot.writer.stop()
+        flush = time.perf_counter() - t
+        await bot.db.close()
+    return {
+        "log_chat_start": report(f"log_chat_start, {CHATS_ROWS} chats", starts),
+        "log_chat_end": report(f"log_chat_end, {CHATS_ROWS} chats", ends),
+        "flush_s": flush,
+    }
+
+
+async def bench_admin_stats(iterations):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        await use_temp_db(tmpdir)
+        reset_state()
+        await fill_chats(CHATS_ROWS)
+        samples = []
+        for _ in range(iterations):
+            t = time.perf_counter()
+            await bot.get_admin_stats()
+            samples.append(time.perf_counter() - t)
+        await bot.writer.stop()
+        await bot.db.close()
+    return {"get_admin_stats": report(f"get_admin_stats, {CHATS_ROWS} chats", samples)}
+
+
+async def bench_dispatch(iterations):
+    """handle_text_message: сколько стоит маршрутизация по состоянию и кнопке"""
+    cases = (
+        ("choosing_gender", "Мужской"),
+        ("choosing_age", "abc"),
+        ("setting_filters", "📋 Текущие настройки"),
+        ("setting_min_rating", "abc"),
+        ("admin_pass", "неверный пароль"),
+        ("idle", "Неизвестный текст"),
+    )
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        await use_temp_db(tmpdir)
+        reset_state()
+        uid = 1
+        await bot.save_user_data(uid, "M", 20)
+        for state, text in cases:
+            msg = StubMessage(uid, text)
+            samples = []
+            for _ in range(iterations):
+                bot.user_state[uid] = state
+                t = time.perf_counter()
+                await bot.handle_text_message(msg)
+                samples.append(time.perf_counter() - t)
+            results[state] = report(f"handle_text_message, {state}", samples)
+        await bot.writer.stop()
+        await bot.db.close()
+    return results
+
+
+# --- ПЛАНЫ ЗАПРОСОВ: горячие запросы не должны читать таблицу целиком ---
+async def bench_plans(iterations):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        await use_temp_db(tmpdir)
+        scans = await full_scans(bot.db)
+        for sql, params in HOT_QUERIES:
+            plan = await bot.db.fetchall(f"EXPLAIN QUERY PLAN {sql}", params)
+            print(f"{'; '.join(row[-1] for row in plan):<70} {' '.join(sql.split())[:60]}")
+        await bot.writer.stop()
+        await bot.db.close()
+    for sql, detail in scans:
+        print(f"FULL SCAN: {detail}: {sql}")
+    if scans:
+        raise SystemExit(1)
+    return {"full_scans": len(scans)}
+
+
+# --- ВОРКЕРЫ: несколько процессов подбирают пары через общее SQLite-хранилище ---
+def _busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def _match_worker(path, user_ids, work, ready, out):
+    """Один воркер: на каждого пользователя - работа обработчика, затем поиск пары"""
+    store = SqliteStateStore(path)
+    pairs = []
+    locked = 0.0  # время внутри транзакции подбора - эта часть у воркеров не параллелится
+    ready.wait()  # время запуска процессов не считаем
+    for uid in user_ids:
+        _busy(work)  # разбор апдейта, профиль, ответ пользователю
+        t = time.perf_counter()
+        partner, _ = store.match_or_wait(uid, "M", 20, None, 0)
+        locked += time.perf_counter() - t
+        if partner is not None:
+            pairs.append((uid, partner.user_id))
+    store.close()
+    out.put((pairs, locked, len(user_ids)))
+
+
+async def bench_workers(iterations, work=0.0005):
+    """Пары в секунду при 1, 2 и 4 воркерах на общем SQLite-хранилище.
+
+    Воркеры растут, только пока хватает ядер: обработчики (work) идут параллельно,
+    а транзакции подбора пары на общем файле - строго по одной. Поэтому кроме
+    скорости печатаем число CPU и потолок 1 / (время транзакции) апдейтов в секунду.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    cpus = os.cpu_count() or 1
+    results = {"cpus": cpus}
+    for workers in (1, 2, 4):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "state.db")
+            SqliteStateStore(path).close()
+            ready = ctx.Barrier(workers + 1)
+            out = ctx.Queue()
+            procs = [
+                ctx.Process(target=_match_worker, args=(path, range(w, iterations, workers), work, ready, out))
+                for w in range(workers)
+            ]
+            for proc in procs:
+                proc.start()
+            ready.wait()
+            t = time.perf_counter()
+            outputs = [out.get() for _ in procs]
+            elapsed = time.perf_counter() - t
+            for proc in procs:
+                proc.join()
+
+        pairs = [pair for found, _, _ in outputs for pair in found]
+        locked = sum(seconds for _, seconds, _ in outputs) / sum(count for _, _, count in outputs)
+        paired = [uid for pair in pairs for uid in pair]
+        duplicates = len(paired) - len(set(paired))
+        print(f"workers={workers}: {len(pairs) / elapsed:8.0f} matches/s, {iterations / elapsed:8.0f} updates/s, "
+              f"{len(pairs)} pairs, duplicates={duplicates}, {locked * 1e6:.0f}us in transaction per update")
+        results[workers] = {"matches_per_s": len(pairs) / elapsed, "duplicates": duplicates, "locked_s": locked}
+    ceiling = 1 / results[1]["locked_s"]
+    if cpus < 4:
+        print(f"{cpus} CPU: workers share the cores, so throughput cannot grow on this host")
+    print(f"the shared file serializes pairing at about {ceiling:.0f} updates/s ({ceiling / 2:.0f} matches/s) "
+          f"whatever the number of workers and cores")
+    return results
+
+
+# --- ИНТЕРЕСЫ: поиск по обратному индексу тегов против прохода по всей очереди ---
+def _random_tags(rnd, vocabulary):
+    # Популярность тегов по закону Ципфа: немного популярных, длинный хвост редких
+    count = rnd.choice((0, 1, 2, 3, 3, 4, 5))
+    return tuple({vocabulary[min(int(rnd.paretovariate(1.1)) - 1, len(vocabulary) - 1)] for _ in range(count)})
+
+
+def _best_overlap_scan(queue, user_id, user_rating, filters, tags):
+    """Без индекса: пройти всю очередь и взять максимум пересечения"""
+    min_key, min_age, max_age = match_bounds(user_rating, filters)
+    tags = frozenset(tags)
+    best, best_overlap = None, 0
+    for entry in queue:
+        if entry.user_id == user_id or not min_age <= entry.age <= max_age or rating_key(entry.rating) < min_key:
+            continue
+        overlap = len(entry.tags & tags)
+        if overlap > best_overlap:
+            best, best_overlap = entry, overlap
+    return best
+
+
+async def bench_interests(iterations):
+    rnd = random.Random(1)
+    vocabulary = [f"tag{i}" for i in range(500)]
+    filters = {"min_rating": 0, "min_age": 18, "max_age": 30}
+
+    # Первые TAG_SCAN * 2 с тегом не подходят по возрасту - подходящий за ними все равно находится
+    queue = MatchQueue(interest_timeout=30)
+    for uid in range(TAG_SCAN * 2):
+        queue.add(uid, "M", 50, None, 3.0, ("tag0",))
+    queue.add(-1, "F", 20, None, 3.0, ("tag0",))
+    found = queue.find(10_000_000, 3.0, filters, ("tag0",), plain=False)
+    assert found is not None and found.user_id == -1, "подходящий партнер спрятан за TAG_SCAN"
+    results = {}
+    for size in (1000, 100_000):
+        queue = MatchQueue(interest_timeout=30)
+        for uid in range(size):
+            queue.add(uid, rnd.choice("MF"), rnd.randint(14, 60), None, round(rnd.uniform(0, 5), 1),
+                      _random_tags(rnd, vocabulary))
+        searches = [(10_000_000 + i, _random_tags(rnd, vocabulary) or ("tag0",)) for i in range(iterations)]
+        indexed, plain, found, optimal = [], [], 0, 0
+        for uid, tags in searches:
+            t = time.perf_counter()
+            entry = queue.find(uid, 3.0, filters, tags, plain=False)
+            indexed.append(time.perf_counter() - t)
+            t = time.perf_counter()
+            queue.find(uid, 3.0, filters)  # без тегов: свежие ожидающие с тегами зарезервированы
+            plain.append(time.perf_counter() - t)
+            found += len(entry.tags.intersection(tags)) if entry else 0
+        scan = []
+        for uid, tags in searches[:max(1, iterations // 20)]:  # проход по очереди медленный, хватит выборки
+            t = time.perf_counter()
+            best = _best_overlap_scan(queue, uid, 3.0, filters, tags)
+            scan.append(time.perf_counter() - t)
+            optimal += len(best.tags.intersection(tags)) if best else 0
+        sample = len(scan)
+        found_sample = sum(
+            len(e.tags.intersection(tags)) if (e := queue.find(uid, 3.0, filters, tags, plain=False)) else 0
+            for uid, tags in searches[:sample]
+        )
+        print(f"queue {size}: overlap found {found / iterations:.2f} avg; "
+              f"on {sample} searches index {found_sample / sample:.2f} vs full scan {optimal / sample:.2f}")
+        results[f"queue_{size}"] = {
+            "index": report(f"find by tags (index), queue {size}", indexed),
+            "plain": report(f"find plain with reservations, queue {size}", plain),
+            "scan": report(f"find by tags (full scan), queue {size}", scan),
+        }
+    return results
+
+
+# --- ТАЙМЕРЫ: arm/cancel и тик колеса при сотнях тысяч таймеров ---
+async def bench_timers(iterations):
+    results = {}
+    for size in (1000, 100_000, 500_000):
+        now = [0.0]
+        wheel = TimerWheel(1.0, clock=lambda: now[0])
+        rnd = random.Random(1)
+        for uid in range(size):
+            wheel.arm(("chat", uid), rnd.uniform(60, 1800))
+        arm, cancel = [], []
+        for i in range(iterations):
+            key = ("queue", i)
+            t = time.perf_counter()
+            wheel.arm(key, 600)
+            arm.append(time.perf_counter() - t)
+            t = time.perf_counter()
+            wheel.cancel(key)
+            cancel.append(time.perf_counter() - t)
+        ticks, expired = [], 0
+        for _ in range(1800):  # полчаса модельного времени, за которые истекают все таймеры
+            now[0] += 1
+            t = time.perf_counter()
+            expired += len(wheel.advance())
+            ticks.append(time.perf_counter() - t)
+        results[f"timers_{size}"] = {
+            "arm": report(f"arm, {size} timers", arm),
+            "cancel": report(f"cancel, {size} timers", cancel),
+            "tick": report(f"tick, {size} timers ({expired} expired)", ticks),
+        }
+        if expired != size or len(wheel):
+            raise SystemExit(f"истекло {expired} из {size}, осталось {len(wheel)}")
+    results["mass_expiry_lateness_s"] = await _mass_expiry()
+    return results
+
+
+async def _mass_expiry(queued=1000, rate=500, tick=0.01):
+    """queued таймеров очереди истекают разом, их обработчики ждут общего лимита отправки;
+    таймер чата, истекающий следом, не должен ждать, пока они отправят все"""
+    wheel = TimerWheel(tick)
+    sending = asyncio.Lock()
+    started = {}
+
+    async def on_expire(key):
+        started[key] = time.monotonic()
+        if key[0] == "queue":
+            async with sending:  # как OutboundScheduler: не быстрее rate сообщений в секунду
+                await asyncio.sleep(1 / rate)
+
+    for uid in range(queued):
+        wheel.arm(("queue", uid), 0)
+    wheel.arm(("chat", 0), tick * 5)
+    due = time.monotonic() + tick * 5
+    wheel.start(on_expire)
+    while ("chat", 0) not in started:
+        await asyncio.sleep(tick)
+    await wheel.stop()
+    lateness = started[("chat", 0)] - due
+    print(f"mass expiry: {queued} queue timers sending at {rate}/s (~{queued / rate:.1f}s one by one), "
+          f"chat timer ran {lateness * 1e3:.0f} ms after its deadline")
+    if lateness > tick * 10:
+        raise SystemExit(f"таймер чата ждал массового истечения {lateness:.2f} с")
+    return lateness
+
+
+# --- СЕССИИ: память на пользователей и стоимость вытеснения/восстановления ---
+def _fill_sessions(state, users):
+    """Зарегистрированные пользователи, как после choosing_age"""
+    for uid in range(users):
+        state["user_gender"][uid] = "M" if uid % 2 else "F"
+        state["user_age"][uid] = 14 + uid % 60
+        state["user_state"][uid] = "idle"
+        state["user_filters"][uid] = {"min_rating": 0, "min_age": 14, "max_age": 100}
+
+
+def _traced(fill):
+    """Сколько байт памяти выделил fill()"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    fill()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used
+
+
+async def bench_sessions(iterations, users=100_000):
+    fields = ("user_gender", "user_age", "user_state", "user_filters")
+    old_dicts = {name: {} for name in fields}  # до: отдельный словарь на каждое поле
+    old = _traced(lambda: _fill_sessions(old_dicts, users))
+    store = MemoryStateStore()
+    new = _traced(lambda: _fill_sessions({name: getattr(store, name) for name in fields}, users))
+
+    bounded_store = MemoryStateStore(session_size=users // 10)
+
+    def churn():
+        for uid in range(users):
+            bounded_store.sessions.touch(uid)
+            bounded_store.user_state[uid] = "idle"
+
+    bounded = _traced(churn)
+    print(f"{users} users: dicts {old / users:.0f} B/user ({old / 2**20:.1f} MiB), "
+          f"sessions {new / users:.0f} B/user ({new / 2**20:.1f} MiB), "
+          f"LRU {users // 10}: {bounded / 2**20:.1f} MiB, {len(bounded_store.sessions)} in memory")
+
+    # Посреди регистрации сессию вытеснять нельзя: пол из choosing_gender еще не в users
+    bounded_store.user_state[0] = "choosing_age"
+    bounded_store.user_gender[0] = "M"
+    for uid in range(users, users + users // 5):
+        bounded_store.sessions.touch(uid)
+    if bounded_store.user_gender.get(0) != "M" or bounded_store.user_state.get(0) != "choosing_age":
+        raise SystemExit("вытеснена сессия посреди регистрации")
+
+    touch = []
+    for i in range(iterations):
+        t = time.perf_counter()
+        bounded_store.sessions.touch(users + i)
+        touch.append(time.perf_counter() - t)
+
+    # Восстановление вытесненной сессии из users
+    restore = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        await use_temp_db(tmpdir)
+        reset_state()
+        await bot.db.executemany(
+            "INSERT INTO users(user_id, gender, age) VALUES(?,?,?)", [(uid, "M", 20) for uid in range(iterations)]
+        )
+        for uid in range(iterations):
+            t = time.perf_counter()
+            await bot.restore_session(uid)
+            restore.append(time.perf_counter() - t)
+        if bot.user_state.get(0) != "idle" or bot.user_age.get(0) != 20:
+            raise SystemExit("сессия не восстановилась")
+        await bot.writer.stop()
+        await bot.db.close()
+    return {
+        "bytes_per_user": {"dicts": old / users, "sessions": new / users},
+        "touch": report(f"touch, LRU {users // 10}", touch),
+        "restore": report("restore_session (промах кэша профилей)", restore),
+    }
+
+
+# --- ГОНКИ: много пользователей жмут кнопки одновременно, пары не должны двоиться ---
+class JitterBot(StubBot):
+    """StubBot, который уступает цикл на случайное время, как сетевой запрос"""
+
+    def __init__(self, rnd):
+        super().__init__()
+        self.rnd = rnd
+
+    async def _call(self, *args, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.rnd.random() * 0.002)
+
+    send_message = copy_message = send_media_group = _call
+
+
+def pairing_violations():
+    """Нарушения инвариантов пар в текущем состоянии -> [описание]"""
+    found = []
+    for uid, partner_id in bot.active_chats.items():
+        if bot.active_chats.get(partner_id) != uid:
+            found.append(f"{uid} -> {partner_id}, но {partner_id} -> {bot.active_chats.get(partner_id)}")
+        if uid in bot.waiting_users:
+            found.append(f"{uid} в чате и в очереди")
+    return found
+
+
+async def bench_races(iterations, users=200):
+    """Каждый пользователь шлет апдейты пачками без ожидания ответа (двойные
+    нажатия, скип одновременно с выходом партнера); обработка идет через
+    почтовые ящики, как в dp.update. Инварианты проверяются на каждом шаге цикла.
+    """
+    rnd = random.Random(1)
+    real_bot, bot.bot = bot.bot, JitterBot(rnd)
+    buttons = {
+        "idle": ("🔎 Найти собеседника",) * 3 + ("⛔ Выйти из поиска",),
+        "in_chat": ("привет",) * 4 + ("⏭️ Скипнуть", "❌ Завершить чат"),
+        "rating": ("⭐ 1", "🚫 Пропустить"),
+    }
+    violations = []
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            await use_temp_db(tmpdir)
+            reset_state()
+            bot.mailboxes = bot.Mailboxes()
+            bot.pair_locks = bot.PairLocks()
+            for uid in range(1, users + 1):
+                bot.user_gender[uid] = rnd.choice("MF")
+                bot.user_age[uid] = 20
+                bot.user_state[uid] = "idle"
+                await bot.save_user_data(uid, bot.user_gender[uid], 20)
+
+            async def deliver(msg):
+                async with bot.mailboxes.hold(msg.from_user.id):
+                    await bot.handle_all_messages(msg)
+
+            async def user(uid):
+                tasks = []
+                for _ in range(iterations // users):
+                    # Кнопка выбирается по состоянию на момент нажатия, а доходит позже
+                    text = rnd.choice(buttons.get(bot.user_state.get(uid), buttons["idle"]))
+                    tasks.append(asyncio.create_task(deliver(StubMessage(uid, text))))
+                    await asyncio.sleep(rnd.random() * 0.003)
+                await asyncio.gather(*tasks)
+
+            async def watch():
+                while True:
+                    violations.extend(pairing_violations())
+                    await asyncio.sleep(0)
+
+            watcher = asyncio.create_task(watch())
+            t = time.perf_counter()
+            await asyncio.gather(*(user(uid) for uid in range(1, users + 1)))
+            elapsed = time.perf_counter() - t
+            watcher.cancel()
+            violations.extend(pairing_violations())
+
+            await bot.writer.stop()  # flush() не дождется пачки, которую фоновая задача уже забрала
+            (open_chats,) = await bot.db.fetchone("SELECT COUNT(*) FROM chats WHERE end_time IS NULL")
+            (total_chats,) = await bot.db.fetchone("SELECT COUNT(*) FROM chats")
+            if open_chats != len(bot.active_chats) // 2:
+                violations.append(f"незакрытых строк chats {open_chats}, активных пар {len(bot.active_chats) // 2}")
+            await bot.db.close()
+    finally:
+        bot.bot = real_bot
+
+    for line in sorted(set(violations))[:20]:
+        print(f"VIOLATION: {line}")
+    updates = iterations // users * users
+    print(f"{users} users, {updates} updates in {elapsed:.2f}s ({updates / elapsed:.0f}/s), "
+          f"{total_chats} chats, {len(bot.active_chats) // 2} still active, violations={len(violations)}")
+    if violations:
+        raise SystemExit(1)
+    return {"updates_per_s": updates / elapsed, "chats": total_chats, "violations": len(violations)}
+
+
+# --- РАССЫЛКА: лимит скорости, RetryAfter и продолжение после перезапуска ---
+def _max_in_window(times, window):
+    """Больше всего отметок времени в одном окне длиной window секунд"""
+    times = sorted(times)
+    best = start = 0
+    for end, t in enumerate(times):
+        while t - times[start] >= window:
+            start += 1
+        best = max(best, end - start + 1)
+    return best
+
+
+async def bench_broadcast(iterations, rate=500, banned_every=20, concurrency=50, window=0.5):
+    """iterations пользователей; на середине рассылку прерываем, как при
+    остановке бота, и продолжаем новым Broadcaster по курсору из базы"""
+    rnd = random.Random(1)
+    received = collections.Counter()
+    flood = [0]
+    started = [{}, {}]  # запуск до и после перезапуска: user_id -> время первой попытки
+
+    async def api_send(uid):
+        await asyncio.sleep(rnd.random() * 0.02)
+        if rnd.random() < 0.002:
+            flood[0] += 1
+            raise TelegramRetryAfter(None, "Too Many Requests", 0.05)
+        received[uid] += 1
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        await use_temp_db(tmpdir)
+        await bot.db.executemany(
+            "INSERT INTO users(user_id, banned) VALUES(?,?)",
+            [(uid, int(uid % banned_every == 0)) for uid in range(1, iterations + 1)]
+        )
+        outbox = OutboundScheduler(rate * 2, 1, 5)  # общий лимит бота выше лимита рассылки
+        outbox.start()
+
+        def make_broadcaster(run):
+            def send(uid, text):
+                started[run].setdefault(uid, time.perf_counter())  # повтор после RetryAfter - не новый токен
+                return outbox.send(uid, lambda: api_send(uid))
+            return Broadcaster(bot.db, send, rate=rate, chunk=200, concurrency=concurrency)
+
+        broadcaster = make_broadcaster(0)
+        t = time.perf_counter()
+        broadcast = await broadcaster.create(1, "bench", iterations - iterations // banned_every)
+        while sum(received.values()) < iterations // 2:
+            await asyncio.sleep(0.01)
+        await broadcaster.stop()  # остановка бота посреди пачки
+        interrupted_at = broadcast.cursor
+
+        broadcaster = make_broadcaster(1)
+        (resumed,) = await broadcaster.resume()
+        while len(broadcaster):
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - t
+        await outbox.stop()
+        burst = broadcaster._bucket.capacity  # каждый Broadcaster начинает с полного ведра
+        status = (await bot.db.fetchone("SELECT status, sent FROM broadcasts WHERE id=?", (broadcast.id,)))
+        await bot.writer.stop()
+        await bot.db.close()
+
+    active = [uid for uid in range(1, iterations + 1) if uid % banned_every]
+    missed = [uid for uid in active if not received[uid]]
+    banned = [uid for uid in received if uid % banned_every == 0]
+    duplicates = sum(received.values()) - len(received)
+    achieved = sum(received.values()) / elapsed
+    # Лимит в любом окне window (в 10 раз дольше запаса ведра) - rate * window и одно ведро;
+    # каждый запуск начинает с полного ведра, поэтому окна считаем по запускам отдельно
+    allowed = rate * window + burst
+    peak = max(_max_in_window(times.values(), window) for times in started)
+    print(f"{len(active)} recipients in {elapsed:.2f}s: {achieved:.0f} msg/s, "
+          f"peak {peak} sends per {window}s window (limit {rate}/s, {allowed:.0f} allowed), "
+          f"interrupted at user_id {interrupted_at}, {flood[0]} RetryAfter, {resumed.failed} failed, "
+          f"missed={len(missed)} banned={len(banned)} duplicates={duplicates} (at most {concurrency}) status={status[0]}")
+    if missed or banned or status[0] != DONE or duplicates > concurrency or peak > allowed:
+        raise SystemExit(1)
+    return {"msgs_per_s": achieved, "duplicates": duplicates, "failed": resumed.failed}
+
+
+# --- ОТПРАВКА: порядок внутри чата и полосы между чатами в OutboundScheduler ---
+async def bench_outbox(iterations, chats=100):
+    delivered = collections.defaultdict(list)
+
+    def call(chat_id, tag):
+        async def request():
+            delivered[chat_id].append(tag)
+        return request
+
+    # Уведомление "собеседник найден" и первое сообщение собеседника в один чат - по порядку
+    outbox = OutboundScheduler(1000, 1, 5)
+    outbox.start()
+    await asyncio.gather(outbox.send(1, call(1, "found"), NOTICE), outbox.send(1, call(1, "hi"), RELAY))
+    # Между чатами пересылка обгоняет уведомление, поставленное раньше (общий лимит исчерпан)
+    outbox = OutboundScheduler(10, 100, 100)
+    outbox.start()
+    await asyncio.gather(*(outbox.send(100 + i, call(0, "filler"), NOTICE) for i in range(10)))
+    await asyncio.gather(outbox.send(2, call(0, "notice"), NOTICE), outbox.send(3, call(0, "relay"), RELAY))
+    await outbox.stop()
+    print(f"one chat: {delivered[1]}; across chats: {delivered[0][-2:]}")
+    if delivered[1] != ["found", "hi"] or delivered[0][-2:] != ["relay", "notice"]:
+        raise SystemExit("OutboundScheduler нарушил порядок в чате или приоритет полос")
+
+    # Поток: iterations сообщений в chats чатов вперемешку по полосам
+    rnd = random.Random(1)
+    delivered.clear()
+    outbox = OutboundScheduler(1e9, 1e9, 10**9)
+    outbox.start()
+    sent = collections.defaultdict(list)
+    sends = []
+    t = time.perf_counter()
+    for i in range(iterations):
+        chat_id = rnd.randrange(chats)
+        sent[chat_id].append(i)
+        sends.append(outbox.send(chat_id, call(chat_id, i), rnd.choice((RELAY, NOTICE, BULK))))
+    await asyncio.gather(*sends)
+    elapsed = time.perf_counter() - t
+    await outbox.stop()
+    reordered = sum(delivered[chat_id] != order for chat_id, order in sent.items())
+    print(f"{iterations} sends to {chats} chats in {elapsed:.2f}s ({iterations / elapsed:.0f}/s), "
+          f"chats out of order: {reordered}")
+    if reordered:
+        raise SystemExit(1)
+    return {"sends_per_s": iterations / elapsed, "reordered": reordered}
+
+
+# --- ВЕБХУК: один пользователь шлет поток апдейтов, остальные не должны ждать его очереди ---
+def _raw_message(update_id, user_id):
+    sender = {"id": user_id, "is_bot": False, "first_name": "bench"}
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": 0, "chat": {"id": user_id, "type": "private"}, "from": sender, "text": "привет"}}
+
+
+async def bench_webhook(iterations, users=50, slots=10, work=0.005):
+    """iterations апдейтов от одного пользователя разом, следом по одному от users других;
+    обработчик занимает work секунд, вебхук пускает slots апдейтов одновременно"""
+    from aiogram import Bot, Dispatcher
+
+    from mailbox import MailboxMiddleware, Mailboxes
+    from webhook import WebhookHandler
+
+    logging.getLogger("aiogram.event").setLevel(logging.WARNING)  # строка INFO на каждый апдейт
+    latencies = {}
+
+    async def handler(message):
+        await asyncio.sleep(work)
+        latencies.setdefault(message.from_user.id, []).append(time.perf_counter())
+
+    results = {}
+    for label, mailboxes in (("semaphore only", None), ("mailbox first", Mailboxes())):
+        dp = Dispatcher()
+        dp.update.outer_middleware(MailboxMiddleware(mailboxes or Mailboxes()))
+        dp.message.register(handler)
+        webhook = WebhookHandler(dp, Bot("1:bench"), max_concurrency=slots, mailboxes=mailboxes)
+        latencies.clear()
+        hot = [asyncio.create_task(webhook._feed(webhook.bot, _raw_message(i, 1))) for i in range(iterations)]
+        await asyncio.sleep(0)
+        t = time.perf_counter()
+        others = [asyncio.create_task(webhook._feed(webhook.bot, _raw_message(iterations + uid, uid)))
+                  for uid in range(2, users + 2)]
+        await asyncio.gather(*others)
+        waited = [latencies[uid][0] - t for uid in range(2, users + 2)]
+        await asyncio.gather(*hot)
+        hot_s = latencies[1][-1] - t
+        await webhook.bot.session.close()
+        print(f"{label:<15} {users} users behind {iterations} updates of one: max wait {max(waited) * 1e3:.0f} ms, "
+              f"hot user done in {hot_s:.2f}s")
+        results[label] = {"max_wait": max(waited), "hot_s": hot_s}
+    # Без очереди за горячим пользователем: остальным хватает users / (slots - 1) обработок
+    limit = (users / (slots - 1) + 2) * work * 3
+    if results["mailbox first"]["max_wait"] > limit:
+        raise SystemExit(f"пользователи ждали очередь горячего: {results['mailbox first']['max_wait']:.3f}s > {limit:.3f}s")
+    return results
+
+
+# --- ВЫГРУЗКА: скорость на миллионах строк и влияние на цикл событий и запись ---
+async def _loop_lag(samples, period=0.001):
+    """Насколько позже обещанного просыпается sleep(period) - задержка всех обработчиков"""
+    while True:
+        t = time.perf_counter()
+        await asyncio.sleep(period)
+        samples.append(time.perf_counter() - t - period)
+
+
+async def _live_writes(samples, period=0.01):
+    """Запись оценок, как в живом боте, пока идет выгрузка"""
+    while True:
+        t = time.perf_counter()
+        await bot.db.execute("INSERT INTO ratings(from_user, to_user, rating) VALUES(?,?,?)", (1, 2, 5))
+        samples.append(time.perf_counter() - t)
+        await asyncio.sleep(period)
+
+
+async def bench_export(iterations):
+    rows = iterations * 500  # -n 2000 -> миллион строк в chats и в ratings
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = await use_temp_db(tmpdir)
+        t = time.perf_counter()
+        await bot.db.executemany(
+            "INSERT INTO chats(user1, user2, start_time, end_time, duration) VALUES(?,?,?,?,?)",
+            ((i, i + 1, "2024-01-01T12:00:00", "2024-01-01T12:05:00", 300) for i in range(rows))
+        )
+        await bot.db.executemany(
+            "INSERT INTO ratings(from_user, to_user, rating, ts) VALUES(?,?,?,?)",
+            ((i, i + 1, i % 5 + 1, "2024-01-01 12:05:00") for i in range(rows))
+        )
+        await bot.db.executemany(
+            "INSERT INTO admin_actions(admin_id, target_user, action) VALUES(?,?,?)",
+            ((1, i, "ban") for i in range(rows // 100))
+        )
+        print(f"filled {rows} chats, {rows} ratings, {rows // 100} admin_actions in {time.perf_counter() - t:.1f}s")
+
+        for fmt in ("ndjson", "csv"):
+            for where in ("thread", "process"):
+                await bot.db.execute("DELETE FROM export_watermarks")
+                out_dir = os.path.join(tmpdir, f"{fmt}_{where}")
+                lag, writes = [], []
+                tasks = [asyncio.create_task(_loop_lag(lag)), asyncio.create_task(_live_writes(writes))]
+                t = time.perf_counter()
+                if where == "thread":
+                    reports = await asyncio.to_thread(export_all, path, out_dir, fmt)
+                else:
+                    reports = await export_in_process(path, out_dir, fmt)
+                elapsed = time.perf_counter() - t
+                for task in tasks:
+                    task.cancel()
+                exported = sum(r["rows"] for r in reports)
+                size = sum(r["bytes"] for r in reports)
+                print(f"{fmt:<6} {where:<7} {exported / elapsed:8.0f} rows/s, {size / 2**20:6.1f} MiB gz, {elapsed:5.1f}s")
+                results[f"{fmt}_{where}"] = {
+                    "rows_per_s": exported / elapsed,
+                    "bytes": size,
+                    "loop_lag": report(f"  loop lag during export ({where})", lag),
+                    "write": report(f"  live INSERT during export ({where})", writes),
+                }
+
+        # Повторная выгрузка берет только строки новее водяного знака
+        await bot.db.executemany("INSERT INTO ratings(from_user, to_user, rating) VALUES(?,?,?)", [(1, 2, 3)] * 1000)
+        (before,) = await bot.db.fetchone("SELECT last_id FROM export_watermarks WHERE name='ratings'")
+        (newest,) = await bot.db.fetchone("SELECT MAX(id) FROM ratings")
+        t = time.perf_counter()
+        reports = await export_in_process(path, os.path.join(tmpdir, "ndjson_process"), "ndjson", tables=("ratings",))
+        elapsed = time.perf_counter() - t
+        with gzip.open(reports[0]["file"], "rt", encoding="utf-8") as f:
+            lines = sum(1 for _ in f)
+        print(f"incremental: {reports[0]['rows']} new ratings (expected {newest - before}, file has {lines}) in {elapsed:.2f}s")
+        if reports[0]["rows"] != newest - before or lines != newest - before:
+            raise SystemExit(1)
+        results["incremental_s"] = elapsed
+        await bot.writer.stop()
+        await bot.db.close()
+    return results
+
+
+# --- ЖУРНАЛ: падение посреди нагрузки, восстановление и цена журнала ---
+JOURNAL_BUTTONS = {
+    "idle": ("🔎 Найти собеседника",) * 3 + ("⛔ Выйти из поиска",),
+    "in_chat": ("привет",) * 4 + ("⏭️ Скипнуть", "❌ Завершить чат"),
+    "rating": ("⭐ 1", "🚫 Пропустить"),
+}
+
+
+def _journal_child(tmpdir, seed, users, ready):
+    """Процесс бота под нагрузкой с журналом; родитель убивает его SIGKILL"""
+    logging.getLogger(ROOT).setLevel(logging.WARNING)
+    asyncio.run(_journal_load(tmpdir, seed, users, ready))
+
+
+async def _journal_load(tmpdir, seed, users, ready=None):
+    rnd = random.Random(seed)
+    bot.bot = JitterBot(rnd)
+    await use_temp_db(tmpdir)
+    # Частые снимки: падение приходится и на запись снимка, и на смену поколения
+    reset_state(Journal(os.path.join(tmpdir, "journal"), interval=0.01, snapshot_ops=2000))
+    bot.mailboxes = bot.Mailboxes()
+    bot.pair_locks = bot.PairLocks()
+    bot.store.journal.start()
+    for uid in range(1, users + 1):
+        bot.user_gender[uid] = rnd.choice("MF")
+        bot.user_age[uid] = 20
+        bot.user_filters[uid] = {"min_rating": 0, "min_age": 14, "max_age": 100}
+        bot.user_state[uid] = "idle"
+        await bot.save_user_data(uid, bot.user_gender[uid], 20)
+    if ready is not None:
+        ready.set()
+    pending = set()
+
+    async def deliver(msg):
+        async with bot.mailboxes.hold(msg.from_user.id):
+            await bot.handle_all_messages(msg)
+
+    async def user(uid):
+        while True:
+            text = rnd.choice(JOURNAL_BUTTONS.get(bot.user_state.get(uid), JOURNAL_BUTTONS["idle"]))
+            task = asyncio.create_task(deliver(StubMessage(uid, text)))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+            await asyncio.sleep(rnd.random() * 0.003)
+
+    await asyncio.gather(*(user(uid) for uid in range(1, users + 1)))
+
+
+def _recovery_violations():
+    """После recover_state: пары взаимны, в чате - только те, у кого есть пара -> [описание]"""
+    found = pairing_violations()
+    for uid, state in bot.user_state.items():
+        if (state == "in_chat") != (uid in bot.active_chats):
+            found.append(f"{uid}: состояние {state}, пара {bot.active_chats.get(uid)}")
+        if state not in JOURNAL_BUTTONS:
+            found.append(f"{uid}: неизвестное состояние {state}")
+    for entry in bot.waiting_users:
+        if bot.user_state.get(entry.user_id) != "idle":
+            found.append(f"{entry.user_id} в очереди в состоянии {bot.user_state.get(entry.user_id)}")
+    return found
+
+
+def _fill_journaled(users):
+    """Зарегистрированные пользователи, пятая часть в чатах, десятая - в очереди"""
+    for uid in range(1, users + 1):
+        bot.user_gender[uid] = "MF"[uid % 2]
+        bot.user_age[uid] = 18 + uid % 40
+        bot.user_filters[uid] = {"min_rating": 0, "min_age": 14, "max_age": 100}
+        bot.user_state[uid] = "idle"
+    for uid in range(1, users // 5, 2):
+        bot.store.active_chats[uid] = uid + 1
+        bot.store.active_chats[uid + 1] = uid
+        bot.current_chat[uid] = bot.current_chat[uid + 1] = (uid, time.time())
+        bot.user_state[uid] = bot.user_state[uid + 1] = "in_chat"
+    for uid in range(users // 5, users // 5 + users // 10):
+        bot.waiting_users.add(uid, bot.user_gender[uid], bot.user_age[uid], bot.user_filters[uid], 3.0)
+
+
+async def _churn(users):
+    """Обработчики встают в очередь, выходят из нее и меняют возраст, пока идет снимок"""
+    rnd = random.Random(2)
+    while True:
+        uid = rnd.randrange(1, users + 1)
+        if uid in bot.waiting_users:
+            bot.waiting_users.remove(uid)
+        elif uid not in bot.active_chats:
+            bot.waiting_users.add(uid, bot.user_gender[uid], bot.user_age[uid], bot.user_filters[uid], 4.0)
+        bot.user_age[uid] = rnd.randint(18, 60)
+        await asyncio.sleep(0)
+
+
+def _journal_state(captured):
+    """Снимок Journal.capture() в сравнимом виде: имя -> {ключ: значение}"""
+    return {name: dict(zip(keys, values)) if keys is not None else {e[0]: e for e in values}
+            for name, keys, values in captured}
+
+
+async def bench_journal(iterations, users=300, kills=3, scale=100_000):
+    ctx = multiprocessing.get_context("spawn")
+    results = {}
+    violations = []
+    for trial in range(kills):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            ready = ctx.Event()
+            proc = ctx.Process(target=_journal_child, args=(tmpdir, trial, users, ready))
+            proc.start()
+            await asyncio.to_thread(ready.wait)
+            await asyncio.sleep(1 + trial)
+            os.kill(proc.pid, signal.SIGKILL)
+            proc.join()
+            files = len(os.listdir(tmpdir))
+            reset_state(Journal(os.path.join(tmpdir, "journal")))
+            t = time.perf_counter()
+            bot.recover_state()
+            elapsed = time.perf_counter() - t
+            found = _recovery_violations()
+            violations.extend(found)
+            print(f"kill #{trial + 1} after {1 + trial}s: {len(bot.user_state)} users, {len(bot.active_chats) // 2} chats, "
+                  f"{len(bot.waiting_users)} waiting, {files} files, recovered in {elapsed * 1e3:.1f}ms, violations={len(found)}")
+
+    # Масштаб: снимок и повтор журнала на scale пользователях, пока обработчики меняют состояние
+    with tempfile.TemporaryDirectory() as tmpdir:
+        prefix = os.path.join(tmpdir, "journal")
+        journal = Journal(prefix, snapshot_interval=1e9, snapshot_ops=1e12)
+        reset_state(journal)
+        journal.start()
+        await asyncio.sleep(0)  # первый снимок пустого состояния
+        t = time.perf_counter()
+        _fill_journaled(scale)
+        fill = time.perf_counter() - t
+        ops = journal.ops
+
+        lag = []
+        tasks = [asyncio.create_task(_loop_lag(lag)), asyncio.create_task(_churn(scale))]
+        t = time.perf_counter()
+        await journal.snapshot()
+        written = time.perf_counter() - t
+        for task in tasks:
+            task.cancel()
+        snap_bytes = os.path.getsize(prefix + ".snap")
+
+        # Хвост журнала после снимка: iterations * 50 смен состояния
+        tail = iterations * 50
+        for i in range(tail):
+            bot.user_state[i % scale + 1] = "idle" if i % 2 else "rating"
+        await journal.flush()
+        crashed = os.path.join(tmpdir, "crashed")
+        os.mkdir(crashed)
+        for name in os.listdir(tmpdir):
+            if name.startswith("journal."):
+                shutil.copy(os.path.join(tmpdir, name), crashed)
+        live = _journal_state(await journal.capture())
+        await journal.stop()
+
+        replay = {}
+        for label, path in (("snapshot", prefix), ("snapshot+log", os.path.join(crashed, "journal"))):
+            reset_state(Journal(path))
+            t = time.perf_counter()
+            entries, applied = bot.store.recover()
+            replay[label] = time.perf_counter() - t
+            same = _journal_state(await bot.store.journal.capture()) == live
+            if not same:
+                violations.append(f"восстановленное из {label} состояние отличается от живого")
+            print(f"recover {label:<13} {scale} users: {replay[label]:.2f}s "
+                  f"({entries} snapshot entries, {applied} log ops), same as live: {same}")
+
+        # Цена журнала на одну операцию: запись в сессию с журналом и без
+        raw = MemoryStateStore().user_state
+        samples = {}
+        for label, target in (("plain", raw), ("journaled", bot.user_state)):
+            t = time.perf_counter()
+            for i in range(tail):
+                target[i % 1000 + 1] = "idle"
+            samples[label] = (time.perf_counter() - t) / tail
+    print(f"fill {scale} users: {ops} ops in {fill:.2f}s; snapshot under churn {written:.2f}s, "
+          f"{snap_bytes / 2**20:.1f} MiB, max loop lag {max(lag, default=0) * 1e3:.0f}ms")
+    lag_stats = report("  loop lag during snapshot", lag)
+    print(f"user_state[uid] = ...: {samples['plain'] * 1e6:.2f}us plain, {samples['journaled'] * 1e6:.2f}us journaled")
+    for line in sorted(set(violations))[:20]:
+        print(f"VIOLATION: {line}")
+    if violations:
+        raise SystemExit(1)
+    results.update({
+        "snapshot_s": written, "snapshot_bytes": snap_bytes, "snapshot_lag": lag_stats,
+        "replay_s": replay, "append_us": {k: v * 1e6 for k, v in samples.items()}, "violations": len(violations),
+    })
+    return results
+
+
+# --- ПРОФИЛИРОВАНИЕ: блокировка цикла находится со стеком, профили видят горячую функцию ---
+def _blocking_call(seconds):
+    time.sleep(seconds)  # как синхронный запрос к базе или тяжелый json в обработчике
+
+
+def _hot_function(n):
+    return sum(i * i for i in range(n))
+
+
+async def _busy_handler(stop):
+    while not stop.is_set():
+        _hot_function(20_000)
+        await asyncio.sleep(0.001)
+
+
+async def bench_perf(iterations):
+    results = {}
+    failures = []
+
+    # Цена замера: тот же вызов голым, через ACTION_SECONDS.time и через TimingMiddleware
+    class Handler:
+        callback = bot.handle_all_messages
+
+    async def noop(event, data):
+        return None
+
+    middleware = TimingMiddleware()
+    data = {"handler": Handler}
+    plain, timed_, wrapped = [], [], []
+    for _ in range(iterations):
+        t = time.perf_counter()
+        await noop(None, data)
+        plain.append(time.perf_counter() - t)
+        t = time.perf_counter()
+        with ACTION_SECONDS.time(action="bench"):
+            await noop(None, data)
+        timed_.append(time.perf_counter() - t)
+        t = time.perf_counter()
+        await middleware(noop, None, data)
+        wrapped.append(time.perf_counter() - t)
+    results["plain"] = report("handler call", plain)
+    results["histogram_time"] = report("  + ACTION_SECONDS.time", timed_)
+    results["middleware"] = report("  + TimingMiddleware", wrapped)
+
+    # Блокировка 300 мс: сторож должен снять стек с _blocking_call
+    monitor = LoopMonitor(interval=0.02, slow=0.1)
+    monitor.start()
+    await asyncio.sleep(0.1)
+    _blocking_call(0.3)
+    await asyncio.sleep(0.1)
+    await monitor.stop()
+    stalls = list(monitor.stalls)
+    found = [stack for _, lag, stack in stalls if stack and any("_blocking_call" in f for f in stack)]
+    print(f"stalls: {[(round(lag * 1e3), stack[-1] if stack else None) for _, lag, stack in stalls]}")
+    if len(stalls) != 1 or not found:
+        failures.append("блокировка не найдена или найдена без стека _blocking_call")
+
+    # Профили под нагрузкой: горячая функция должна быть наверху
+    for name, profiler in (("sample", sample), ("cprofile", cprofile)):
+        stop = asyncio.Event()
+        busy = asyncio.create_task(_busy_handler(stop))
+        lag = []
+        lagger = asyncio.create_task(_loop_lag(lag))
+        t = time.perf_counter()
+        text = await profiler(1)
+        elapsed = time.perf_counter() - t
+        stop.set()
+        await busy
+        lagger.cancel()
+        top = next((line for line in text.splitlines() if "_hot_function" in line or "<genexpr>" in line), None)
+        print(f"{name}: {elapsed:.2f}s, {len(text) / 1024:.0f} KiB report, hot line: {top.strip() if top else None}")
+        results[name] = {"loop_lag": report(f"  loop lag during {name}", lag), "report_bytes": len(text)}
+        if top is None:
+            failures.append(f"{name}: нет _hot_function в отчете")
+
+    for line in failures:
+        print(f"FAIL: {line}")
+    if failures:
+        raise SystemExit(1)
+    return results
+
+
+BENCHMARKS = {
+    "db": bench_db,
+    "writer": bench_writer,
+    "logging": bench_logging,
+    "stats": bench_stats,
+    "plans": bench_plans,
+    "workers": bench_workers,
+    "races": bench_races,
+    "timers": bench_timers,
+    "sessions": bench_sessions,
+    "interests": bench_interests,
+    "broadcast": bench_broadcast,
+    "outbox": bench_outbox,
+    "webhook": bench_webhook,
+    "export": bench_export,
+    "journal": bench_journal,
+    "perf": bench_perf,
+    "find_pair": bench_find_pair,
+    "rating": bench_rating,
+    "chat_log": bench_chat_log,
+    "admin_stats": bench_admin_stats,
+    "dispatch": bench_dispatch,
+}
+
+# Группы для запуска одним именем
+GROUPS = {
+    "micro": ("find_pair", "rating", "chat_log", "admin_stats", "dispatch", "timers"),
+}
+
+
+def compare(results, baseline, threshold, path=()):
+    """Сравнить p50 с базовой линией -> [(путь, было, стало)] для замедлившихся больше чем на threshold"""
+    regressions = []
+    for key, value in results.items():
+        base = baseline.get(key)
+        if not isinstance(value, dict) or not isinstance(base, dict):
+            continue
+        if "p50" in value and "p50" in base:
+            if base["p50"] and value["p50"] > base["p50"] * (1 + threshold):
+                regressions.append(("/".join(path + (key,)), base["p50"], value["p50"]))
+        else:
+            regressions.extend(compare(value, base, threshold, path + (key,)))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("names", nargs="*", metavar="name",
+                        help=f"из: {', '.join(list(BENCHMARKS) + list(GROUPS))} (по умолчанию все)")
+    parser.add_argument("-n", "--iterations", type=int, default=2000)
+    parser.add_argument("--save", help="записать результаты в JSON")
+    parser.add_argument("--baseline", help="JSON прошлого прогона; выйти с кодом 1 при регрессии")
+    parser.add_argument("--threshold", type=float, default=0.3, help="допустимое замедление p50 (0.3 = 30%%)")
+    args = parser.parse_args()
+    names = [n for name in args.names for n in GROUPS.get(name, (name,))] or list(BENCHMARKS)
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"неизвестные бенчмарки: {', '.join(sorted(unknown))}")
+
+    logging.getLogger(ROOT).setLevel(logging.WARNING)  # INFO-логи бота на каждую пару мешают читать вывод
+    results = {}
+    for name in names:
+        print(f"--- {name}")
+        results[name] = asyncio.run(BENCHMARKS[name](args.iterations))
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, default=str)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for path, before, after in regressions:
+            print(f"REGRESSION {path}: p50 {before * 1e6:.1f}us -> {after * 1e6:.1f}us (+{(after / before - 1) * 100:.0f}%)")
+        if regressions:
+            sys.exit(1)
+        print(f"no regressions over {args.threshold:.0%}")
+
+
+if __name__ == "__main__":
+    main()
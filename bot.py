@@ -1,31 +1,162 @@
 import asyncio
-import aiosqlite
 from aiogram import Bot, Dispatcher, types
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.filters import Command
-import logging
+from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, BufferedInputFile
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.filters import Command, CommandObject
+from collections import Counter
 from datetime import datetime
+import multiprocessing
 import os
+import time
+
+from broadcast import RUNNING as BROADCAST_RUNNING, Broadcaster
+from cache import Profile, ProfileCache
+from filters import filters_from_row, filters_to_row
+from db import Database
+from export import FORMATS as EXPORT_FORMATS, export_in_process, format_report as format_export_report
+from journal import Journal
+from logs import get_logger, setup_logging
+from mailbox import MailboxMiddleware, Mailboxes, PairLocks
+from matchmaking import DEFAULT_FILTERS, MAX_TAGS, parse_tags
+from metrics import (
+    REGISTRY, ACTION_SECONDS, DB_QUERY_SECONDS, EXPIRED, FIND_PAIR_SECONDS, HANDLER_SECONDS, LOOP_LAG_SECONDS, LOOP_STALLS, MATCHES,
+    RELAY_SECONDS, TELEGRAM_SECONDS, TIME_TO_MATCH_SECONDS, Gauge, build_metrics_app, timed
+)
+from migrations import check_plans, migrate
+from perf import LoopMonitor, TimingMiddleware, cprofile, format_histogram, format_stalls, sample
+from queries import (
+    ADD_RATING_SQL, ADMIN_ACTION_SQL, CHAT_END_SQL, CHAT_START_SQL, LOG_RATING_SQL, PROFILE_SQL, SAVE_FILTERS_SQL,
+    SAVE_INTERESTS_SQL, SAVE_USER_SQL, SET_BANNED_SQL, USERS_AFTER_SQL, USERS_BEFORE_SQL
+)
+from relay import AlbumBuffer, to_input_media
+from sender import BULK, OutboundMiddleware, OutboundScheduler, RELAY, lane
+from state import create_store
+from stats import read_counters, read_popular_hours, rebuild_stats
+from timers import TimerWheel
+from webhook import run_webhook, serve
+from writer import WriteBehind
 
 # --- НАСТРОЙКА ---
 BOT_TOKEN = os.environ.get('BOT_TOKEN')  # Берем токен из переменных окружения
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL')  # свой сервер Bot API (локальный telegram-bot-api или заглушка из loadtest.py)
 ADMIN_ID = 6302652536  # Ваш ID для админки
 ADMIN_PASS = "1234"
 DB_PATH = "anon_chat.db"
+PROFILE_CACHE_SIZE = int(os.environ.get('PROFILE_CACHE_SIZE', 10000))  # сколько профилей держать в памяти
+PROFILE_CACHE_TTL = float(os.environ.get('PROFILE_CACHE_TTL', 0))  # сек, 0 - без срока (только при WORKERS=1, иначе WORKERS_PROFILE_TTL)
+DB_FLUSH_INTERVAL = float(os.environ.get('DB_FLUSH_INTERVAL', 0.05))  # окно группового коммита, сек (сколько записей можно потерять при падении)
+DB_FLUSH_BATCH = int(os.environ.get('DB_FLUSH_BATCH', 500))  # коммитим раньше, если набралось столько записей
+DB_DEAD_LETTER = os.environ.get('DB_DEAD_LETTER', 'anon_dead_letter.jsonl')  # сюда пишутся строки, которые не удалось записать и после повторов
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')  # "polling" или "webhook"
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL') or os.environ.get('RENDER_EXTERNAL_URL')  # без адреса вебхук не регистрируется (локальная проверка)
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')  # сверяется с заголовком X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_CONCURRENCY = int(os.environ.get('WEBHOOK_CONCURRENCY', 100))  # сколько апдейтов обрабатываем одновременно
+WEB_HOST = os.environ.get('WEB_HOST', '0.0.0.0')
+PORT = int(os.environ.get('PORT', 8080))  # Render передает порт через PORT
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))  # /metrics в режиме polling; в режиме вебхука он на PORT
+STATE_BACKEND = os.environ.get('STATE_BACKEND', 'memory')  # "memory" или "sqlite" (общее состояние для WORKERS > 1)
+STATE_DB_PATH = os.environ.get('STATE_DB_PATH', 'anon_state.db')
+STATE_BUSY_TIMEOUT = float(os.environ.get('STATE_BUSY_TIMEOUT', 0.1))  # сек, сколько запрос к общему состоянию может ждать другой воркер, останавливая цикл событий
+STATE_LOCK_TIMEOUT = float(os.environ.get('STATE_LOCK_TIMEOUT', 5))  # сек, сколько подбор пары ждет блокировку записи (цикл при этом не стоит)
+ADMIN_PAGE_SIZE = int(os.environ.get('ADMIN_PAGE_SIZE', 10))  # пользователей на странице панели админа
+WORKERS = int(os.environ.get('WORKERS', 1))  # сколько процессов запустить (только вебхук + STATE_BACKEND=sqlite)
+WORKER_INDEX = 0  # номер процесса; вебхук в Telegram регистрирует только нулевой
+WORKERS_PROFILE_TTL = 2  # сек; при WORKERS > 1 профиль не живет в кэше без срока - бан, оценку или анкету из другого воркера он бы не увидел
+SEND_RATE = float(os.environ.get('SEND_RATE', 30))  # сообщений в секунду на всего бота (лимит Telegram ~30)
+SEND_CHAT_RATE = float(os.environ.get('SEND_CHAT_RATE', 1))  # сообщений в секунду в один чат
+SEND_CHAT_BURST = int(os.environ.get('SEND_CHAT_BURST', 5))  # сколько можно отправить в чат подряд без ожидания
+ALBUM_DELAY = float(os.environ.get('ALBUM_DELAY', 0.5))  # сколько ждать остальные сообщения альбома, сек
+QUEUE_TIMEOUT = int(os.environ.get('QUEUE_TIMEOUT', 600))  # сек в очереди без пары, после чего поиск останавливается; 0 - без срока
+CHAT_IDLE_TIMEOUT = int(os.environ.get('CHAT_IDLE_TIMEOUT', 1800))  # сек без сообщений, после чего чат завершается; 0 - без срока
+RATING_TIMEOUT = int(os.environ.get('RATING_TIMEOUT', 600))  # сек на оценку собеседника, потом запрос снимается; 0 - без срока
+TIMER_TICK = float(os.environ.get('TIMER_TICK', 1))  # шаг колеса таймеров, сек
+TIMER_CONCURRENCY = int(os.environ.get('TIMER_CONCURRENCY', 1000))  # сколько обработчиков истечения выполняются одновременно
+INTEREST_TIMEOUT = int(os.environ.get('INTEREST_TIMEOUT', 30))  # сек, сколько пользователь с интересами ждет общих тегов до поиска по обычным фильтрам; 0 - сразу
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', 100000))  # сколько сессий держать в памяти (STATE_BACKEND=memory), 0 - без ограничения
+SESSION_TTL = float(os.environ.get('SESSION_TTL', 3600))  # сек простоя, после которых сессия вытесняется; 0 - без срока
+BROADCAST_RATE = float(os.environ.get('BROADCAST_RATE', 20))  # сообщений рассылки в секунду; остаток SEND_RATE остается чатам
+BROADCAST_CHUNK = int(os.environ.get('BROADCAST_CHUNK', 500))  # получателей читаем из users пачками по столько; после пачки сохраняем курсор
+BROADCAST_CONCURRENCY = int(os.environ.get('BROADCAST_CONCURRENCY', 50))  # сколько отправок рассылки одновременно в полете
+BROADCAST_REPORT_INTERVAL = float(os.environ.get('BROADCAST_REPORT_INTERVAL', 5))  # сек между обновлениями прогресса у админа
+JOURNAL_PATH = os.environ.get('JOURNAL_PATH', 'anon_journal')  # журнал состояния (STATE_BACKEND=memory): anon_journal.snap и anon_journal.N.log; пусто - без журнала
+JOURNAL_FLUSH_INTERVAL = float(os.environ.get('JOURNAL_FLUSH_INTERVAL', 0.05))  # раз во столько секунд журнал пишется с fsync (сколько переходов можно потерять при падении)
+JOURNAL_SNAPSHOT_INTERVAL = float(os.environ.get('JOURNAL_SNAPSHOT_INTERVAL', 300))  # сек между снимками состояния
+JOURNAL_SNAPSHOT_OPS = int(os.environ.get('JOURNAL_SNAPSHOT_OPS', 100000))  # снимок раньше, если в журнале набралось столько операций
+EXPORT_DIR = os.environ.get('EXPORT_DIR', 'exports')  # куда /export пишет файлы .ndjson.gz / .csv.gz
+EXPORT_CHUNK = int(os.environ.get('EXPORT_CHUNK', 10000))  # строк за один запрос выгрузки
+PERF_LOOP_INTERVAL = float(os.environ.get('PERF_LOOP_INTERVAL', 0.05))  # сек между замерами задержки цикла событий
+PERF_SLOW_CALLBACK = float(os.environ.get('PERF_SLOW_CALLBACK', 0.1))  # вызов, который держит цикл дольше стольких секунд, попадает в лог со стеком и в /perf
+PERF_PROFILE_SECONDS = int(os.environ.get('PERF_PROFILE_SECONDS', 10))  # длительность /perf profile|sample по умолчанию, сек
+PERF_PROFILE_MAX = int(os.environ.get('PERF_PROFILE_MAX', 120))  # дольше профиль не снимаем
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_LEVELS = os.environ.get('LOG_LEVELS', '')  # уровни по подсистемам, например "matchmaking=DEBUG,relay=WARNING"
+LOG_JSON = os.environ.get('LOG_JSON', '0') == '1'  # логи строками JSON
+LOG_DEBUG_RATE = int(os.environ.get('LOG_DEBUG_RATE', 20))  # не больше стольких DEBUG-записей в секунду на подсистему
 
-logging.basicConfig(level=logging.INFO)
-bot = Bot(token=BOT_TOKEN)
+log_listener = setup_logging(LOG_LEVEL, LOG_LEVELS, LOG_JSON, LOG_DEBUG_RATE)  # пишет в stderr из отдельного потока
+log_match = get_logger("matchmaking")
+log_relay = get_logger("relay")
+log_admin = get_logger("admin")
+log_db = get_logger("db")
+log_webhook = get_logger("webhook")
+bot = Bot(token=BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None)
 dp = Dispatcher()
+outbox = OutboundScheduler(SEND_RATE / WORKERS, SEND_CHAT_RATE, SEND_CHAT_BURST)  # все исходящие сообщения идут через него; общий лимит делим между воркерами
+bot.session.middleware(OutboundMiddleware(outbox))
+mailboxes = Mailboxes()  # апдейты одного пользователя обрабатываются по очереди, разных - параллельно
+dp.update.outer_middleware(MailboxMiddleware(mailboxes))
+dp.message.middleware(TimingMiddleware())  # время каждого обработчика без ожидания в ящике (/perf, anonchat_handler_seconds)
+dp.callback_query.middleware(TimingMiddleware())
+loop_monitor = LoopMonitor(PERF_LOOP_INTERVAL, PERF_SLOW_CALLBACK)  # задержка цикла событий и стеки блокирующих вызовов
+pair_locks = PairLocks()  # соединение и завершение чата меняют состояние двух пользователей разом
+timers = TimerWheel(TIMER_TICK)  # ("queue"/"chat"/"rating"/"interests", user_id) -> когда проверить, не истек ли срок
+albums = AlbumBuffer(lambda *args: send_album(*args), ALBUM_DELAY)  # media_group_id -> сообщения альбома
 
 # --- СОСТОЯНИЯ ---
-waiting_users = []  # [(user_id, gender, age, filters)]
-active_chats = {}  # user_id -> partner_id
-user_gender = {}  # user_id -> "M"/"F"
-user_age = {}  # user_id -> возраст
-user_state = {}  # user_id -> "choosing_gender"/"choosing_age"/"idle"/"in_chat"/"admin_pass"/"rating"/"setting_filters"
-awaiting_rating = {}  # user_id -> partner_id (кого нужно оценить)
-user_filters = {}  # user_id -> {"min_rating": 0, "max_age": 100, "min_age": 14}
-chat_start_time = {}  # (user1, user2) -> start_time
+# Хранилище выбирается через STATE_BACKEND: "memory" - в процессе, "sqlite" - общее для нескольких воркеров
+store = create_store(
+    STATE_BACKEND, STATE_DB_PATH, SESSION_CACHE_SIZE, SESSION_TTL, INTEREST_TIMEOUT,
+    Journal(JOURNAL_PATH, JOURNAL_FLUSH_INTERVAL, JOURNAL_SNAPSHOT_INTERVAL, JOURNAL_SNAPSHOT_OPS)
+    if JOURNAL_PATH and STATE_BACKEND == "memory" else None,
+    STATE_BUSY_TIMEOUT, STATE_LOCK_TIMEOUT
+)
+sessions = store.sessions  # user_id -> Session; None у sqlite-хранилища
+waiting_users = store.waiting_users  # очередь ожидания, индексированная по возрасту и рейтингу
+active_chats = store.active_chats  # user_id -> partner_id
+user_gender = store.user_gender  # user_id -> "M"/"F"
+user_age = store.user_age  # user_id -> возраст
+user_state = store.user_state  # user_id -> "choosing_gender"/"choosing_age"/"idle"/"in_chat"/"admin_pass"/"admin_search"/"rating"/"setting_filters"
+awaiting_rating = store.awaiting_rating  # user_id -> partner_id (кого нужно оценить)
+user_filters = store.user_filters  # user_id -> {"min_rating": 0, "max_age": 100, "min_age": 14}
+current_chat = store.current_chat  # user_id -> (id строки chats, start_time), у обоих участников
+chat_activity = store.chat_activity  # user_id -> time.time() последнего сообщения в чате (для CHAT_IDLE_TIMEOUT)
+rating_since = store.rating_since  # user_id -> time.time() запроса оценки (для RATING_TIMEOUT)
+
+@dp.update.outer_middleware()
+async def session_middleware(handler, event, data):
+    """Отметить активность пользователя в LRU сессий; вытесненную сессию восстановить.
+    Зарегистрирован после MailboxMiddleware, поэтому выполняется внутри ящика пользователя"""
+    user = data.get("event_from_user")
+    if sessions is not None and user is not None:
+        if user.id not in sessions:
+            await restore_session(user.id)
+        sessions.touch(user.id)
+    return await handler(event, data)
+
+# --- МЕТРИКИ ---
+REGISTRY.register(Gauge("anonchat_waiting_users", "Пользователей в очереди ожидания", lambda: len(waiting_users)))
+REGISTRY.register(Gauge("anonchat_active_chats", "Активных чатов", lambda: len(active_chats) // 2))
+REGISTRY.register(Gauge("anonchat_users_by_state", "Пользователей в каждом состоянии", lambda: Counter(user_state.values()), labels=("state",)))
+REGISTRY.register(Gauge("anonchat_sessions", "Сессий пользователей в памяти", lambda: len(sessions) if sessions is not None else 0))
+REGISTRY.register(Gauge("anonchat_sessions_evicted", "Сессий вытеснено по LRU/TTL с запуска", lambda: sessions.evicted if sessions is not None else 0))
+REGISTRY.register(Gauge("anonchat_busy_mailboxes", "Пользователей с апдейтами в обработке", lambda: len(mailboxes)))
+REGISTRY.register(Gauge("anonchat_timers", "Запущенных таймеров истечения", lambda: len(timers)))
+REGISTRY.register(Gauge("anonchat_journal_pending", "Операций журнала состояния, еще не записанных на диск", lambda: len(store.journal) if store.journal is not None else 0))
+REGISTRY.register(Gauge("anonchat_outbox_queue_depth", "Исходящих сообщений в очереди", lambda: outbox.depth()))
+REGISTRY.register(Gauge("anonchat_broadcasts_running", "Идущих рассылок админа", lambda: len(broadcasts)))
 
 # --- КЛАВИАТУРЫ ---
 gender_kb = ReplyKeyboardMarkup(
@@ -61,220 +192,227 @@ filters_kb = ReplyKeyboardMarkup(
     keyboard=[
         [KeyboardButton(text="📊 Минимальный рейтинг"), KeyboardButton(text="🎂 Возрастной диапазон")],
         [KeyboardButton(text="❌ Сбросить фильтры"), KeyboardButton(text="📋 Текущие настройки")],
-        [KeyboardButton(text="🔙 Назад")]
+        [KeyboardButton(text="🏷 Интересы"), KeyboardButton(text="🔙 Назад")]
     ],
     resize_keyboard=True
 )
 
 # --- БАЗА ДАННЫХ ---
+db = Database(DB_PATH)  # одно соединение на весь процесс, открывается в init_db()
+profiles = ProfileCache(
+    PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL or (WORKERS_PROFILE_TTL if WORKERS > 1 else 0)
+)  # user_id -> Profile, обновляется при каждой записи в users этим воркером
+writer = WriteBehind(db, DB_FLUSH_INTERVAL, DB_FLUSH_BATCH, dead_letter=DB_DEAD_LETTER)  # логи чатов и оценки пишутся пачками в фоне
+broadcasts = Broadcaster(
+    db, lambda uid, text: send_broadcast(uid, text), lambda b: report_broadcast(b),
+    BROADCAST_RATE, BROADCAST_CHUNK, BROADCAST_CONCURRENCY, BROADCAST_REPORT_INTERVAL
+)  # рассылки админа, курсор в таблице broadcasts
+
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            banned INTEGER DEFAULT 0,
-            gender TEXT,
-            age INTEGER DEFAULT 0,
-            rating REAL DEFAULT 0.0,
-            rating_count INTEGER DEFAULT 0,
-            interests TEXT,
-            filters TEXT,
-            created_at TEXT
-        )""")
-        
-        await db.execute("""CREATE TABLE IF NOT EXISTS admin_actions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            admin_id INTEGER,
-            target_user INTEGER,
-            action TEXT,
-            ts TEXT DEFAULT CURRENT_TIMESTAMP
-        )""")
-        
-        await db.execute("""CREATE TABLE IF NOT EXISTS ratings (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            from_user INTEGER,
-            to_user INTEGER,
-            rating INTEGER,
-            ts TEXT DEFAULT CURRENT_TIMESTAMP
-        )""")
-        
-        await db.execute("""CREATE TABLE IF NOT EXISTS chats (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user1 INTEGER,
-            user2 INTEGER,
-            start_time TEXT,
-            end_time TEXT,
-            duration INTEGER DEFAULT 0
-        )""")
-        await db.commit()
-
-async def get_user_stats():
+    await db.connect()
+    before, after = await migrate(db)
+    if before != after:
+        log_db.info("Схема базы: версия %s -> %s", before, after)
+    await check_plans(db)  # удаленный индекс или измененный запрос - ошибка при старте, а не медленный бот
+    writer.start()
+
+async def get_user_stats(counters=None):
     """Получить статистику пользователей"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Всего пользователей
-        cur = await db.execute("SELECT COUNT(*) FROM users")
-        total_users = (await cur.fetchone())[0]
-        
-        # Активных пользователей (не забаненных)
-        cur = await db.execute("SELECT COUNT(*) FROM users WHERE banned = 0")
-        active_users = (await cur.fetchone())[0]
-        
-        # Забаненных пользователей
-        cur = await db.execute("SELECT COUNT(*) FROM users WHERE banned = 1")
-        banned_users = (await cur.fetchone())[0]
-        
-        # Пользователей онлайн (в активных чатах)
-        online_users = len(active_chats) * 2
-        
-        return {
-            "total_users": total_users,
-            "active_users": active_users,
-            "banned_users": banned_users,
-            "online_users": online_users
-        }
+    if counters is None:
+        counters = await read_counters(db)
+    total_users = counters["total_users"]
+    banned_users = counters["banned_users"]
+    
+    # Пользователей онлайн (в активных чатах; в active_chats по записи на каждого)
+    online_users = len(active_chats)
+    
+    return {
+        "total_users": total_users,
+        "active_users": total_users - banned_users,
+        "banned_users": banned_users,
+        "online_users": online_users
+    }
+
+async def get_profile(user_id):
+    """Профиль из кэша, при промахе - одним запросом из users"""
+    profile = profiles.get(user_id)
+    if profile is not None:
+        return profile
+    row = await db.fetchone(PROFILE_SQL, (user_id,))
+    if row:
+        profile = Profile(
+            banned=row[0] == 1,
+            rating=row[1] or 0.0,
+            rating_count=row[2] or 0,
+            gender=row[3],
+            age=row[4] or 0,
+            filters=filters_from_row(*row[5:8]),
+            interests=parse_tags(row[8]),
+        )
+    else:
+        profile = Profile()
+    return profiles.put(user_id, profile)
 
 async def ban_user(user_id):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("INSERT OR REPLACE INTO users(user_id, banned) VALUES(?,1)", (user_id,))
-        await db.commit()
+    await db.execute(SET_BANNED_SQL, (user_id, 1))
+    profiles.update(user_id, banned=True)
 
 async def unban_user(user_id):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("INSERT OR REPLACE INTO users(user_id, banned) VALUES(?,0)", (user_id,))
-        await db.commit()
+    await db.execute(SET_BANNED_SQL, (user_id, 0))
+    profiles.update(user_id, banned=False)
 
 async def is_banned(user_id):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT banned FROM users WHERE user_id=?", (user_id,))
-        row = await cur.fetchone()
-        return row and row[0] == 1
+    return (await get_profile(user_id)).banned
 
 async def save_user_data(user_id, gender, age):
-    async with aiosqlite.connect(DB_PATH) as db:
-        current_time = datetime.now().isoformat()
-        await db.execute(
-            "INSERT OR REPLACE INTO users(user_id, gender, age, created_at) VALUES(?,?,?,?)", 
-            (user_id, gender, age, current_time)
-        )
-        await db.commit()
+    current_time = datetime.now().isoformat()
+    await db.execute(SAVE_USER_SQL, (user_id, gender, age, current_time))
+    profiles.update(user_id, gender=gender, age=age)
 
-async def update_rating(user_id, rating):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT rating, rating_count FROM users WHERE user_id=?", (user_id,))
-        row = await cur.fetchone()
-        
-        if row and row[0] is not None:
-            current_rating, count = row[0] or 0, row[1] or 0
-            new_rating = (current_rating * count + rating) / (count + 1)
-            await db.execute(
-                "UPDATE users SET rating=?, rating_count=? WHERE user_id=?", 
-                (new_rating, count + 1, user_id)
-            )
-        else:
-            await db.execute(
-                "INSERT OR REPLACE INTO users(user_id, rating, rating_count, created_at) VALUES(?,?,?,?)", 
-                (user_id, rating, 1, datetime.now().isoformat())
-            )
-        
-        from_user = None
-        for uid, partner_id in awaiting_rating.items():
-            if partner_id == user_id:
-                from_user = uid
-                break
-        
-        if from_user:
-            await db.execute(
-                "INSERT INTO ratings(from_user, to_user, rating) VALUES(?,?,?)",
-                (from_user, user_id, rating)
-            )
-        await db.commit()
+async def update_rating(user_id, rating, from_user=None):
+    profile = await get_profile(user_id)
+    count = profile.rating_count
+    new_rating = (profile.rating * count + rating) / (count + 1)
+    profiles.update(user_id, rating=new_rating, rating_count=count + 1)
+    writer.submit(ADD_RATING_SQL, (user_id, rating, datetime.now().isoformat()))  # приращение, не итог из кэша
+    
+    if from_user:
+        writer.submit(LOG_RATING_SQL, (from_user, user_id, rating))
+    
+    waiting_users.update_rating(user_id, round(new_rating, 1))
 
 async def get_user_rating(user_id):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT rating, rating_count FROM users WHERE user_id=?", (user_id,))
-        row = await cur.fetchone()
-        if row and row[0] is not None:
-            return round(row[0], 1), row[1] or 0
-        return 0, 0
+    profile = await get_profile(user_id)
+    if profile.rating_count:
+        return round(profile.rating, 1), profile.rating_count
+    return 0, 0
 
 async def save_user_filters(user_id, filters):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT OR REPLACE INTO users(user_id, filters) VALUES(?,?)",
-            (user_id, str(filters))
-        )
-        await db.commit()
+    await db.execute(SAVE_FILTERS_SQL, (user_id, *filters_to_row(filters)))
+    profiles.update(user_id, filters=dict(filters))
+
+async def save_user_interests(user_id, tags):
+    """Интересы хранятся в users.interests строкой "тег1,тег2" """
+    await db.execute(SAVE_INTERESTS_SQL, (user_id, ",".join(tags) or None))
+    profiles.update(user_id, interests=tuple(tags))
 
 async def get_user_filters(user_id):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT filters FROM users WHERE user_id=?", (user_id,))
-        row = await cur.fetchone()
-        if row and row[0]:
-            try:
-                return eval(row[0])
-            except:
-                return {"min_rating": 0, "min_age": 14, "max_age": 100}
-        return {"min_rating": 0, "min_age": 14, "max_age": 100}
+    return (await get_profile(user_id)).filters
+
+async def load_user_filters(user_id):
+    """Фильтры из состояния; после перезапуска подтягиваем их из базы"""
+    filters = user_filters.get(user_id)
+    if filters is None:
+        filters = await get_user_filters(user_id)
+        if filters is not None:
+            user_filters[user_id] = filters
+    return filters or DEFAULT_FILTERS
+
+async def restore_session(user_id):
+    """Сессии нет в памяти (вытеснена или бот перезапущен): пол и возраст берем из users,
+    фильтры подтянет load_user_filters"""
+    profile = await get_profile(user_id)
+    if profile.gender and profile.age:
+        user_gender[user_id] = profile.gender
+        user_age[user_id] = profile.age
+        user_state[user_id] = "idle"
 
 async def log_chat_start(user1, user2):
+    """Записать начало диалога, вернуть id строки в chats.
+
+    Вставка идет сразу, а не через writer: id нужен, чтобы log_chat_end
+    обновил строку по первичному ключу, и он должен быть общим для всех воркеров.
+    """
     start_time = datetime.now().isoformat()
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT INTO chats(user1, user2, start_time) VALUES(?,?,?)",
-            (user1, user2, start_time)
-        )
-        await db.commit()
-    chat_start_time[(user1, user2)] = start_time
+    chat_id = await db.execute(CHAT_START_SQL, (user1, user2, start_time))
+    current_chat[user1] = current_chat[user2] = (chat_id, start_time)
+    return chat_id
 
 async def log_chat_end(user1, user2):
-    end_time = datetime.now()
-    start_time = chat_start_time.get((user1, user2))
-    if not start_time:
+    """Записать конец диалога; кто из двоих его завершил - не важно"""
+    entry = current_chat.pop(user1, None)
+    current_chat.pop(user2, None)
+    if not entry:
         return
+    chat_id, start_time = entry
     
-    duration = (end_time - datetime.fromisoformat(start_time)).seconds
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "UPDATE chats SET end_time=?, duration=? WHERE user1=? AND user2=? AND end_time IS NULL",
-            (end_time.isoformat(), duration, user1, user2)
-        )
-        await db.commit()
-    
-    if (user1, user2) in chat_start_time:
-        del chat_start_time[(user1, user2)]
+    end_time = datetime.now()
+    duration = int((end_time - datetime.fromisoformat(start_time)).total_seconds())
+    writer.submit(CHAT_END_SQL, (end_time.isoformat(), duration, chat_id))
 
 # --- СТАТИСТИКА ДЛЯ АДМИНА ---
 async def get_admin_stats():
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Общее количество диалогов
-        cur = await db.execute("SELECT COUNT(*) FROM chats")
-        total_chats = (await cur.fetchone())[0]
-        
-        # Средняя продолжительность чата
-        cur = await db.execute("SELECT AVG(duration) FROM chats WHERE duration > 0")
-        avg_duration = (await cur.fetchone())[0] or 0
-        
-        # Популярное время активности (по часам)
-        cur = await db.execute("""
-            SELECT strftime('%H', start_time) as hour, COUNT(*) as count 
-            FROM chats 
-            GROUP BY hour 
-            ORDER BY count DESC 
-            LIMIT 3
-        """)
-        popular_hours = await cur.fetchall()
-        
-        # Статистика пользователей
-        user_stats = await get_user_stats()
-        
-        return {
-            "total_chats": total_chats,
-            "avg_duration": round(avg_duration / 60, 1),
-            "popular_hours": popular_hours,
-            "user_stats": user_stats
-        }
+    # Счетчики поддерживаются триггерами (stats.py), полных проходов по таблицам нет
+    counters = await read_counters(db)
+    total_chats = counters["total_chats"]
+    
+    # Средняя продолжительность чата
+    avg_duration = counters["duration_sum"] / counters["duration_count"] if counters["duration_count"] else 0
+    
+    # Популярное время активности (по часам)
+    popular_hours = await read_popular_hours(db)
+    
+    # Статистика пользователей
+    user_stats = await get_user_stats(counters)
+    
+    return {
+        "total_chats": total_chats,
+        "avg_duration": round(avg_duration / 60, 1),
+        "popular_hours": popular_hours,
+        "user_stats": user_stats,
+        "profile_cache": profiles.stats(),
+        "outbox": outbox.stats()
+    }
+
+def format_admin_stats(stats):
+    user_stats = stats["user_stats"]
+    cache = stats["profile_cache"]
+    outbox_stats = stats["outbox"]
+    
+    popular_hours_text = ""
+    for hour, count in stats["popular_hours"]:
+        popular_hours_text += f"{hour}:00 - {count} чатов\n"
+    
+    return f"""
+📊 **Статистика бота:**
+
+👥 **Пользователи:**
+• Всего: {user_stats['total_users']}
+• Активных: {user_stats['active_users']}
+• Онлайн: {user_stats['online_users']}
+• Забанено: {user_stats['banned_users']}
+
+💬 **Диалоги:**
+• Всего: {stats['total_chats']}
+• Средняя продолжительность: {stats['avg_duration']} мин.
+
+🕐 **Популярное время:**
+{popular_hours_text}
+🗃 **Кэш профилей:** {cache['hits']} попаданий / {cache['misses']} промахов ({cache['hit_rate']}%), в памяти {cache['size']}
+📤 **Отправка:** в очереди {outbox_stats['queue_depth']}, задержка чата {outbox_stats['lanes']['relay']['avg_delay_ms']} мс, уведомлений {outbox_stats['lanes']['notice']['avg_delay_ms']} мс, ошибок {outbox_stats['failed']}
+    """
+
+async def get_users_page(after=0, before=None, limit=ADMIN_PAGE_SIZE):
+    """Страница пользователей для панели: keyset-пагинация по user_id, один запрос.
+
+    after - листаем вперед от этого user_id, before - назад. Возвращает
+    (строки (user_id, rating, rating_count, banned), есть_назад, есть_вперед).
+    """
+    if before is not None:
+        rows = await db.fetchall(USERS_BEFORE_SQL, (before, ADMIN_ID, limit + 1))
+        has_prev = len(rows) > limit
+        return list(reversed(rows[:limit])), has_prev, True
+    rows = await db.fetchall(USERS_AFTER_SQL, (after, ADMIN_ID, limit + 1))
+    return rows[:limit], after > 0, len(rows) > limit
 
 # --- ПОМОЩНИКИ ---
-async def find_pair(user_id):
+@timed(FIND_PAIR_SECONDS)
+async def find_pair(user_id, fallback=False):
+    """Соединить user_id с партнером или поставить в очередь.
+
+    fallback - повторный поиск по таймеру INTEREST_TIMEOUT: общие интересы
+    больше не обязательны, сообщение об ожидании не повторяем.
+    """
     if await is_banned(user_id):
         await bot.send_message(user_id, "⛔ Вы заблокированы админом.")
         return
@@ -287,76 +425,96 @@ async def find_pair(user_id):
         return
 
     # УБИРАЕМ ОГРАНИЧЕНИЕ ПО ПОЛУ - можно подключаться к любому полу
-    user_filters_data = user_filters.get(user_id, {"min_rating": 0, "min_age": 14, "max_age": 100})
-
-    print(f"🔍 Поиск пары для {user_id} ({gender}, {age} лет)")
-    print(f"📋 Очередь ожидания: {[(uid, g, a) for uid, g, a, f in waiting_users]}")
-
-    for i, (uid, ugender, uage, ufilters) in enumerate(waiting_users):
-        if uid != user_id:  # Убираем проверку на противоположный пол
-            print(f"🔎 Проверяем пользователя {uid} ({ugender}, {uage} лет)")
-            
-            partner_rating, partner_count = await get_user_rating(uid)
-            user_rating, user_count = await get_user_rating(user_id)
-            
-            if user_rating >= 4.0 and partner_rating < 3.5:
-                print(f"❌ Не подходит по рейтингу: {partner_rating} < 3.5")
-                continue
-                
-            if partner_rating < user_filters_data.get("min_rating", 0):
-                print(f"❌ Не подходит по минимальному рейтингу: {partner_rating} < {user_filters_data.get('min_rating', 0)}")
-                continue
-                
-            min_age = user_filters_data.get("min_age", 14)
-            max_age = user_filters_data.get("max_age", 100)
-            if not (min_age <= uage <= max_age):
-                print(f"❌ Не подходит по возрасту: {uage} не в диапазоне {min_age}-{max_age}")
-                continue
+    user_filters_data = await load_user_filters(user_id)
+    user_rating, _ = await get_user_rating(user_id)
+    tags = (await get_profile(user_id)).interests
+    # С интересами сначала ждем партнера с общими тегами, без них - обычные фильтры
+    plain = fallback or not tags or not INTEREST_TIMEOUT
+
+    log_match.debug("Поиск пары для %s (%s, %s лет)", user_id, gender, age, extra={"queue": len(waiting_users)})
 
-            partner_id = uid
-            waiting_users.pop(i)
-            active_chats[user_id] = partner_id
-            active_chats[partner_id] = user_id
+    # Забираем партнера и записываем пару (или встаем в очередь) одной операцией хранилища:
+    # пока мы ждали базу, нас мог соединить другой пользователь
+    async with store.locked():
+        partner, queued = store.match_or_wait(user_id, gender, age, user_filters_data, user_rating, tags, plain)
+    if partner:
+        partner_id = partner.user_id
+        TIME_TO_MATCH_SECONDS.observe(time.time() - partner.since)
+        # Пока строка chats не записана, завершение этого чата ждет замка пары
+        async with pair_locks.hold(user_id, partner_id):
             user_state[user_id] = "in_chat"
             user_state[partner_id] = "in_chat"
-            
+            chat_activity[user_id] = chat_activity[partner_id] = time.time()
             await log_chat_start(user_id, partner_id)
-            
-            rating, count = await get_user_rating(partner_id)
-            rating_text = f" (Рейтинг: {rating}⭐)" if count > 0 else ""
-            age_text = f", возраст: {uage} лет"
-            gender_text = f", пол: {'Мужской' if ugender == 'M' else 'Женский'}"
-            
-            print(f"✅ Соединили {user_id} с {partner_id}")
-            await bot.send_message(user_id, f"✅ Собеседник найден!{rating_text}{age_text}{gender_text}", reply_markup=chat_kb)
-            await bot.send_message(partner_id, f"✅ Собеседник найден!{rating_text}{age_text}{gender_text}", reply_markup=chat_kb)
-            return
+        for uid in (user_id, partner_id):
+            timers.cancel(("queue", uid))
+            timers.cancel(("interests", uid))
+        if CHAT_IDLE_TIMEOUT:
+            timers.arm(("chat", user_id), CHAT_IDLE_TIMEOUT)
+        
+        rating_text = f" (Рейтинг: {partner.rating}⭐)" if partner.rating > 0 else ""
+        age_text = f", возраст: {partner.age} лет"
+        gender_text = f", пол: {'Мужской' if partner.gender == 'M' else 'Женский'}"
+        common = partner.tags.intersection(tags)
+        tags_text = f"\n🏷 Общие интересы: {', '.join(sorted(common))}" if common else ""
+        MATCHES.inc(by="interests" if common else "fallback" if fallback else "filters")
+        
+        log_match.info("Соединили %s с %s", user_id, partner_id)
+        await bot.send_message(user_id, f"✅ Собеседник найден!{rating_text}{age_text}{gender_text}{tags_text}", reply_markup=chat_kb)
+        await bot.send_message(partner_id, f"✅ Собеседник найден!{rating_text}{age_text}{gender_text}{tags_text}", reply_markup=chat_kb)
+        return
 
-    user_data = (user_id, gender, age, user_filters_data)
-    if user_data not in waiting_users:
-        waiting_users.append(user_data)
-        print(f"➕ Добавили {user_id} в очередь ожидания. Теперь в очереди: {len(waiting_users)}")
-    
+    if not queued:
+        log_match.debug("%s уже в чате, повторный поиск пропущен", user_id)
+        return
+    if fallback:
+        return  # по-прежнему в очереди, теперь доступен и без общих интересов
+
+    log_match.debug("%s в очереди ожидания", user_id, extra={"queue": len(waiting_users)})
     user_state[user_id] = "idle"
+    if QUEUE_TIMEOUT and ("queue", user_id) not in timers:
+        timers.arm(("queue", user_id), QUEUE_TIMEOUT)
+    if not plain and ("interests", user_id) not in timers:
+        timers.arm(("interests", user_id), INTEREST_TIMEOUT)
     await bot.send_message(user_id, "⏳ Ожидание собеседника...", reply_markup=menu_kb)
 
-async def end_chat(user_id, notify=True):
-    partner_id = active_chats.get(user_id)
+async def end_chat(user_id, notify=True, reason=None):
+    """Завершить чат user_id; reason - уведомление обоим вместо обычных (чат закрыт не участником)"""
+    # Замок пары: соединение могло еще не дописать строку chats. Если пока
+    # ждали замок, партнер сменился, берем замки заново под нового
+    while True:
+        expected = active_chats.get(user_id)
+        async with pair_locks.hold(user_id, expected):
+            if active_chats.get(user_id) != expected:
+                continue
+            async with store.locked():
+                partner_id = store.unpair(user_id)
+            if partner_id:
+                await log_chat_end(user_id, partner_id)
+
+                user_state[user_id] = "rating"
+                user_state[partner_id] = "rating"
+
+                awaiting_rating[user_id] = partner_id
+                awaiting_rating[partner_id] = user_id
+                rating_since[user_id] = rating_since[partner_id] = time.time()
+                chat_activity.pop(user_id, None)
+                chat_activity.pop(partner_id, None)
+        break
+
     if partner_id:
-        await log_chat_end(user_id, partner_id)
-        
-        del active_chats[user_id]
-        del active_chats[partner_id]
-        user_state[user_id] = "rating"
-        user_state[partner_id] = "rating"
-        
-        awaiting_rating[user_id] = partner_id
-        awaiting_rating[partner_id] = user_id
-        
+        for uid in (user_id, partner_id):
+            timers.cancel(("chat", uid))
+            if RATING_TIMEOUT:
+                timers.arm(("rating", uid), RATING_TIMEOUT)
+        if reason:
+            await bot.send_message(partner_id, f"{reason} Оцените диалог:", reply_markup=rating_kb)
+            await bot.send_message(user_id, f"{reason} Оцените диалог:", reply_markup=rating_kb)
+            return
         if notify:
             await bot.send_message(partner_id, "❌ Собеседник покинул чат. Оцените диалог:", reply_markup=rating_kb)
         await bot.send_message(user_id, "❌ Чат завершен. Оцените диалог:", reply_markup=rating_kb)
-    else:
+    elif not reason:
         await bot.send_message(user_id, "❌ Чат завершен.", reply_markup=menu_kb)
 
 # --- КОМАНДЫ ---
@@ -383,29 +541,131 @@ async def cmd_stats(msg: types.Message):
         return
     
     stats = await get_admin_stats()
-    user_stats = stats["user_stats"]
+    await msg.answer(format_admin_stats(stats))
+
+@dp.message(Command("rebuild_stats"))
+async def cmd_rebuild_stats(msg: types.Message):
+    """Пересчитать счетчики статистики из таблиц users и chats"""
+    uid = msg.from_user.id
+    if uid != ADMIN_ID:
+        await msg.answer("⛔ Нет доступа")
+        return
     
-    popular_hours_text = ""
-    for hour, count in stats["popular_hours"]:
-        popular_hours_text += f"{hour}:00 - {count} чатов\n"
+    started = time.perf_counter()
+    await rebuild_stats(db)
+    log_admin.info("Админ %s: пересчет статистики", uid)
+    await msg.answer(f"✅ Статистика пересчитана за {time.perf_counter() - started:.1f} с")
+
+@dp.message(Command("broadcast"))
+async def cmd_broadcast(msg: types.Message, command: CommandObject):
+    """Рассылка текста всем незабаненным пользователям: /broadcast текст"""
+    uid = msg.from_user.id
+    if uid != ADMIN_ID:
+        await msg.answer("⛔ Нет доступа")
+        return
     
-    text = f"""
-📊 **Статистика бота:**
+    text = (command.args or "").strip()
+    if not text:
+        await msg.answer("Использование: /broadcast текст сообщения")
+        return
+    if broadcasts.active():
+        await msg.answer("⏳ Рассылка уже идет, дождитесь ее окончания или остановите.")
+        return
+    
+    user_stats = await get_user_stats()
+    broadcast = await broadcasts.create(uid, text, user_stats["active_users"])
+    log_admin.info("Админ %s: рассылка %s на ~%s пользователей", uid, broadcast.id, broadcast.total)
 
-👥 **Пользователи:**
-• Всего: {user_stats['total_users']}
-• Активных: {user_stats['active_users']}
-• Онлайн: {user_stats['online_users']}
-• Забанено: {user_stats['banned_users']}
+export_task = None  # идущая выгрузка /export
 
-💬 **Диалоги:**
-• Всего: {stats['total_chats']}
-• Средняя продолжительность: {stats['avg_duration']} мин.
+@dp.message(Command("export"))
+async def cmd_export(msg: types.Message, command: CommandObject):
+    """Выгрузка chats, ratings и admin_actions с прошлой выгрузки: /export [ndjson|csv]"""
+    global export_task
+    uid = msg.from_user.id
+    if uid != ADMIN_ID:
+        await msg.answer("⛔ Нет доступа")
+        return
+    
+    fmt = (command.args or "ndjson").strip().lower()
+    if fmt not in EXPORT_FORMATS:
+        await msg.answer(f"Использование: /export [{'|'.join(EXPORT_FORMATS)}]")
+        return
+    if export_task is not None and not export_task.done():
+        await msg.answer("⏳ Выгрузка уже идет.")
+        return
+    
+    await msg.answer("⏳ Выгрузка началась, пришлю отчет, когда закончится.")
+    log_admin.info("Админ %s: выгрузка %s", uid, fmt)
+    # Отдельной задачей: ящик админа не занят, пока идет выгрузка
+    export_task = asyncio.create_task(run_export(uid, fmt))
 
-🕐 **Популярное время:**
-{popular_hours_text}
-    """
-    await msg.answer(text)
+async def run_export(uid, fmt):
+    try:
+        reports = await export_in_process(DB_PATH, EXPORT_DIR, fmt, EXPORT_CHUNK)
+    except Exception as e:
+        log_admin.exception("Выгрузка не удалась")
+        await bot.send_message(uid, f"❌ Выгрузка не удалась: {e}")
+        return
+    await bot.send_message(uid, "📦 Выгрузка готова:\n" + format_export_report(reports))
+
+perf_task = None  # идущий профиль /perf profile|sample
+PROFILERS = {"profile": cprofile, "sample": sample}  # cProfile точнее, выборка стеков почти не замедляет бота
+
+@dp.message(Command("perf"))
+async def cmd_perf(msg: types.Message, command: CommandObject):
+    """p50/p99 обработчиков и подсистем: /perf; профиль файлом: /perf profile|sample [сек]"""
+    global perf_task
+    uid = msg.from_user.id
+    if uid != ADMIN_ID:
+        await msg.answer("⛔ Нет доступа")
+        return
+    
+    args = (command.args or "").split()
+    if not args:
+        await msg.answer(format_perf())
+        return
+    if args[0] not in PROFILERS or len(args) > 2 or (len(args) == 2 and not args[1].isdigit()):
+        await msg.answer(f"Использование: /perf или /perf [{'|'.join(PROFILERS)}] [секунд, до {PERF_PROFILE_MAX}]")
+        return
+    if perf_task is not None and not perf_task.done():
+        await msg.answer("⏳ Профиль уже снимается.")
+        return
+    
+    seconds = max(1, min(int(args[1]) if len(args) == 2 else PERF_PROFILE_SECONDS, PERF_PROFILE_MAX))
+    await msg.answer(f"⏳ Снимаю профиль ({args[0]}) {seconds} с, пришлю файлом.")
+    log_admin.info("Админ %s: профиль %s на %s с", uid, args[0], seconds)
+    # Отдельной задачей: обработчики админа не ждут конца профиля и сами в него попадают
+    perf_task = asyncio.create_task(run_profile(uid, args[0], seconds))
+
+async def run_profile(uid, mode, seconds):
+    try:
+        report = await PROFILERS[mode](seconds)
+    except Exception as e:
+        log_admin.exception("Профиль не снят")
+        await bot.send_message(uid, f"❌ Профиль не снят: {e}")
+        return
+    name = f"perf_{mode}_{datetime.now():%Y%m%d_%H%M%S}.txt"
+    await bot.send_document(uid, BufferedInputFile(report.encode(), name), caption=f"📈 Профиль {mode}, {seconds} с")
+
+def format_perf():
+    """Отчет /perf: последние замеры по обработчикам и подсистемам, медленные сверху"""
+    lines = ["⏱ Производительность, мс (по последним вызовам):"]
+    for title, histogram in (
+        ("🧩 Обработчики:", HANDLER_SECONDS),
+        ("🧭 Состояния и кнопки меню:", ACTION_SECONDS),
+        ("🔎 find_pair:", FIND_PAIR_SECONDS),
+        ("💬 Пересылка в чате:", RELAY_SECONDS),
+        ("🗄 SQLite:", DB_QUERY_SECONDS),
+        ("📤 Telegram API:", TELEGRAM_SECONDS),
+        ("🔁 Задержка цикла событий:", LOOP_LAG_SECONDS),
+    ):
+        section = format_histogram(title, histogram)
+        if section:
+            lines += [""] + section
+    lines += ["", f"📬 В очереди отправки: {outbox.depth()}, пользователей с апдейтами в обработке: {len(mailboxes)}"]
+    lines += [f"🐢 Блокировок цикла дольше {PERF_SLOW_CALLBACK * 1e3:.0f} мс: {LOOP_STALLS.value()}"] + format_stalls(loop_monitor)
+    return "\n".join(lines)
 
 # --- ГЛАВНЫЙ ОБРАБОТЧИК ДЛЯ ВСЕХ СООБЩЕНИЙ ---
 @dp.message()
@@ -414,7 +674,7 @@ async def handle_all_messages(msg: types.Message):
     
     # Если пользователь в чате - обрабатываем все типы сообщений
     if user_state.get(uid) == "in_chat":
-        await handle_chat_message(msg)
+        await handle_chat_message(msg)  # время пересылки - в RELAY_SECONDS
         return
     
     # Для всех остальных состояний - только текстовые сообщения
@@ -444,268 +704,390 @@ async def handle_chat_message(msg: types.Message):
             await end_chat(uid)
             return
     
-    # Пересылка сообщений партнеру
-    try:
-        if msg.text:
-            # Текстовое сообщение
-            await bot.send_message(partner_id, msg.text)
-            print(f"💬 Текст отправлен от {uid} к {partner_id}: {msg.text}")
-            
-        elif msg.photo:
-            # Фото
-            await bot.send_photo(partner_id, msg.photo[-1].file_id, caption=msg.caption)
-            print(f"📷 Фото отправлено от {uid} к {partner_id}")
-            
-        elif msg.video:
-            # Видео
-            await bot.send_video(partner_id, msg.video.file_id, caption=msg.caption)
-            print(f"🎥 Видео отправлено от {uid} к {partner_id}")
-            
-        elif msg.sticker:
-            # Стикер
-            await bot.send_sticker(partner_id, msg.sticker.file_id)
-            print(f"😊 Стикер отправлен от {uid} к {partner_id}")
-            
-        elif msg.voice:
-            # Голосовое сообщение
-            await bot.send_voice(partner_id, msg.voice.file_id)
-            print(f"🎤 Голосовое отправлено от {uid} к {partner_id}")
-            
-        elif msg.document:
-            # Документ
-            await bot.send_document(partner_id, msg.document.file_id, caption=msg.caption)
-            print(f"📄 Документ отправлен от {uid} к {partner_id}")
-            
-        elif msg.audio:
-            # Аудио
-            await bot.send_audio(partner_id, msg.audio.file_id, caption=msg.caption)
-            print(f"🎵 Аудио отправлено от {uid} к {partner_id}")
-            
-    except Exception as e:
-        print(f"❌ Ошибка отправки сообщения от {uid} к {partner_id}: {e}")
-        await msg.answer("❌ Не удалось отправить сообщение.")
+    chat_activity[uid] = time.time()
+
+    # Пересылка сообщений партнеру (полоса RELAY обгоняет системные сообщения)
+    with lane(RELAY), RELAY_SECONDS.time():
+        if msg.media_group_id:
+            # Альбом собираем и отправляем одним send_media_group
+            albums.add(msg, partner_id)
+            return
+        try:
+            # copy_message переносит любой тип сообщения вместе с подписью и разметкой
+            await bot.copy_message(partner_id, msg.chat.id, msg.message_id)
+            log_relay.debug("Сообщение %s отправлено от %s к %s", msg.content_type.value, uid, partner_id)
+        except Exception as e:
+            log_relay.warning("Ошибка отправки сообщения от %s к %s: %s", uid, partner_id, e)
+            await msg.answer("❌ Не удалось отправить сообщение.")
+
+async def send_album(uid, partner_id, messages):
+    """Отправить собранный альбом собеседнику"""
+    if active_chats.get(uid) != partner_id:
+        return  # чат закончился, пока собирали альбом
+    media = [m for m in map(to_input_media, messages) if m is not None]
+    with lane(RELAY):
+        try:
+            if len(media) > 1:
+                await bot.send_media_group(partner_id, media)
+            else:
+                for m in messages:
+                    await bot.copy_message(partner_id, m.chat.id, m.message_id)
+            log_relay.debug("Альбом из %d отправлен от %s к %s", len(messages), uid, partner_id)
+        except Exception as e:
+            log_relay.warning("Ошибка отправки альбома от %s к %s: %s", uid, partner_id, e)
+            await bot.send_message(uid, "❌ Не удалось отправить сообщение.")
 
 async def handle_text_message(msg: types.Message):
-    """Обработка текстовых сообщений для меню и настроек"""
+    """Обработка текстовых сообщений для меню и настроек: обработчик выбирается по состоянию"""
     uid = msg.from_user.id
-    text = msg.text.strip()
+    handler = STATE_HANDLERS.get(user_state.get(uid))
+    if handler is None:
+        await handle_menu(msg, uid, msg.text.strip())  # кнопки меню меряет сам handle_menu
+        return
+    # Весь апдейт меряет TimingMiddleware; здесь - разбивка по состояниям в отдельной гистограмме
+    with ACTION_SECONDS.time(action=handler.__name__):
+        await handler(msg, uid, msg.text.strip())
 
-    # Выбор пола
-    if user_state.get(uid) == "choosing_gender":
-        if text not in ["Мужской", "Женский"]:
-            await msg.answer("Выберите пол кнопкой.")
-            return
-        gender = "M" if text == "Мужской" else "F"
-        user_gender[uid] = gender
-        user_state[uid] = "choosing_age"
-        await msg.answer(f"✅ Пол: {text}\n\nВведите возраст (14-100 лет):")
+# --- МАРШРУТИЗАЦИЯ ПО СОСТОЯНИЯМ ---
+# Новое состояние - функция с @on_state, новая кнопка - функция с @on_button
+STATE_HANDLERS = {}  # состояние -> async handler(msg, uid, text); остальное идет в handle_menu
+MENU_BUTTONS = {}  # текст кнопки menu_kb -> async action(msg, uid)
+FILTER_BUTTONS = {}  # текст кнопки filters_kb -> async action(msg, uid)
+RATING_BUTTONS = {f"{'⭐' * n} {n}": n for n in range(1, 6)}  # текст кнопки rating_kb -> оценка
+
+def on_state(*states):
+    def register(handler):
+        for state in states:
+            STATE_HANDLERS[state] = handler
+        return handler
+    return register
+
+def on_button(buttons, text):
+    def register(action):
+        buttons[text] = action
+        return action
+    return register
+
+# Выбор пола
+@on_state("choosing_gender")
+async def state_choosing_gender(msg, uid, text):
+    if text not in ["Мужской", "Женский"]:
+        await msg.answer("Выберите пол кнопкой.")
         return
+    gender = "M" if text == "Мужской" else "F"
+    user_gender[uid] = gender
+    user_state[uid] = "choosing_age"
+    await msg.answer(f"✅ Пол: {text}\n\nВведите возраст (14-100 лет):")
 
-    # Ввод возраста
-    if user_state.get(uid) == "choosing_age":
-        try:
-            age = int(text)
-            if 14 <= age <= 100:
-                user_age[uid] = age
-                await save_user_data(uid, user_gender[uid], age)
-                user_state[uid] = "idle"
-                user_filters[uid] = {"min_rating": 0, "min_age": 14, "max_age": 100}
-                await save_user_filters(uid, user_filters[uid])
-                await msg.answer(
-                    f"✅ Регистрация завершена!\n"
-                    f"Пол: {'Мужской' if user_gender[uid] == 'M' else 'Женский'}\n"
-                    f"Возраст: {age} лет\n\n"
-                    f"Теперь вы можете найти собеседника!", 
-                    reply_markup=menu_kb
-                )
-            else:
-                await msg.answer("❌ Возраст должен быть от 14 до 100 лет.")
-        except ValueError:
-            await msg.answer("❌ Введите число от 14 до 100:")
+# Ввод возраста
+@on_state("choosing_age")
+async def state_choosing_age(msg, uid, text):
+    try:
+        age = int(text)
+    except ValueError:
+        await msg.answer("❌ Введите число от 14 до 100:")
+        return
+    if not 14 <= age <= 100:
+        await msg.answer("❌ Возраст должен быть от 14 до 100 лет.")
         return
+    user_age[uid] = age
+    await save_user_data(uid, user_gender[uid], age)
+    user_state[uid] = "idle"
+    user_filters[uid] = {"min_rating": 0, "min_age": 14, "max_age": 100}
+    await save_user_filters(uid, user_filters[uid])
+    await msg.answer(
+        f"✅ Регистрация завершена!\n"
+        f"Пол: {'Мужской' if user_gender[uid] == 'M' else 'Женский'}\n"
+        f"Возраст: {age} лет\n\n"
+        f"Теперь вы можете найти собеседника!", 
+        reply_markup=menu_kb
+    )
 
-    # Оценка собеседника
-    if user_state.get(uid) == "rating":
-        partner_id = awaiting_rating.get(uid)
-        if text in ["⭐ 1", "⭐⭐ 2", "⭐⭐⭐ 3", "⭐⭐⭐⭐ 4", "⭐⭐⭐⭐⭐ 5"]:
-            rating = len(text.split("⭐")[0])
-            if partner_id:
-                await update_rating(partner_id, rating)
-                await msg.answer(f"✅ Вы поставили оценку {rating}⭐", reply_markup=menu_kb)
-            else:
-                await msg.answer("❌ Не удалось найти собеседника", reply_markup=menu_kb)
-        elif text != "🚫 Пропустить":
-            await msg.answer("Спасибо за диалог!", reply_markup=menu_kb)
+# Оценка собеседника
+@on_state("rating")
+async def state_rating(msg, uid, text):
+    partner_id = awaiting_rating.get(uid)
+    rating = RATING_BUTTONS.get(text)
+    if rating:
+        if partner_id:
+            await update_rating(partner_id, rating, from_user=uid)
+            await msg.answer(f"✅ Вы поставили оценку {rating}⭐", reply_markup=menu_kb)
         else:
-            await msg.answer("Диалог завершен", reply_markup=menu_kb)
-        
-        user_state[uid] = "idle"
-        if uid in awaiting_rating:
-            del awaiting_rating[uid]
-        return
-
-    # Настройка фильтров
-    if user_state.get(uid) == "setting_filters":
-        if text == "📊 Минимальный рейтинг":
-            await msg.answer("Введите минимальный рейтинг (0-5):")
-            user_state[uid] = "setting_min_rating"
-        elif text == "🎂 Возрастной диапазон":
-            await msg.answer("Введите возрастной диапазон в формате 'мин-макс' (например: 14-25):")
-            user_state[uid] = "setting_age_range"
-        elif text == "❌ Сбросить фильтры":
-            user_filters[uid] = {"min_rating": 0, "min_age": 14, "max_age": 100}
-            await save_user_filters(uid, user_filters[uid])
-            await msg.answer("✅ Фильтры сброшены", reply_markup=menu_kb)
-            user_state[uid] = "idle"
-        elif text == "📋 Текущие настройки":
-            filters = user_filters.get(uid, {"min_rating": 0, "min_age": 14, "max_age": 100})
-            await msg.answer(
-                f"📋 Ваши фильтры:\n"
-                f"⭐ Минимальный рейтинг: {filters.get('min_rating', 0)}\n"
-                f"🎂 Возраст: {filters.get('min_age', 14)}-{filters.get('max_age', 100)} лет",
-                reply_markup=filters_kb
-            )
-        elif text == "🔙 Назад":
-            user_state[uid] = "idle"
-            await msg.answer("Главное меню", reply_markup=menu_kb)
+            await msg.answer("❌ Не удалось найти собеседника", reply_markup=menu_kb)
+    elif text != "🚫 Пропустить":
+        await msg.answer("Спасибо за диалог!", reply_markup=menu_kb)
+    else:
+        await msg.answer("Диалог завершен", reply_markup=menu_kb)
+    
+    user_state[uid] = "idle"
+    if uid in awaiting_rating:
+        del awaiting_rating[uid]
+    rating_since.pop(uid, None)
+    timers.cancel(("rating", uid))
+
+# Настройка фильтров
+@on_state("setting_filters")
+async def state_setting_filters(msg, uid, text):
+    action = FILTER_BUTTONS.get(text)
+    if action:
+        await action(msg, uid)
+
+@on_button(FILTER_BUTTONS, "📊 Минимальный рейтинг")
+async def filter_min_rating(msg, uid):
+    await msg.answer("Введите минимальный рейтинг (0-5):")
+    user_state[uid] = "setting_min_rating"
+
+@on_button(FILTER_BUTTONS, "🎂 Возрастной диапазон")
+async def filter_age_range(msg, uid):
+    await msg.answer("Введите возрастной диапазон в формате 'мин-макс' (например: 14-25):")
+    user_state[uid] = "setting_age_range"
+
+@on_button(FILTER_BUTTONS, "❌ Сбросить фильтры")
+async def filter_reset(msg, uid):
+    user_filters[uid] = {"min_rating": 0, "min_age": 14, "max_age": 100}
+    await save_user_filters(uid, user_filters[uid])
+    await msg.answer("✅ Фильтры сброшены", reply_markup=menu_kb)
+    user_state[uid] = "idle"
+
+@on_button(FILTER_BUTTONS, "📋 Текущие настройки")
+async def filter_show(msg, uid):
+    filters = await load_user_filters(uid)
+    interests = (await get_profile(uid)).interests
+    await msg.answer(
+        f"📋 Ваши фильтры:\n"
+        f"⭐ Минимальный рейтинг: {filters.get('min_rating', 0)}\n"
+        f"🎂 Возраст: {filters.get('min_age', 14)}-{filters.get('max_age', 100)} лет\n"
+        f"🏷 Интересы: {', '.join(interests) if interests else 'не заданы'}",
+        reply_markup=filters_kb
+    )
+
+@on_button(FILTER_BUTTONS, "🏷 Интересы")
+async def filter_interests(msg, uid):
+    await msg.answer(f"Введите до {MAX_TAGS} интересов через запятую (например: музыка, игры, кино). "
+                     f"Отправьте «-», чтобы очистить:")
+    user_state[uid] = "setting_interests"
+
+@on_button(FILTER_BUTTONS, "🔙 Назад")
+async def filter_back(msg, uid):
+    user_state[uid] = "idle"
+    await msg.answer("Главное меню", reply_markup=menu_kb)
+
+# Установка минимального рейтинга
+@on_state("setting_min_rating")
+async def state_setting_min_rating(msg, uid, text):
+    try:
+        min_rating = float(text)
+    except ValueError:
+        await msg.answer("❌ Введите корректное число")
         return
+    if not 0 <= min_rating <= 5:
+        await msg.answer("❌ Введите число от 0 до 5")
+        return
+    filters = dict(await load_user_filters(uid))
+    filters["min_rating"] = min_rating
+    user_filters[uid] = filters
+    await save_user_filters(uid, filters)
+    await msg.answer(f"✅ Минимальный рейтинг установлен: {min_rating}", reply_markup=filters_kb)
+    user_state[uid] = "setting_filters"
 
-    # Установка минимального рейтинга
-    if user_state.get(uid) == "setting_min_rating":
-        try:
-            min_rating = float(text)
-            if 0 <= min_rating <= 5:
-                if uid not in user_filters:
-                    user_filters[uid] = {}
-                user_filters[uid]["min_rating"] = min_rating
-                await save_user_filters(uid, user_filters[uid])
-                await msg.answer(f"✅ Минимальный рейтинг установлен: {min_rating}", reply_markup=filters_kb)
-                user_state[uid] = "setting_filters"
-            else:
-                await msg.answer("❌ Введите число от 0 до 5")
-        except:
-            await msg.answer("❌ Введите корректное число")
+# Установка возрастного диапазона
+@on_state("setting_age_range")
+async def state_setting_age_range(msg, uid, text):
+    try:
+        min_age, max_age = map(int, text.split('-'))
+    except ValueError:
+        await msg.answer("❌ Введите в формате 'мин-макс' (например: 14-25)")
+        return
+    if not 14 <= min_age <= max_age <= 100:
+        await msg.answer("❌ Введите диапазон от 14 до 100 лет (мин-макс)")
+        return
+    filters = dict(await load_user_filters(uid))
+    filters["min_age"] = min_age
+    filters["max_age"] = max_age
+    user_filters[uid] = filters
+    await save_user_filters(uid, filters)
+    await msg.answer(f"✅ Возрастной диапазон установлен: {min_age}-{max_age} лет", reply_markup=filters_kb)
+    user_state[uid] = "setting_filters"
 
-    # Установка возрастного диапазона
-    if user_state.get(uid) == "setting_age_range":
-        try:
-            min_age, max_age = map(int, text.split('-'))
-            if 14 <= min_age <= max_age <= 100:
-                if uid not in user_filters:
-                    user_filters[uid] = {}
-                user_filters[uid]["min_age"] = min_age
-                user_filters[uid]["max_age"] = max_age
-                await save_user_filters(uid, user_filters[uid])
-                await msg.answer(f"✅ Возрастной диапазон установлен: {min_age}-{max_age} лет", reply_markup=filters_kb)
-                user_state[uid] = "setting_filters"
-            else:
-                await msg.answer("❌ Введите диапазон от 14 до 100 лет (мин-макс)")
-        except:
-            await msg.answer("❌ Введите в формате 'мин-макс' (например: 14-25)")
+# Установка интересов
+@on_state("setting_interests")
+async def state_setting_interests(msg, uid, text):
+    tags = () if text == "-" else parse_tags(text)
+    if not tags and text != "-":
+        await msg.answer("❌ Введите интересы через запятую или «-», чтобы очистить")
+        return
+    await save_user_interests(uid, tags)
+    if tags:
+        await msg.answer(f"✅ Интересы: {', '.join(tags)}. Сначала будем искать собеседника с общими интересами.", reply_markup=filters_kb)
+    else:
+        await msg.answer("✅ Интересы очищены", reply_markup=filters_kb)
+    user_state[uid] = "setting_filters"
 
-    # Панель админа - ВВОД ПАРОЛЯ
-    if user_state.get(uid) == "admin_pass":
-        if text == ADMIN_PASS:
-            user_state[uid] = "idle"
-            
-            # Получаем список пользователей
-            async with aiosqlite.connect(DB_PATH) as db:
-                cur = await db.execute("SELECT user_id FROM users WHERE user_id != ?", (ADMIN_ID,))
-                users = await cur.fetchall()
-            
-            # Создаем кнопки
-            buttons = []
-            for user in users:
-                user_id = user[0]
-                rating, count = await get_user_rating(user_id)
-                rating_text = f" ({rating}⭐)" if count > 0 else ""
-                
-                buttons.append([
-                    InlineKeyboardButton(text=f"⛔ Ban {user_id}", callback_data=f"ban_{user_id}"),
-                    InlineKeyboardButton(text=f"✅ Unban {user_id}", callback_data=f"unban_{user_id}")
-                ])
-                buttons.append([
-                    InlineKeyboardButton(text=f"❌ EndChat {user_id}", callback_data=f"end_chat_{user_id}")
-                ])
-            
-            # Добавляем кнопку статистики
-            buttons.append([InlineKeyboardButton(text="📊 Статистика", callback_data="admin_stats")])
-            
-            kb = InlineKeyboardMarkup(inline_keyboard=buttons)
-            await msg.answer("✅ Панель администратора:", reply_markup=kb)
-        else:
-            await msg.answer("❌ Неверный пароль")
+# Панель админа - ПОИСК ПОЛЬЗОВАТЕЛЯ
+@on_state("admin_search")
+async def state_admin_search(msg, uid, text):
+    if uid != ADMIN_ID:
+        await handle_menu(msg, uid, text)
+        return
+    user_state[uid] = "idle"
+    if not text.isdigit():
+        await msg.answer("❌ Введите user_id числом")
+        return
+    target_id = int(text)
+    rows, has_prev, has_next = await get_users_page(after=target_id - 1)
+    if not rows or rows[0][0] != target_id:
+        await msg.answer(f"❌ Пользователь {target_id} не найден")
         return
+    page, kb = admin_page(rows, True, has_next)
+    await msg.answer(page, reply_markup=kb)
 
+# Панель админа - ВВОД ПАРОЛЯ
+@on_state("admin_pass")
+async def state_admin_pass(msg, uid, text):
+    if text == ADMIN_PASS:
+        user_state[uid] = "idle"
+        
+        page, kb = admin_page(*await get_users_page())
+        await msg.answer(page, reply_markup=kb)
+    else:
+        await msg.answer("❌ Неверный пароль")
+
+# Основное меню (idle и любое состояние без своего обработчика)
+async def handle_menu(msg, uid, text):
     # Проверка бана
     if await is_banned(uid):
         await msg.answer("⛔ Вы заблокированы админом.")
         return
-
-    # Основное меню
-    if text == "🔎 Найти собеседника":
-        await find_pair(uid)
-    elif text == "⚙️ Фильтры":
-        user_state[uid] = "setting_filters"
-        await msg.answer("Настройте фильтры поиска:", reply_markup=filters_kb)
-    elif text == "📊 Моя статистика":
-        rating, count = await get_user_rating(uid)
-        age = user_age.get(uid, "не указан")
-        gender = user_gender.get(uid, "не указан")
-        gender_text = "Мужской" if gender == "M" else "Женский" if gender == "F" else "не указан"
-        await msg.answer(f"📊 Ваша статистика:\nРейтинг: {rating}⭐ из {count} оценок\nВозраст: {age} лет\nПол: {gender_text}")
-    elif text == "⛔ Выйти из поиска":
-        waiting_users[:] = [x for x in waiting_users if x[0] != uid]
-        user_state[uid] = "idle"
-        await msg.answer("✅ Вы вышли из поиска.", reply_markup=menu_kb)
-    elif text == "🛠 Панель":
-        if uid == ADMIN_ID:
-            user_state[uid] = "admin_pass"
-            await msg.answer("Введите пароль для панели администратора:")
-        else:
-            await msg.answer("⛔ У вас нет доступа к панели администратора.")
+    action = MENU_BUTTONS.get(text)
+    if action:
+        with ACTION_SECONDS.time(action=action.__name__):
+            await action(msg, uid)
     else:
         await msg.answer("Неизвестная команда. Используйте кнопки.")
 
+@on_button(MENU_BUTTONS, "🔎 Найти собеседника")
+async def menu_find(msg, uid):
+    await find_pair(uid)
+
+@on_button(MENU_BUTTONS, "⚙️ Фильтры")
+async def menu_filters(msg, uid):
+    user_state[uid] = "setting_filters"
+    await msg.answer("Настройте фильтры поиска:", reply_markup=filters_kb)
+
+@on_button(MENU_BUTTONS, "📊 Моя статистика")
+async def menu_stats(msg, uid):
+    rating, count = await get_user_rating(uid)
+    age = user_age.get(uid, "не указан")
+    gender = user_gender.get(uid, "не указан")
+    gender_text = "Мужской" if gender == "M" else "Женский" if gender == "F" else "не указан"
+    await msg.answer(f"📊 Ваша статистика:\nРейтинг: {rating}⭐ из {count} оценок\nВозраст: {age} лет\nПол: {gender_text}")
+
+@on_button(MENU_BUTTONS, "⛔ Выйти из поиска")
+async def menu_leave_search(msg, uid):
+    if uid in active_chats:
+        return  # пока проверяли бан, нас уже соединили
+    async with store.locked():
+        waiting_users.remove(uid)
+    timers.cancel(("queue", uid))
+    timers.cancel(("interests", uid))
+    user_state[uid] = "idle"
+    await msg.answer("✅ Вы вышли из поиска.", reply_markup=menu_kb)
+
+@on_button(MENU_BUTTONS, "🛠 Панель")
+async def menu_admin_panel(msg, uid):
+    if uid == ADMIN_ID:
+        user_state[uid] = "admin_pass"
+        await msg.answer("Введите пароль для панели администратора:")
+    else:
+        await msg.answer("⛔ У вас нет доступа к панели администратора.")
+
 # --- ПАНЕЛЬ АДМИНА ---
+def admin_page(rows, has_prev, has_next):
+    """Текст и кнопки одной страницы списка пользователей"""
+    lines = ["✅ Панель администратора:"]
+    buttons = []
+    for user_id, rating, count, banned in rows:
+        line = f"{user_id} — {round(rating, 1)}⭐ ({count})" if count else f"{user_id} — без оценок"
+        if banned:
+            line += " ⛔"
+        if user_id in active_chats:
+            line += " 💬"
+        lines.append(line)
+        if banned:
+            ban_button = InlineKeyboardButton(text=f"✅ Unban {user_id}", callback_data=f"unban_{user_id}")
+        else:
+            ban_button = InlineKeyboardButton(text=f"⛔ Ban {user_id}", callback_data=f"ban_{user_id}")
+        buttons.append([
+            ban_button,
+            InlineKeyboardButton(text=f"❌ EndChat {user_id}", callback_data=f"end_chat_{user_id}")
+        ])
+    if not rows:
+        lines.append("Пользователей нет")
+
+    nav = []
+    if has_prev and rows:
+        nav.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"admin_prev_{rows[0][0]}"))
+    if has_next and rows:
+        nav.append(InlineKeyboardButton(text="Вперед ➡️", callback_data=f"admin_next_{rows[-1][0]}"))
+    if nav:
+        buttons.append(nav)
+    buttons.append([
+        InlineKeyboardButton(text="🔍 Найти", callback_data="admin_search"),
+        InlineKeyboardButton(text="📊 Статистика", callback_data="admin_stats")
+    ])
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=buttons)
+
 @dp.callback_query()
 async def admin_callback(callback: types.CallbackQuery):
     admin_id = callback.from_user.id
     data = callback.data
+
+    if admin_id != ADMIN_ID:
+        await callback.answer("⛔ Нет доступа")
+        return
     
     if data == "admin_stats":
         stats = await get_admin_stats()
-        user_stats = stats["user_stats"]
-        
-        popular_hours_text = ""
-        for hour, count in stats["popular_hours"]:
-            popular_hours_text += f"{hour}:00 - {count} чатов\n"
-        
-        text = f"""
-📊 **Статистика бота:**
+        text = format_admin_stats(stats)
+        await callback.message.answer(text)
+        return
 
-👥 **Пользователи:**
-• Всего: {user_stats['total_users']}
-• Активных: {user_stats['active_users']}
-• Онлайн: {user_stats['online_users']}
-• Забанено: {user_stats['banned_users']}
+    if data == "admin_search":
+        user_state[admin_id] = "admin_search"
+        await callback.message.answer("Введите user_id:")
+        await callback.answer()
+        return
 
-💬 **Диалоги:**
-• Всего: {stats['total_chats']}
-• Средняя продолжительность: {stats['avg_duration']} мин.
+    if data.startswith(("admin_next_", "admin_prev_")):
+        cursor = int(data.rsplit("_", 1)[1])
+        if data.startswith("admin_next_"):
+            rows, has_prev, has_next = await get_users_page(after=cursor)
+        else:
+            rows, has_prev, has_next = await get_users_page(before=cursor)
+        if not rows:
+            await callback.answer("Больше пользователей нет")
+            return
+        text, kb = admin_page(rows, has_prev, has_next)
+        await callback.message.edit_text(text, reply_markup=kb)
+        await callback.answer()
+        return
 
-🕐 **Популярное время:**
-{popular_hours_text}
-        """
-        await callback.message.answer(text)
+    if data.startswith("broadcast_stop_"):
+        broadcast_id = int(data.rsplit("_", 1)[1])
+        stopped = broadcasts.cancel(broadcast_id)
+        if stopped:
+            log_admin.info("Админ %s: остановка рассылки %s", admin_id, broadcast_id)
+        await callback.answer("⏹ Рассылка остановится после текущих отправок" if stopped else "Рассылка уже завершена")
         return
 
     if data.startswith(("ban_", "unban_", "end_chat_")):
-        action, target_id = data.split("_", 1)
+        action, target_id = data.rsplit("_", 1)
         target_id = int(target_id)
 
         if action == "ban":
             await ban_user(target_id)
+            async with store.locked():
+                waiting_users.remove(target_id)
             await end_chat(target_id)
             await callback.message.answer(f"⛔ Пользователь {target_id} заблокирован.")
         elif action == "unban":
@@ -715,8 +1097,142 @@ async def admin_callback(callback: types.CallbackQuery):
             await end_chat(target_id)
             await callback.message.answer(f"✅ Чат пользователя {target_id} завершён.")
         
+        writer.submit(ADMIN_ACTION_SQL, (admin_id, target_id, action))
+        log_admin.info("Админ %s: %s %s", admin_id, action, target_id)
         await callback.answer()
 
+# --- РАССЫЛКА ---
+async def send_broadcast(uid, text):
+    with lane(BULK):  # пересылка в чатах и уведомления идут вперед рассылки
+        await bot.send_message(uid, text)
+
+def format_broadcast(broadcast):
+    titles = {BROADCAST_RUNNING: "📣 Рассылка идет", "done": "✅ Рассылка завершена", "cancelled": "⏹ Рассылка остановлена"}
+    percent = min(100, broadcast.done * 100 // broadcast.total) if broadcast.total else 100
+    lines = [
+        f"{titles.get(broadcast.status, broadcast.status)} (#{broadcast.id})",
+        f"• Отправлено: {broadcast.sent}, ошибок: {broadcast.failed} из ~{broadcast.total} ({percent}%)",
+        f"• Скорость: {broadcast.rate():.1f} сообщ./с",
+    ]
+    eta = broadcast.eta()
+    if broadcast.status == BROADCAST_RUNNING and eta is not None:
+        lines.append(f"• Осталось: ~{int(eta // 60)} мин {int(eta % 60)} с")
+    return "\n".join(lines)
+
+async def report_broadcast(broadcast):
+    """Прогресс рассылки у админа: одно сообщение, которое редактируется по ходу"""
+    text = format_broadcast(broadcast)
+    kb = None
+    if broadcast.status == BROADCAST_RUNNING:
+        kb = InlineKeyboardMarkup(inline_keyboard=[[
+            InlineKeyboardButton(text="⏹ Остановить", callback_data=f"broadcast_stop_{broadcast.id}")
+        ]])
+    if broadcast.message_id is not None:
+        try:
+            await bot.edit_message_text(text, chat_id=broadcast.admin_id, message_id=broadcast.message_id, reply_markup=kb)
+            return
+        except TelegramBadRequest as e:
+            if "not modified" in str(e):
+                return
+            # сообщение удалено или слишком старое - пришлем новое
+    sent = await bot.send_message(broadcast.admin_id, text, reply_markup=kb)
+    broadcast.message_id = sent.message_id
+
+# --- ИСТЕЧЕНИЕ СРОКОВ ---
+# Таймер только будит проверку: срок считается по меткам времени в хранилище,
+# поэтому устаревший таймер (пользователя уже соединили, он написал в чат в
+# другом воркере) ничего не ломает, а при необходимости переносится
+async def expire_queue(uid):
+    entry = waiting_users.get(uid)
+    if entry is None:
+        return
+    left = entry.since + QUEUE_TIMEOUT - time.time()
+    if left > 0:
+        timers.arm(("queue", uid), left)
+        return
+    async with store.locked():
+        waiting_users.remove(uid)
+    EXPIRED.inc(kind="queue")
+    log_match.debug("%s снят с поиска по таймауту", uid)
+    await bot.send_message(uid, "⌛ Собеседник так и не нашелся, поиск остановлен. Попробуйте еще раз позже.", reply_markup=menu_kb)
+
+async def expire_chat(uid):
+    partner_id = active_chats.get(uid)
+    if partner_id is None:
+        return
+    last = max(chat_activity.get(uid, 0), chat_activity.get(partner_id, 0))
+    left = last + CHAT_IDLE_TIMEOUT - time.time()
+    if left > 0:
+        timers.arm(("chat", uid), left)
+        return
+    EXPIRED.inc(kind="chat")
+    log_match.info("Чат %s с %s завершен по неактивности", uid, partner_id)
+    await end_chat(uid, reason="⌛ Чат завершен: давно не было сообщений.")
+
+async def expire_rating(uid):
+    since = rating_since.get(uid)
+    if since is None:
+        return
+    left = since + RATING_TIMEOUT - time.time()
+    if left > 0:
+        timers.arm(("rating", uid), left)
+        return
+    del rating_since[uid]
+    awaiting_rating.pop(uid, None)
+    if user_state.get(uid) == "rating":
+        user_state[uid] = "idle"
+    EXPIRED.inc(kind="rating")
+
+async def expire_interests(uid):
+    """Общих интересов не нашлось за INTEREST_TIMEOUT: ищем по обычным фильтрам"""
+    entry = waiting_users.get(uid)
+    if entry is None:
+        return
+    left = entry.since + INTEREST_TIMEOUT - time.time()
+    if left > 0:
+        timers.arm(("interests", uid), left)
+        return
+    await find_pair(uid, fallback=True)
+
+EXPIRY_HANDLERS = {"queue": expire_queue, "chat": expire_chat, "rating": expire_rating, "interests": expire_interests}
+
+async def on_timer(key):
+    kind, uid = key
+    async with mailboxes.hold(uid):
+        await EXPIRY_HANDLERS[kind](uid)
+
+def recover_state():
+    """Состояние из журнала после перезапуска (STATE_BACKEND=memory). Пара и ее
+    in_chat пишутся в разных шагах, если замок пары был занят, - доводим такие пары"""
+    started = time.perf_counter()
+    entries, ops = store.recover()
+    if not entries and not ops:
+        return
+    now = time.time()
+    for uid in list(active_chats):
+        chat_activity[uid] = now  # chat_activity не журналируется: отсчет неактивности заново
+        if user_state.get(uid) != "in_chat":
+            user_state[uid] = "in_chat"
+    for uid, state in list(user_state.items()):
+        if state == "in_chat" and uid not in active_chats:
+            user_state[uid] = "idle"
+    log_db.info("Состояние восстановлено за %.2f с: %s чатов, %s в очереди (%s записей снимка, %s операций журнала)",
+                time.perf_counter() - started, len(active_chats) // 2, len(waiting_users), entries, ops)
+
+def arm_timers():
+    """Таймеры для состояния, пережившего перезапуск (STATE_BACKEND=sqlite или журнал); сработают сразу и перенесутся"""
+    for entry in waiting_users:
+        if QUEUE_TIMEOUT:
+            timers.arm(("queue", entry.user_id), 0)
+        if INTEREST_TIMEOUT and entry.tags:
+            timers.arm(("interests", entry.user_id), 0)
+    if CHAT_IDLE_TIMEOUT:
+        for uid in chat_activity:
+            timers.arm(("chat", uid), 0)
+    if RATING_TIMEOUT:
+        for uid in rating_since:
+            timers.arm(("rating", uid), 0)
+
 # --- ЗАПУСК ---
 async def main():
     # Проверяем наличие токена
@@ -726,9 +1242,84 @@ async def main():
         return
     
     await init_db()
+    outbox.start()
+    if WORKER_INDEX == 0:  # рассылку, прерванную перезапуском, продолжает один воркер
+        for broadcast in await broadcasts.resume():
+            log_admin.info("Продолжаем рассылку %s: отправлено %s из ~%s", broadcast.id, broadcast.sent, broadcast.total)
+    recover_state()
+    if store.journal is not None:
+        store.journal.start()
+    arm_timers()
+    timers.start(on_timer, TIMER_CONCURRENCY)
+    loop_monitor.start()
     print("✅ Бот запущен...")
     print(f"🤖 Токен бота: {'установлен' if BOT_TOKEN else 'отсутствует'}")
-    await dp.start_polling(bot)
+    metrics_task = None
+    try:
+        if BOT_MODE == "webhook":
+            log_webhook.info("Вебхук: %s:%s%s (воркер %s/%s)", WEB_HOST, PORT, WEBHOOK_PATH, WORKER_INDEX + 1, WORKERS)
+            await run_webhook(
+                dp, bot, WEB_HOST, PORT,
+                path=WEBHOOK_PATH,
+                url=WEBHOOK_URL if WORKER_INDEX == 0 else None,
+                secret_token=WEBHOOK_SECRET,
+                max_concurrency=WEBHOOK_CONCURRENCY,
+                mailboxes=mailboxes,
+                reuse_port=WORKERS > 1
+            )
+        else:
+            if METRICS_PORT:
+                log_webhook.info("Метрики: %s:%s/metrics", WEB_HOST, METRICS_PORT)
+                metrics_task = asyncio.create_task(serve(build_metrics_app(), WEB_HOST, METRICS_PORT))
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        if metrics_task:
+            metrics_task.cancel()
+        await timers.stop()
+        await albums.stop()
+        await broadcasts.stop()
+        if export_task is not None:
+            export_task.cancel()
+        if perf_task is not None:
+            perf_task.cancel()
+        await loop_monitor.stop()
+        if store.journal is not None:
+            await store.journal.stop()
+        await outbox.stop()
+        await writer.stop()
+        await db.close()
+        store.close()
+        log_listener.stop()
+
+
+def run_worker(index):
+    """Точка входа процесса-воркера: модуль импортируется заново, со своим соединением к хранилищу"""
+    global WORKER_INDEX
+    WORKER_INDEX = index
+    asyncio.run(main())
+
+
+def run_workers():
+    """Запустить WORKERS процессов, которые слушают один порт и делят состояние через SQLite"""
+    if BOT_MODE != "webhook" or STATE_BACKEND != "sqlite":
+        log_webhook.error("WORKERS > 1 работает только с BOT_MODE=webhook и STATE_BACKEND=sqlite")
+        log_listener.stop()  # дописать очередь логов до выхода
+        return
+    ctx = multiprocessing.get_context("spawn")
+    procs = [ctx.Process(target=run_worker, args=(i,), name=f"worker-{i}") for i in range(WORKERS)]
+    for proc in procs:
+        proc.start()
+    try:
+        for proc in procs:
+            proc.join()
+    except KeyboardInterrupt:
+        for proc in procs:
+            proc.join()
+
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if WORKERS > 1:
+        run_workers()
+    else:
+        asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,255 @@
+"""Рассылка админа по всем незабаненным пользователям.
+
+Получатели читаются из users пачками по user_id (keyset-курсор), в памяти
+только текущая пачка. Внутри пачки сообщения уходят параллельно, но не
+быстрее rate в секунду; общий лимит бота, лимит чата и RetryAfter соблюдает
+OutboundScheduler, а рассылка идет в полосе BULK и пропускает вперед
+пересылку в чатах и уведомления.
+
+Курсор и счетчики хранятся в таблице broadcasts и обновляются после каждой
+пачки, поэтому после перезапуска рассылка продолжается с места остановки.
+Отправки впереди курсора ограничены concurrency, поэтому после перезапуска
+сообщение повторно получат не больше concurrency человек.
+"""
+import asyncio
+import time
+from datetime import datetime
+
+from aiogram.exceptions import TelegramRetryAfter
+
+from logs import get_logger
+from metrics import BROADCAST_MESSAGES
+from sender import TokenBucket
+
+logger = get_logger("broadcast")
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        admin_id INTEGER,
+        text TEXT,
+        status TEXT DEFAULT 'running',
+        cursor INTEGER DEFAULT 0,
+        sent INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        total INTEGER DEFAULT 0,
+        message_id INTEGER,
+        created_at TEXT,
+        updated_at TEXT
+    )""",
+    "CREATE INDEX IF NOT EXISTS broadcasts_status ON broadcasts(status)",
+)
+
+RECIPIENTS_SQL = "SELECT user_id FROM users WHERE user_id > ? AND banned = 0 ORDER BY user_id LIMIT ?"
+
+RUNNING, DONE, CANCELLED = "running", "done", "cancelled"
+
+
+class Broadcast:
+    """Одна рассылка: строка broadcasts плюс скорость текущего запуска"""
+    __slots__ = ("id", "admin_id", "text", "status", "cursor", "sent", "failed", "total", "message_id",
+                 "started", "done_at_start")
+
+    def __init__(self, id, admin_id, text, status=RUNNING, cursor=0, sent=0, failed=0, total=0, message_id=None):
+        self.id = id
+        self.admin_id = admin_id
+        self.text = text
+        self.status = status
+        self.cursor = cursor  # последний user_id, после которого продолжать
+        self.sent = sent
+        self.failed = failed
+        self.total = total  # оценка по счетчикам stats на момент запуска
+        self.message_id = message_id  # сообщение админу с прогрессом
+        self.started = time.monotonic()
+        self.done_at_start = sent + failed
+
+    @property
+    def done(self):
+        return self.sent + self.failed
+
+    def rate(self):
+        """Сообщений в секунду с начала текущего запуска"""
+        elapsed = time.monotonic() - self.started
+        return (self.done - self.done_at_start) / elapsed if elapsed > 0 else 0.0
+
+    def eta(self):
+        """Примерно секунд до конца, None - пока скорость неизвестна"""
+        rate = self.rate()
+        return max(0, self.total - self.done) / rate if rate else None
+
+
+class Broadcaster:
+    """Запускает рассылки и сохраняет их курсор.
+
+    send(user_id, text) - корутина отправки одному получателю; report(broadcast)
+    вызывается при запуске, раз в report_interval секунд и в конце рассылки.
+    """
+
+    def __init__(self, db, send, report=None, rate=20, chunk=500, concurrency=50, report_interval=5, max_retries=3):
+        self.db = db
+        self.send = send
+        self.report = report
+        self.chunk = chunk
+        self.concurrency = concurrency
+        self.report_interval = report_interval
+        self.max_retries = max_retries
+        self._bucket = TokenBucket(rate, max(1, rate / 20))  # запас на 50 мс: опоздание sleep не теряет токены, а всплеска на секунду нет
+        self._pace = asyncio.Lock()  # токена ждет один отправитель, остальные стоят за ним
+        self._running = {}  # id -> (Broadcast, asyncio.Task)
+
+    def __len__(self):
+        return len(self._running)
+
+    def active(self):
+        return [broadcast for broadcast, _ in self._running.values()]
+
+    async def create(self, admin_id, text, total):
+        now = datetime.now().isoformat()
+        broadcast_id = await self.db.execute(
+            "INSERT INTO broadcasts(admin_id, text, total, created_at, updated_at) VALUES(?,?,?,?,?)",
+            (admin_id, text, total, now, now)
+        )
+        broadcast = Broadcast(broadcast_id, admin_id, text, total=total)
+        self.start(broadcast)
+        return broadcast
+
+    async def resume(self):
+        """Продолжить рассылки, прерванные остановкой бота -> [Broadcast]"""
+        rows = await self.db.fetchall(
+            """SELECT id, admin_id, text, status, cursor, sent, failed, total, message_id
+            FROM broadcasts WHERE status = ?""", (RUNNING,)
+        )
+        resumed = []
+        for row in rows:
+            if row[0] in self._running:
+                continue
+            broadcast = Broadcast(*row)
+            logger.info("Рассылка %s продолжается с user_id > %s (%s отправлено)", broadcast.id, broadcast.cursor, broadcast.sent)
+            self.start(broadcast)
+            resumed.append(broadcast)
+        return resumed
+
+    def start(self, broadcast):
+        task = asyncio.create_task(self._run(broadcast))
+        self._running[broadcast.id] = (broadcast, task)
+        task.add_done_callback(lambda _: self._running.pop(broadcast.id, None))
+
+    def cancel(self, broadcast_id):
+        """Остановить рассылку насовсем; уже отправляемые сообщения дойдут -> bool"""
+        entry = self._running.get(broadcast_id)
+        if entry is None:
+            return False
+        entry[0].status = CANCELLED
+        return True
+
+    async def stop(self):
+        """Прервать рассылки при остановке бота; статус остается running, их продолжит resume()"""
+        tasks = [task for _, task in self._running.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self, broadcast):
+        reporter = asyncio.create_task(self._report_loop(broadcast)) if self.report else None
+        try:
+            while broadcast.status == RUNNING:
+                rows = await self.db.fetchall(RECIPIENTS_SQL, (broadcast.cursor, self.chunk))
+                if not rows:
+                    broadcast.status = DONE
+                    break
+                await self._send_chunk(broadcast, [row[0] for row in rows])
+                await self._save(broadcast)
+        except asyncio.CancelledError:
+            await self._save(broadcast)
+            raise
+        except Exception:
+            logger.exception("Рассылка %s прервана ошибкой", broadcast.id)
+            broadcast.status = CANCELLED
+        finally:
+            if reporter is not None:
+                reporter.cancel()
+        await self._save(broadcast)
+        logger.info("Рассылка %s: %s, отправлено %s, ошибок %s", broadcast.id, broadcast.status, broadcast.sent, broadcast.failed)
+        if self.report:
+            await self._report(broadcast)
+
+    async def _send_chunk(self, broadcast, user_ids):
+        """Отправить пачку. Счетчики растут с каждой отправкой, а курсор - по
+        непрерывному префиксу завершенных. Отправка i-го получателя начинается,
+        только когда i < префикс + concurrency, поэтому при прерывании повторно
+        получат сообщение не больше concurrency человек, и их отправки не считаются"""
+        results = [None] * len(user_ids)  # True - доставлено, False - ошибка
+        prefix = 0
+        advanced = asyncio.Event()
+
+        async def deliver(i, user_id):
+            nonlocal prefix
+            async with self._pace:
+                while (wait := self._bucket.delay()) > 0:
+                    await asyncio.sleep(wait)
+                self._bucket.consume()
+            ok = results[i] = await self._deliver(user_id, broadcast.text)
+            if ok:
+                broadcast.sent += 1
+            else:
+                broadcast.failed += 1
+            BROADCAST_MESSAGES.inc(result="sent" if ok else "failed")
+            while prefix < len(results) and results[prefix] is not None:
+                prefix += 1
+            advanced.set()
+
+        tasks = []
+        try:
+            for i, user_id in enumerate(user_ids):
+                while i >= prefix + self.concurrency:
+                    advanced.clear()
+                    await advanced.wait()
+                if broadcast.status != RUNNING:
+                    break
+                tasks.append(asyncio.create_task(deliver(i, user_id)))
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if prefix:
+                broadcast.cursor = user_ids[prefix - 1]
+            if broadcast.status == RUNNING:  # прервана остановкой бота: хвост после пропуска уйдет еще раз
+                for ok in results[prefix:]:
+                    if ok is True:
+                        broadcast.sent -= 1
+                    elif ok is False:
+                        broadcast.failed -= 1
+
+    async def _deliver(self, user_id, text):
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self.send(user_id, text)
+                return True
+            except TelegramRetryAfter as e:
+                # Планировщик уже повторял запрос; ждем и пробуем еще, пока есть попытки
+                if attempt == self.max_retries:
+                    break
+                await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                logger.debug("Рассылка: %s не получил сообщение: %s", user_id, e)
+                return False
+        return False
+
+    async def _report_loop(self, broadcast):
+        while True:
+            await self._report(broadcast)
+            await asyncio.sleep(self.report_interval)
+
+    async def _save(self, broadcast):
+        await self.db.execute(
+            "UPDATE broadcasts SET status=?, cursor=?, sent=?, failed=?, message_id=?, updated_at=? WHERE id=?",
+            (broadcast.status, broadcast.cursor, broadcast.sent, broadcast.failed, broadcast.message_id,
+             datetime.now().isoformat(), broadcast.id)
+        )
+
+    async def _report(self, broadcast):
+        try:
+            await self.report(broadcast)
+        except Exception:
+            logger.exception("Не удалось показать прогресс рассылки %s", broadcast.id)
@@ -0,0 +1,88 @@
+import time
+from collections import OrderedDict
+
+
+class Profile:
+    """Строка users, нужная горячему пути"""
+    __slots__ = ("banned", "rating", "rating_count", "gender", "age", "filters", "interests")
+
+    def __init__(self, banned=False, rating=0.0, rating_count=0, gender=None, age=0, filters=None, interests=()):
+        self.banned = banned
+        self.rating = rating
+        self.rating_count = rating_count
+        self.gender = gender
+        self.age = age
+        self.filters = filters
+        self.interests = interests  # кортеж тегов
+
+
+class ProfileCache:
+    """Ограниченный LRU-кэш профилей по user_id.
+
+    Хелперы, меняющие users, обновляют закэшированную запись сразу после
+    записи в базу, поэтому чтения из кэша не отстают от SQLite. Если базу
+    меняют другие воркеры, ttl ограничивает, сколько секунд запись может
+    быть устаревшей (0 - без срока).
+    """
+
+    def __init__(self, maxsize=10000, ttl=0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # user_id -> Profile
+        self._expires = {}  # user_id -> monotonic-время устаревания (только при ttl)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, user_id):
+        return user_id in self._data
+
+    def get(self, user_id):
+        profile = self._data.get(user_id)
+        if profile is not None and self.ttl and self._expires[user_id] < time.monotonic():
+            self.invalidate(user_id)
+            profile = None
+        if profile is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._data.move_to_end(user_id)
+        return profile
+
+    def put(self, user_id, profile):
+        self._data[user_id] = profile
+        self._data.move_to_end(user_id)
+        if self.ttl:
+            self._expires[user_id] = time.monotonic() + self.ttl
+        while len(self._data) > self.maxsize:
+            evicted, _ = self._data.popitem(last=False)
+            self._expires.pop(evicted, None)
+        return profile
+
+    def update(self, user_id, **fields):
+        """Обновить поля закэшированного профиля; если его нет - ничего не делать"""
+        profile = self._data.get(user_id)
+        if profile is not None:
+            for name, value in fields.items():
+                setattr(profile, name, value)
+        return profile
+
+    def invalidate(self, user_id):
+        self._data.pop(user_id, None)
+        self._expires.pop(user_id, None)
+
+    def clear(self):
+        self._data.clear()
+        self._expires.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total * 100, 1) if total else 0.0,
+        }
@@ -0,0 +1,96 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import aiosqlite
+
+from metrics import DB_QUERY_SECONDS
+
+# Настройки SQLite для одного долгоживущего соединения
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",  # читатели не блокируют писателя
+    "PRAGMA synchronous=NORMAL",  # в WAL fsync только на чекпоинтах
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",  # ~16 МБ страничного кэша
+    "PRAGMA mmap_size=134217728",  # 128 МБ
+    "PRAGMA busy_timeout=5000",
+)
+
+
+class Database:
+    """Общее соединение с базой на весь процесс.
+
+    Соединение открывается один раз в init_db() и закрывается при остановке.
+    sqlite3 кэширует подготовленные выражения по тексту запроса, поэтому
+    хелперы используют постоянные строки SQL с параметрами.
+    """
+
+    def __init__(self, path, cached_statements=256):
+        self.path = path
+        self.cached_statements = cached_statements
+        self._conn = None
+        self._write_lock = asyncio.Lock()
+
+    @property
+    def connected(self):
+        return self._conn is not None
+
+    async def connect(self):
+        if self._conn is not None:
+            return self
+        self._conn = await aiosqlite.connect(self.path, cached_statements=self.cached_statements)
+        for pragma in PRAGMAS:
+            await self._conn.execute(pragma)
+        return self
+
+    async def close(self):
+        if self._conn is None:
+            return
+        async with self._write_lock:
+            await self._conn.commit()
+            await self._conn.close()
+            self._conn = None
+
+    async def fetchone(self, sql, params=()):
+        with DB_QUERY_SECONDS.time(op="fetchone"):
+            cur = await self._conn.execute(sql, params)
+            try:
+                return await cur.fetchone()
+            finally:
+                await cur.close()
+
+    async def fetchall(self, sql, params=()):
+        with DB_QUERY_SECONDS.time(op="fetchall"):
+            cur = await self._conn.execute(sql, params)
+            try:
+                return await cur.fetchall()
+            finally:
+                await cur.close()
+
+    async def execute(self, sql, params=()):
+        """Одиночная запись с коммитом, возвращает lastrowid"""
+        async with self._write_lock:
+            with DB_QUERY_SECONDS.time(op="execute"):
+                cur = await self._conn.execute(sql, params)
+                await self._conn.commit()
+                rowid = cur.lastrowid
+                await cur.close()
+                return rowid
+
+    async def executemany(self, sql, seq_of_params):
+        async with self._write_lock:
+            with DB_QUERY_SECONDS.time(op="executemany"):
+                await self._conn.executemany(sql, seq_of_params)
+                await self._conn.commit()
+
+    @asynccontextmanager
+    async def transaction(self):
+        """Несколько запросов одной транзакцией (чтение-изменение-запись)"""
+        async with self._write_lock:
+            with DB_QUERY_SECONDS.time(op="transaction"):
+                try:
+                    yield self._conn
+                except BaseException:
+                    await self._conn.rollback()
+                    raise
+                else:
+                    await self._conn.commit()
@@ -0,0 +1,186 @@
+"""Выгрузка chats, ratings и admin_actions для офлайн-аналитики.
+
+Таблица читается пачками по id (WHERE id > ? ORDER BY id LIMIT ?), каждая
+пачка - своя короткая транзакция чтения: в режиме WAL выгрузка не мешает
+записи и не держит чекпоинт. Строки пишутся в сжатые файлы NDJSON или CSV
+(gzip); файл пишется как .part и переименовывается, когда готов целиком.
+
+Последний выгруженный id хранится в export_watermarks, следующая выгрузка
+берет только новые строки. Строки chats дописывает log_chat_end, поэтому
+граница для chats не заходит за первый еще идущий чат; открытые строки
+старше OPEN_CHAT_MAX_AGE считаются оставшимися после падения и выгружаются.
+
+Выгрузка синхронная, на своем соединении sqlite3. Бот запускает этот файл
+отдельным процессом (export_in_process), чтобы разбор строк и сжатие не
+занимали цикл событий; из консоли: python export.py [--format csv].
+"""
+import argparse
+import asyncio
+import csv
+import gzip
+import json
+import os
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta
+
+# Таблица -> колонки в файле; у всех первичный ключ id растет с каждой вставкой
+TABLES = {
+    "chats": ("id", "user1", "user2", "start_time", "end_time", "duration"),
+    "ratings": ("id", "from_user", "to_user", "rating", "ts"),
+    "admin_actions": ("id", "admin_id", "target_user", "action", "ts"),
+}
+FORMATS = ("ndjson", "csv")
+OPEN_CHAT_MAX_AGE = timedelta(days=1)  # чаты дольше CHAT_IDLE_TIMEOUT бот закрывает сам
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS export_watermarks (
+        name TEXT PRIMARY KEY,
+        last_id INTEGER NOT NULL DEFAULT 0,
+        exported_at TEXT
+    ) WITHOUT ROWID""",
+)
+
+CHUNK_SQL = "SELECT {columns} FROM {table} WHERE id > ? AND id <= ? ORDER BY id LIMIT ?"
+FIRST_OPEN_CHAT_SQL = "SELECT MIN(id) FROM chats WHERE id > ? AND end_time IS NULL AND start_time >= ?"
+
+
+def connect(path):
+    """Свое соединение выгрузки: autocommit, чтобы чтение не держало транзакцию между пачками"""
+    conn = sqlite3.connect(path, isolation_level=None, timeout=5)
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+def watermark(conn, table):
+    row = conn.execute("SELECT last_id FROM export_watermarks WHERE name=?", (table,)).fetchone()
+    return row[0] if row else 0
+
+
+def first_open_chat(conn, since):
+    """id первого незавершенного чата новее since -> выгружать chats только до него"""
+    (chat_id,) = conn.execute(FIRST_OPEN_CHAT_SQL, (since, (datetime.now() - OPEN_CHAT_MAX_AGE).isoformat())).fetchone()
+    return chat_id
+
+
+_encode = json.JSONEncoder(ensure_ascii=False).encode  # json.dumps с нестандартными аргументами создает кодировщик на каждый вызов
+
+
+def _write_ndjson(f, columns, rows):
+    f.write("".join(_encode(dict(zip(columns, row))) + "\n" for row in rows))
+
+
+def _write_csv(f, columns, rows):
+    csv.writer(f).writerows(rows)
+
+
+def export_table(conn, table, out_dir, fmt="ndjson", chunk=10_000):
+    """Выгрузить строки table новее водяного знака в один файл -> отчет"""
+    columns = TABLES[table]
+    started = time.perf_counter()
+    since = watermark(conn, table)
+    (until,) = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()
+    if table == "chats":
+        open_id = first_open_chat(conn, since)
+        if open_id is not None:
+            until = min(until, open_id - 1)
+    report = {"table": table, "file": None, "rows": 0, "since": since, "until": max(since, until), "bytes": 0}
+    if until <= since:
+        report["seconds"] = time.perf_counter() - started
+        return report
+
+    path = os.path.join(out_dir, f"{table}_{since + 1}-{until}.{fmt}.gz")
+    part = path + ".part"
+    write = _write_csv if fmt == "csv" else _write_ndjson
+    sql = CHUNK_SQL.format(columns=", ".join(columns), table=table)
+    last = since
+    with gzip.open(part, "wt", encoding="utf-8", newline="", compresslevel=6) as f:
+        if fmt == "csv":
+            csv.writer(f).writerow(columns)
+        while True:
+            rows = conn.execute(sql, (last, until, chunk)).fetchall()
+            if not rows:
+                break
+            write(f, columns, rows)
+            report["rows"] += len(rows)
+            last = rows[-1][0]
+    if report["rows"]:
+        os.replace(part, path)
+        report["file"] = path
+        report["bytes"] = os.path.getsize(path)
+    else:
+        os.remove(part)  # строки между водяным знаком и until удалены - файл не нужен
+
+    # Знак ставим после переименования: упавшая выгрузка повторится целиком, а не потеряет строки
+    conn.execute(
+        """INSERT INTO export_watermarks(name, last_id, exported_at) VALUES(?,?,?)
+        ON CONFLICT(name) DO UPDATE SET last_id=excluded.last_id, exported_at=excluded.exported_at""",
+        (table, until, datetime.now().isoformat())
+    )
+    report["seconds"] = time.perf_counter() - started
+    return report
+
+
+def export_all(path, out_dir, fmt="ndjson", chunk=10_000, tables=tuple(TABLES)):
+    """Выгрузить таблицы по очереди -> [отчет по таблице]"""
+    if fmt not in FORMATS:
+        raise ValueError(f"формат {fmt!r}, ожидается один из {FORMATS}")
+    os.makedirs(out_dir, exist_ok=True)
+    conn = connect(path)
+    try:
+        for sql in SCHEMA:  # из консоли база могла еще не пройти миграцию 6
+            conn.execute(sql)
+        return [export_table(conn, table, out_dir, fmt, chunk) for table in tables]
+    finally:
+        conn.close()
+
+
+async def export_in_process(path, out_dir, fmt="ndjson", chunk=10_000, tables=tuple(TABLES)):
+    """export_all в отдельном процессе python export.py с пониженным приоритетом -> [отчет].
+    Чистый процесс, а не multiprocessing: spawn заново импортировал бы bot.py со всем его состоянием"""
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.abspath(__file__), "--db", path, "--dir", out_dir, "--format", fmt,
+        "--chunk", str(chunk), "--tables", *tables, "--json", "--nice", "10",
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        out, err = await proc.communicate()
+    except asyncio.CancelledError:
+        proc.kill()
+        raise
+    if proc.returncode:
+        raise RuntimeError(err.decode(errors="replace").strip().splitlines()[-1] if err.strip() else f"код {proc.returncode}")
+    return json.loads(out)
+
+
+def format_report(reports):
+    lines = []
+    for r in reports:
+        if not r["file"]:
+            lines.append(f"{r['table']}: новых строк нет (id до {r['until']})")
+            continue
+        speed = r["rows"] / r["seconds"] if r["seconds"] else 0
+        lines.append(f"{r['table']}: {r['rows']} строк, id {r['since'] + 1}-{r['until']}, "
+                     f"{r['bytes'] / 2**20:.1f} МБ, {r['seconds']:.1f} с ({speed:.0f} строк/с) -> {r['file']}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Выгрузка chats, ratings и admin_actions в сжатые NDJSON/CSV")
+    parser.add_argument("--db", default="anon_chat.db")
+    parser.add_argument("--dir", default="exports")
+    parser.add_argument("--format", choices=FORMATS, default="ndjson")
+    parser.add_argument("--chunk", type=int, default=10_000)
+    parser.add_argument("--tables", nargs="*", choices=tuple(TABLES), default=tuple(TABLES))
+    parser.add_argument("--json", action="store_true", help="отчет одной строкой JSON (для бота)")
+    parser.add_argument("--nice", type=int, default=0, help="понизить приоритет процесса")
+    args = parser.parse_args()
+    if args.nice and hasattr(os, "nice"):
+        os.nice(args.nice)  # на одном CPU планировщик ОС отдает предпочтение процессу бота
+    reports = export_all(args.db, args.dir, args.format, args.chunk, tables=args.tables)
+    print(json.dumps(reports) if args.json else format_report(reports))
+
+
+if __name__ == "__main__":
+    main()
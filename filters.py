@@ -0,0 +1,22 @@
+"""Фильтры поиска в колонках users: filter_min_rating, filter_min_age, filter_max_age.
+
+Колонки добавляет миграция 4; профиль (bot.get_profile) читает их вместе с
+остальной строкой users, save_user_filters пишет обратно.
+"""
+FILTER_KEYS = ("min_rating", "min_age", "max_age")
+
+
+def filters_from_row(min_rating, min_age, max_age):
+    """Колонки users -> словарь фильтров; None, если пользователь их не задавал"""
+    if min_rating is None and min_age is None and max_age is None:
+        return None
+    filters = {"min_rating": 0, "min_age": 14, "max_age": 100}
+    for key, value in zip(FILTER_KEYS, (min_rating, min_age, max_age)):
+        if value is not None:
+            filters[key] = value
+    return filters
+
+
+def filters_to_row(filters):
+    return tuple(filters.get(key) for key in FILTER_KEYS)
+
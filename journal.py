@@ -0,0 +1,379 @@
+"""Журнал переходов состояния для теплого перезапуска (STATE_BACKEND=memory).
+
+Каждое изменение словарей состояния и очереди ожидания дописывается в
+журнал короткой операцией: ("s", словарь, ключ, значение), ("d", словарь,
+ключ), очередь - ("a", запись), ("r", user_id), ("u", user_id, рейтинг).
+Операции копятся в памяти кортежами и раз в interval секунд уходят на диск
+одной строкой "crc32 JSON" с fsync в отдельном потоке: обработчики не ждут
+ни диск, ни json. Значения после записи в словарь не изменяются (бот
+меняет копию фильтров и присваивает ее заново), поэтому кодировать их
+можно позже.
+Переход, сделанный за один шаг цикла событий (соединение пары - снятие с
+очереди и две записи active_chats), попадает в одну строку и
+восстанавливается целиком; оборванная при падении последняя строка
+отбрасывается.
+
+Раз в snapshot_interval секунд или после snapshot_ops операций состояние
+целиком пишется в снимок, журнал переходит на новое поколение, старые
+удаляются. Снимок нечеткий: поколение меняется до копирования, словари
+копируются по одному, и между ними цикл обслуживает обработчики. Их
+изменения уже попадают в журнал нового поколения и при восстановлении
+применяются поверх снимка еще раз - операции идемпотентны (значение
+задается целиком, в очередь встает только отсутствующий), итог тот же.
+Снимок - поток pickle, а не JSON: читается вчетверо быстрее, и
+пишет его только сам бот. Восстановление: последний снимок и журналы его
+поколения и новее.
+
+chat_activity не журналируется: он меняется на каждое сообщение в чате,
+а после перезапуска отсчет неактивности просто начинается заново.
+Вытеснение сессий (sessions.py) тоже: вытесненные после восстановления
+снова уйдут по LRU/TTL, а их данные и так есть в таблице users.
+"""
+import asyncio
+import gc
+import json
+import os
+import pickle
+import time
+import zlib
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+
+from logs import get_logger
+
+logger = get_logger("journal")
+
+UNJOURNALED = ("chat_activity",)
+SNAPSHOT_CHUNK = 5000  # записей в куске снимка: pickle не держит GIL на весь снимок разом
+ENCODE_CHUNK = 1000  # операций за один вызов json.dumps при записи пачки - по той же причине
+
+
+def _dump(value):
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+@contextmanager
+def _paused_gc():
+    """Без сборщика мусора: снимок и восстановление создают сотни тысяч
+    долгоживущих объектов, и сборка поколений проходила бы их снова и снова"""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _columns(mapping):
+    """Словарь двумя списками: на снимок 100 тыс. пользователей это не полмиллиона
+    кортежей (ключ, значение), которые запускали бы полную сборку мусора"""
+    if hasattr(mapping, "columns"):
+        return mapping.columns()
+    return list(mapping.keys()), list(mapping.values())
+
+
+def _value(value):
+    return tuple(value) if isinstance(value, list) else value
+
+
+class Journal:
+    """Файлы: path.snap (снимок) и path.<поколение>.log (журнал после него)"""
+
+    def __init__(self, path, interval=0.05, snapshot_interval=300, snapshot_ops=100_000):
+        self.path = path
+        self.interval = interval
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_ops = snapshot_ops
+        self.gen = None  # поколение, в которое пишем; выбирается при recover()/start()
+        self.ops = 0  # операций с последнего снимка
+        self.batches = 0  # строк записано с запуска
+        self._pending = []  # операции, еще не на диске
+        self._file = None
+        self._maps = None
+        self._queue = None
+        self._task = None
+        self._closing = asyncio.Event()
+        self._lock = asyncio.Lock()  # flush и snapshot по одному: пачки ложатся в файл по порядку
+        self._snapshot_at = time.monotonic()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def bind(self, maps, queue):
+        """Что журналировать и куда восстанавливать: {имя: словарь} и очередь ожидания"""
+        self._maps = maps
+        self._queue = queue
+
+    def append(self, *op):
+        self._pending.append(op)
+        self.ops += 1
+
+    # --- восстановление ---
+    def _log_path(self, gen):
+        return f"{self.path}.{gen}.log"
+
+    def _generations(self):
+        directory, prefix = os.path.split(self.path)
+        prefix += "."
+        gens = []
+        for name in os.listdir(directory or "."):
+            middle = name[len(prefix):-len(".log")]
+            if name.startswith(prefix) and name.endswith(".log") and middle.isdigit():
+                gens.append(int(middle))
+        return sorted(gens)
+
+    def _read_snapshot(self):
+        """-> (поколение, [(имя, ключи, значения)]) или (0, []), если снимка нет"""
+        try:
+            f = open(self.path + ".snap", "rb")
+        except FileNotFoundError:
+            return 0, []
+        with f:
+            gen = pickle.load(f)
+            chunks = []
+            while True:
+                try:
+                    chunks.append(pickle.load(f))
+                except EOFError:
+                    return gen, chunks
+
+    def _read_log(self, gen):
+        with open(self._log_path(gen), "rb") as f:
+            for number, line in enumerate(f, 1):
+                crc, _, body = line.rstrip(b"\n").partition(b" ")
+                if not line.endswith(b"\n") or crc != b"%08x" % zlib.crc32(body):
+                    logger.warning("Журнал %s: строка %s оборвана, дальше не читаем", self._log_path(gen), number)
+                    return
+                yield json.loads(body)
+
+    def recover(self):
+        """Загрузить снимок и применить журналы после него -> (записей снимка, операций журнала)"""
+        with _paused_gc():
+            return self._recover()
+
+    def _recover(self):
+        base, chunks = self._read_snapshot()
+        entries = 0
+        for name, keys, values in chunks:
+            if name == "waiting":
+                for user_id, gender, age, filters, rating, since, tags in values:
+                    self._queue.add(user_id, gender, age, filters, rating, tags, since)
+            else:
+                target = self._maps[name]
+                for key, value in zip(keys, values):
+                    target[key] = value
+            entries += len(values)
+        ops = 0
+        gens = [gen for gen in self._generations() if gen >= base]
+        for gen in gens:
+            for batch in self._read_log(gen):
+                for op in batch:
+                    self._apply(op)
+                ops += len(batch)
+        self.gen = max([base] + gens) + 1  # после перезапуска пишем в новый файл
+        return entries, ops
+
+    def _apply(self, op):
+        kind = op[0]
+        if kind == "s":
+            self._maps[op[1]][op[2]] = _value(op[3])
+        elif kind == "d":
+            self._maps[op[1]].pop(op[2], None)
+        elif kind == "a":
+            user_id, gender, age, filters, rating, since, tags = op[1:]
+            self._queue.add(user_id, gender, age, filters, rating, tags, since)
+        elif kind == "r":
+            self._queue.remove(op[1])
+        elif kind == "u":
+            self._queue.update_rating(op[1], op[2])
+
+    # --- запись ---
+    def start(self):
+        if self._task is not None:
+            return
+        if self.gen is None:
+            self.gen = max(self._generations(), default=0) + 1
+        self._file = open(self._log_path(self.gen), "ab")
+        self._closing.clear()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Дописать очередь и сохранить снимок: следующий запуск прочитает только его"""
+        if self._task is None:
+            return
+        self._closing.set()
+        await self._task
+        self._task = None
+        await self.snapshot()
+        self._file.close()
+        self._file = None
+
+    async def _run(self):
+        await self._guarded(self.snapshot)  # журналы прошлого запуска больше не нужны
+        while not self._closing.is_set():
+            try:
+                await asyncio.wait_for(self._closing.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            if self.ops >= self.snapshot_ops or (
+                    self.ops and time.monotonic() - self._snapshot_at >= self.snapshot_interval):
+                await self._guarded(self.snapshot)
+            else:
+                await self._guarded(self.flush)
+
+    async def _guarded(self, step):
+        try:
+            await step()
+        except Exception:
+            logger.exception("Не удалось записать журнал состояния")
+
+    async def flush(self):
+        async with self._lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, []
+            await asyncio.to_thread(self._write, self._file, batch)
+
+    def _write(self, file, batch):
+        body = ("[" + ",".join(_dump(batch[i:i + ENCODE_CHUNK])[1:-1]
+                               for i in range(0, len(batch), ENCODE_CHUNK)) + "]").encode()
+        file.write(b"%08x %s\n" % (zlib.crc32(body), body))
+        file.flush()
+        os.fsync(file.fileno())
+        self.batches += 1
+
+    async def capture(self):
+        """Копия состояния по словарю за шаг цикла -> [(имя, ключи, значения)]"""
+        state = []
+        for name, mapping in self._maps.items():
+            if name in UNJOURNALED:
+                continue
+            with _paused_gc():
+                state.append((name, *_columns(mapping)))
+            await asyncio.sleep(0)
+        with _paused_gc():
+            state.append(("waiting", None, [
+                (e.user_id, e.gender, e.age, e.filters, e.rating, e.since, sorted(e.tags)) for e in self._queue
+            ]))
+        return state
+
+    async def snapshot(self):
+        """Снимок всего состояния; дальше журнал пишется в новое поколение"""
+        async with self._lock:
+            batch, self._pending = self._pending, []  # операции до смены поколения - в старый журнал
+            old_file = self._file
+            self.gen += 1
+            self._file = open(self._log_path(self.gen), "ab")
+            self.ops = 0
+            self._snapshot_at = time.monotonic()
+            await asyncio.to_thread(self._close_log, old_file, batch)
+            state = await self.capture()
+            await asyncio.to_thread(self._write_snapshot, state, self.gen)
+
+    def _close_log(self, file, batch):
+        if batch:
+            self._write(file, batch)
+        file.close()
+
+    def _write_snapshot(self, state, gen):
+        tmp = self.path + ".snap.tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(gen, f, pickle.HIGHEST_PROTOCOL)
+            for name, keys, values in state:
+                for i in range(0, len(values), SNAPSHOT_CHUNK):
+                    chunk = keys[i:i + SNAPSHOT_CHUNK] if keys is not None else None
+                    pickle.dump((name, chunk, values[i:i + SNAPSHOT_CHUNK]), f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path + ".snap")
+        directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)  # переименование тоже должно дойти до диска
+        finally:
+            os.close(directory)
+        for old in self._generations():
+            if old < gen:
+                os.remove(self._log_path(old))
+
+
+class JournaledMap(MutableMapping):
+    """Словарь состояния, который записывает каждое изменение в журнал"""
+
+    def __init__(self, inner, name, journal):
+        self._inner = inner
+        self._name = name
+        self._journal = journal
+
+    def __getitem__(self, key):
+        return self._inner[key]
+
+    def get(self, key, default=None):
+        return self._inner.get(key, default)
+
+    def __setitem__(self, key, value):
+        self._inner[key] = value
+        self._journal.append("s", self._name, key, value)
+
+    def __delitem__(self, key):
+        del self._inner[key]
+        self._journal.append("d", self._name, key)
+
+    def __contains__(self, key):
+        return key in self._inner
+
+    def __iter__(self):
+        return iter(self._inner)
+
+    def __len__(self):
+        return len(self._inner)
+
+    def values(self):
+        return self._inner.values()
+
+    def items(self):
+        return self._inner.items()
+
+
+class JournaledQueue:
+    """Очередь ожидания, которая записывает постановку, снятие и смену рейтинга в журнал"""
+
+    def __init__(self, inner, journal):
+        self._inner = inner
+        self._journal = journal
+
+    def __getattr__(self, name):
+        return getattr(self._inner, name)
+
+    def __len__(self):
+        return len(self._inner)
+
+    def __contains__(self, user_id):
+        return user_id in self._inner
+
+    def __iter__(self):
+        return iter(self._inner)
+
+    def add(self, user_id, gender, age, filters, rating=0, tags=(), since=None):
+        added = self._inner.add(user_id, gender, age, filters, rating, tags, since)
+        if added:
+            e = self._inner.get(user_id)
+            self._journal.append("a", user_id, e.gender, e.age, e.filters, e.rating, e.since, sorted(e.tags))
+        return added
+
+    def remove(self, user_id):
+        entry = self._inner.remove(user_id)
+        if entry is not None:
+            self._journal.append("r", user_id)
+        return entry
+
+    def pop_match(self, user_id, user_rating, filters=None, tags=(), plain=True):
+        entry = self._inner.pop_match(user_id, user_rating, filters, tags, plain)
+        if entry is not None:
+            self._journal.append("r", entry.user_id)
+        return entry
+
+    def update_rating(self, user_id, rating):
+        if user_id in self._inner:
+            self._inner.update_rating(user_id, rating)
+            self._journal.append("u", user_id, rating)
@@ -0,0 +1,342 @@
+"""Нагрузочный тест: bot.py против локальной заглушки Bot API.
+
+Бот запускается отдельным процессом в режиме polling с TELEGRAM_API_URL,
+указывающим на FakeBotAPI. Синтетические пользователи проходят /start, пол,
+возраст, поиск, переписку, скип или завершение чата и оценку. Сеть не нужна,
+база создается во временной папке, сценарии задаются seed - прогоны можно
+сравнивать между релизами.
+
+Запуск: python loadtest.py [-u USERS] [--messages N] [--rounds N] [--seed S] [--json FILE]
+"""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import random
+import re
+import signal
+import socket
+import statistics
+import sys
+import tempfile
+import time
+
+import aiohttp
+from aiohttp import web
+
+BOT_DIR = os.path.dirname(os.path.abspath(__file__))
+FIRST_USER_ID = 10_000_000
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentiles(samples):
+    if not samples:
+        return {"n": 0}
+    samples = sorted(samples)
+    return {
+        "n": len(samples),
+        "p50_ms": round(samples[len(samples) // 2] * 1e3, 2),
+        "p99_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1e3, 2),
+        "mean_ms": round(statistics.fmean(samples) * 1e3, 2),
+    }
+
+
+class FakeBotAPI:
+    """Заглушка Bot API: отдает апдейты через getUpdates и принимает ответы бота.
+
+    Тексты sendMessage попадают во входящие пользователя (inbox), copyMessage
+    сопоставляется с исходным апдейтом - так считается задержка пересылки.
+    """
+
+    def __init__(self):
+        self.calls = collections.Counter()  # метод -> число вызовов
+        self.relay_latency = []
+        self.updates_served = 0
+        self._updates = collections.deque()
+        self._new_update = asyncio.Event()
+        self._update_id = 0
+        self._message_id = 0
+        self._sent_at = {}  # (chat_id, message_id) -> время апдейта
+        self._inbox = collections.defaultdict(asyncio.Queue)  # chat_id -> тексты от бота
+
+    def app(self):
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        return app
+
+    # --- сторона пользователя ---
+    def push(self, user_id, text):
+        """Отправить боту сообщение от пользователя"""
+        self._update_id += 1
+        self._message_id += 1
+        message = {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"u{user_id}"},
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        self._sent_at[(user_id, self._message_id)] = time.perf_counter()
+        self._updates.append({"update_id": self._update_id, "message": message})
+        self._new_update.set()
+
+    async def expect(self, user_id, needles, timeout):
+        """Ждать ответ бота, содержащий одну из строк needles; остальные пропускать"""
+        inbox = self._inbox[user_id]
+        deadline = time.perf_counter() + timeout
+        while True:
+            left = deadline - time.perf_counter()
+            if left <= 0:
+                return None
+            try:
+                text = await asyncio.wait_for(inbox.get(), left)
+            except asyncio.TimeoutError:
+                return None
+            if any(needle in text for needle in needles):
+                return text
+
+    def pending(self, user_id, needle):
+        """Есть ли уже во входящих сообщение с needle (без ожидания, сообщения не теряются)"""
+        return any(needle in text for text in self._inbox[user_id]._queue)
+
+    # --- сторона бота ---
+    async def handle(self, request):
+        method = request.match_info["method"].lower()
+        self.calls[method] += 1
+        data = dict(await request.post()) if request.body_exists else {}
+        if method == "getupdates":
+            result = await self._get_updates(int(data.get("offset", 0)), float(data.get("timeout", 0)))
+        elif method == "getme":
+            result = {"id": 1, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot"}
+        elif method == "sendmessage":
+            chat_id = int(data["chat_id"])
+            self._inbox[chat_id].put_nowait(data.get("text", ""))
+            result = self._message(chat_id, text=data.get("text", ""))
+        elif method == "copymessage":
+            sent = self._sent_at.pop((int(data["from_chat_id"]), int(data["message_id"])), None)
+            if sent is not None:
+                self.relay_latency.append(time.perf_counter() - sent)
+            self._message_id += 1
+            result = {"message_id": self._message_id}
+        elif method == "sendmediagroup":
+            result = [self._message(int(data["chat_id"]))]
+        elif method.startswith("send"):
+            result = self._message(int(data["chat_id"]))
+        else:
+            result = True  # deleteWebhook, answerCallbackQuery и прочее
+        return web.json_response({"ok": True, "result": result})
+
+    def _message(self, chat_id, **fields):
+        self._message_id += 1
+        return {"message_id": self._message_id, "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, **fields}
+
+    async def _get_updates(self, offset, timeout):
+        while self._updates and self._updates[0]["update_id"] < offset:
+            self._updates.popleft()
+        if not self._updates and timeout:
+            self._new_update.clear()
+            try:
+                await asyncio.wait_for(self._new_update.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        batch = list(self._updates)[:100]
+        self.updates_served += len(batch)
+        return batch
+
+
+class Driver:
+    """Синтетические пользователи; у каждого свой Random(seed + номер)"""
+
+    def __init__(self, api, users, messages, rounds, skip, think, timeout, seed):
+        self.api = api
+        self.users = users
+        self.messages = messages
+        self.rounds = rounds
+        self.skip = skip
+        self.think = think
+        self.timeout = timeout
+        self.seed = seed
+        self.time_to_match = []
+        self.reply_latency = []
+        self.outcomes = collections.Counter()
+
+    async def say(self, user_id, text, *needles):
+        started = time.perf_counter()
+        self.api.push(user_id, text)
+        reply = await self.api.expect(user_id, needles, self.timeout)
+        if reply is not None and needles:
+            self.reply_latency.append(time.perf_counter() - started)
+        return reply
+
+    async def user(self, n):
+        rnd = random.Random(self.seed + n)
+        uid = FIRST_USER_ID + n
+        await asyncio.sleep(rnd.uniform(0, self.think * 10))  # пользователи приходят не одновременно
+        if not await self.say(uid, "/start", "Выберите свой пол"):
+            self.outcomes["timeout_start"] += 1
+            return
+        await self.say(uid, rnd.choice(("Мужской", "Женский")), "Введите возраст")
+        if not await self.say(uid, str(rnd.randint(16, 40)), "Регистрация завершена"):
+            self.outcomes["timeout_register"] += 1
+            return
+
+        reply, started = None, None
+        for _ in range(self.rounds):
+            if reply is None:
+                started = time.perf_counter()
+                reply = await self.say(uid, "🔎 Найти собеседника", "Собеседник найден", "Ожидание")
+            if reply and "Ожидание" in reply:
+                reply = await self.api.expect(uid, ("Собеседник найден",), self.timeout)
+            if not reply:
+                self.outcomes["unmatched"] += 1
+                await self.say(uid, "⛔ Выйти из поиска", "вышли из поиска")
+                return
+            self.time_to_match.append(time.perf_counter() - started)
+            self.outcomes["matched"] += 1
+            reply = await self.chat(uid, rnd)
+            if reply is not None:
+                started = time.perf_counter()  # скип сразу запускает новый поиск
+        self.outcomes["finished"] += 1
+
+    async def chat(self, uid, rnd):
+        """Переписка и выход из чата; вернуть ответ на скип (уже идет новый поиск) или None"""
+        for i in range(self.messages):
+            await asyncio.sleep(rnd.uniform(0, self.think))
+            if self.api.pending(uid, "Оцените диалог"):
+                break  # собеседник ушел
+            self.api.push(uid, f"сообщение {i}")
+        else:
+            if rnd.random() < self.skip:
+                reply = await self.say(uid, "⏭️ Скипнуть", "Собеседник найден", "Ожидание", "Спасибо за диалог")
+                if reply and "Спасибо" not in reply:
+                    self.outcomes["skipped"] += 1
+                    return reply
+                return None
+            self.api.push(uid, "❌ Завершить чат")
+        if await self.api.expect(uid, ("Оцените диалог", "Спасибо за диалог"), self.timeout):
+            # "Неизвестная команда" - собеседник скипнул нас молча, и оценка пришла уже в меню
+            await self.say(uid, "⭐⭐⭐⭐⭐ 5", "оценку", "Не удалось", "Спасибо за диалог", "Неизвестная команда")
+        return None
+
+    async def run(self):
+        await asyncio.gather(*(self.user(n) for n in range(self.users)))
+
+
+def parse_metrics(text):
+    """Строки Prometheus -> {(имя, метки): значение}"""
+    values = {}
+    for line in text.splitlines():
+        match = re.match(r"^([a-z_]+)(\{[^}]*\})? (\S+)$", line)
+        if match:
+            values[(match.group(1), match.group(2) or "")] = float(match.group(3))
+    return values
+
+
+async def scrape_metrics(port):
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"http://127.0.0.1:{port}/metrics") as resp:
+            return parse_metrics(await resp.text())
+
+
+def sqlite_time(metrics):
+    ops = {}
+    for (name, labels), value in metrics.items():
+        if name.startswith("anonchat_db_query_seconds_"):
+            op = re.search(r'op="([^"]+)"', labels).group(1)
+            ops.setdefault(op, {})[name.rsplit("_", 1)[1]] = value
+    return {
+        op: {"count": int(v.get("count", 0)), "total_s": round(v.get("sum", 0), 3),
+             "mean_ms": round(v.get("sum", 0) / v["count"] * 1e3, 3) if v.get("count") else 0}
+        for op, v in sorted(ops.items())
+    }
+
+
+async def run(args):
+    api = FakeBotAPI()
+    api_port, metrics_port = free_port(), free_port()
+    runner = web.AppRunner(api.app())
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", api_port).start()
+
+    env = dict(
+        os.environ,
+        BOT_TOKEN="123456:loadtest",
+        TELEGRAM_API_URL=f"http://127.0.0.1:{api_port}",
+        BOT_MODE="polling",
+        METRICS_PORT=str(metrics_port),
+        WEB_HOST="127.0.0.1",
+        LOG_LEVEL="WARNING",
+    )
+    if not args.telegram_limits:
+        env.update(SEND_RATE="1000000", SEND_CHAT_RATE="1000000", SEND_CHAT_BURST="1000000")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        proc = await asyncio.create_subprocess_exec(sys.executable, os.path.join(BOT_DIR, "bot.py"), cwd=tmpdir, env=env)
+        try:
+            # Бот готов, когда спросил getUpdates
+            while not api.calls["getupdates"]:
+                if proc.returncode is not None:
+                    raise SystemExit("bot.py завершился при запуске")
+                await asyncio.sleep(0.05)
+            driver = Driver(api, args.users, args.messages, args.rounds, args.skip, args.think, args.timeout, args.seed)
+            started = time.perf_counter()
+            await driver.run()
+            elapsed = time.perf_counter() - started
+            metrics = await scrape_metrics(metrics_port)
+        finally:
+            if proc.returncode is None:
+                proc.send_signal(signal.SIGINT)
+                await proc.wait()
+            await runner.cleanup()
+
+    return {
+        "params": {k: v for k, v in vars(args).items() if k != "json"},
+        "elapsed_s": round(elapsed, 2),
+        "updates": api.updates_served,
+        "updates_per_s": round(api.updates_served / elapsed, 1),
+        "reply_latency": percentiles(driver.reply_latency),
+        "time_to_match": percentiles(driver.time_to_match),
+        "relay_latency": percentiles(api.relay_latency),
+        "sqlite": sqlite_time(metrics),
+        "api_calls": dict(api.calls),
+        "outcomes": dict(driver.outcomes),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-u", "--users", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=5, help="сообщений от каждого в одном чате")
+    parser.add_argument("--rounds", type=int, default=2, help="сколько чатов проходит каждый пользователь")
+    parser.add_argument("--skip", type=float, default=0.3, help="доля выходов из чата через скип")
+    parser.add_argument("--think", type=float, default=0.05, help="макс. пауза между сообщениями, сек")
+    parser.add_argument("--timeout", type=float, default=10, help="сколько ждать ответа или собеседника, сек")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--telegram-limits", action="store_true", help="оставить лимиты отправки как в проде")
+    parser.add_argument("--json", help="сохранить результат в файл")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    print(f"users={args.users} elapsed={result['elapsed_s']}s updates={result['updates']} "
+          f"({result['updates_per_s']}/s)")
+    for key in ("reply_latency", "time_to_match", "relay_latency"):
+        print(f"{key:<15} {result[key]}")
+    for op, values in result["sqlite"].items():
+        print(f"sqlite {op:<12} {values}")
+    print(f"outcomes        {result['outcomes']}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
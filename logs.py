@@ -0,0 +1,119 @@
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+ROOT = "anonchat"
+SUBSYSTEMS = ("matchmaking", "relay", "db", "admin", "outbox", "webhook")
+
+# Поля LogRecord, которые не относятся к extra
+_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+def get_logger(subsystem):
+    return logging.getLogger(f"{ROOT}.{subsystem}")
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON; поля из extra= попадают в объект как есть"""
+
+    def format(self, record):
+        data = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS:
+                data[key] = value
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class DebugSampler(logging.Filter):
+    """Пропускает не больше `rate` DEBUG-записей в секунду на подсистему, остальные считает"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self.suppressed = 0
+        self._windows = {}  # logger -> [начало секунды, сколько пропустили]
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.rate <= 0:
+            return True
+        now = int(time.monotonic())
+        window = self._windows.get(record.name)
+        if window is None or window[0] != now:
+            window = self._windows[record.name] = [now, 0]
+        if window[1] >= self.rate:
+            self.suppressed += 1
+            return False
+        window[1] += 1
+        return True
+
+
+def _level(name):
+    """'debug' -> 10; неизвестное имя -> None (getLevelName вернул бы строку 'Level VERBOSE')"""
+    level = logging.getLevelName(name.strip().upper())
+    return level if isinstance(level, int) else None
+
+
+def parse_levels(spec, invalid=None):
+    """'matchmaking=DEBUG,relay=WARNING' -> {'matchmaking': 10, 'relay': 30}
+
+    Части с неизвестным уровнем пропускаются и дописываются в список `invalid`.
+    """
+    levels = {}
+    for part in filter(None, (p.strip() for p in (spec or "").split(","))):
+        name, _, level = part.partition("=")
+        number = _level(level)
+        if number is None:
+            if invalid is not None:
+                invalid.append(part)
+            continue
+        levels[name.strip()] = number
+    return levels
+
+
+def setup_logging(level="INFO", levels=None, json_format=False, debug_rate=20, stream=None):
+    """Настроить логирование: запись в поток идет из отдельного потока через QueueHandler.
+
+    Возвращает запущенный QueueListener, его нужно остановить при выходе.
+    """
+    handler = logging.StreamHandler(stream or sys.stderr)
+    if json_format:
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(DebugSampler(debug_rate))
+
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(queue_handler)
+    invalid = []
+    root_level = _level(str(level))
+    if root_level is None:
+        invalid.append(f"LOG_LEVEL={level}")
+        root_level = logging.INFO
+    root.setLevel(root_level)
+
+    for subsystem in SUBSYSTEMS:
+        get_logger(subsystem).setLevel(logging.NOTSET)
+    for subsystem, subsystem_level in parse_levels(levels, invalid).items():
+        get_logger(subsystem).setLevel(subsystem_level)
+
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    # Опечатка в уровне не должна ронять бота при импорте: подсистема остается на общем уровне
+    for part in invalid:
+        logging.getLogger(ROOT).warning("Неизвестный уровень логирования %r, оставлен уровень по умолчанию", part)
+    return listener
@@ -0,0 +1,100 @@
+import asyncio
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+
+from aiogram import BaseMiddleware
+
+# Ящики, которые держит текущая задача: вебхук берет ящик до общего семафора,
+# и MailboxMiddleware внутри той же задачи не должен ждать его второй раз.
+# Задачи, созданные внутри ящика, наследуют контекст - поэтому храним и владельца
+_held = ContextVar("mailboxes_held", default=(None, frozenset()))
+
+
+def update_user_id(update):
+    """user_id отправителя из сырого апдейта (dict от Telegram), None - если отправителя нет"""
+    for key, value in update.items():
+        if key != "update_id" and isinstance(value, dict):
+            sender = value.get("from") or value.get("user")
+            return sender.get("id") if isinstance(sender, dict) else None
+    return None
+
+
+class Mailboxes:
+    """Почтовые ящики пользователей: апдейты одного пользователя идут строго
+    по очереди, апдейты разных пользователей - параллельно.
+
+    Ящик (замок) создается при первом апдейте и удаляется, когда его никто
+    не ждет, поэтому память растет только с числом одновременно активных.
+    Повторный hold() того же ящика в той же задаче не ждет.
+    """
+
+    def __init__(self):
+        self._boxes = {}  # user_id -> [asyncio.Lock, сколько апдейтов держат или ждут ящик]
+
+    def __len__(self):
+        return len(self._boxes)
+
+    @asynccontextmanager
+    async def hold(self, user_id):
+        task = asyncio.current_task()
+        owner, held = _held.get()
+        if owner is not task:
+            held = frozenset()
+        elif user_id in held:
+            yield
+            return
+        box = self._boxes.get(user_id)
+        if box is None:
+            box = self._boxes[user_id] = [asyncio.Lock(), 0]
+        box[1] += 1
+        try:
+            async with box[0]:
+                token = _held.set((task, held | {user_id}))
+                try:
+                    yield
+                finally:
+                    _held.reset(token)
+        finally:
+            box[1] -= 1
+            if not box[1]:
+                del self._boxes[user_id]
+
+
+class MailboxMiddleware(BaseMiddleware):
+    """Внешний middleware на апдейты: обработчик выполняется внутри ящика отправителя"""
+
+    def __init__(self, mailboxes):
+        self.mailboxes = mailboxes
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+        async with self.mailboxes.hold(user.id):
+            return await handler(event, data)
+
+
+class PairLocks:
+    """Шардированные замки для переходов, меняющих состояние двух пользователей
+    (соединение и завершение чата).
+
+    Замки берутся по шардам user_id в порядке возрастания, поэтому встречные
+    переходы не блокируют друг друга навсегда. Держать их нужно только на
+    короткий участок с await (запись в базу), не на весь обработчик.
+    """
+
+    def __init__(self, shards=64):
+        self._locks = [asyncio.Lock() for _ in range(shards)]
+
+    @asynccontextmanager
+    async def hold(self, *user_ids):
+        shards = sorted({uid % len(self._locks) for uid in user_ids if uid is not None})
+        acquired = []
+        try:
+            for shard in shards:
+                await self._locks[shard].acquire()
+                acquired.append(shard)
+            yield
+        finally:
+            for shard in reversed(acquired):
+                self._locks[shard].release()
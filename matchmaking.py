@@ -0,0 +1,226 @@
+import itertools
+import time
+
+DEFAULT_FILTERS = {"min_rating": 0, "min_age": 14, "max_age": 100}
+
+# Правило рейтинга: пользователей с рейтингом от 4.0 не соединяем с партнерами ниже 3.5
+HIGH_RATING = 4.0
+HIGH_RATING_PARTNER_MIN = 3.5
+
+MAX_TAGS = 5  # интересов у одного пользователя
+MAX_TAG_LENGTH = 32
+TAG_SCAN = 64  # сколько ожидающих с одним тегом проверить при поиске по интересам
+
+
+def parse_tags(text):
+    """"Музыка, #игры,кино" -> ("музыка", "игры", "кино"): без повторов, не больше MAX_TAGS"""
+    tags = []
+    for tag in (text or "").replace("#", " ").replace(";", ",").split(","):
+        tag = " ".join(tag.split()).lower()[:MAX_TAG_LENGTH]
+        if tag and tag not in tags:
+            tags.append(tag)
+    return tuple(tags[:MAX_TAGS])
+
+
+def rating_key(rating):
+    """Рейтинг в корзину с шагом 0.1 (как в get_user_rating)"""
+    return int(round((rating or 0) * 10))
+
+
+def match_bounds(user_rating, filters=None):
+    """Фильтры ищущего -> (минимальная корзина рейтинга, min_age, max_age) для партнера"""
+    filters = filters or DEFAULT_FILTERS
+    min_rating = filters.get("min_rating", 0) or 0
+    if (user_rating or 0) >= HIGH_RATING:
+        min_rating = max(min_rating, HIGH_RATING_PARTNER_MIN)
+    min_key = rating_key(min_rating)
+    if min_key / 10 < min_rating:
+        min_key += 1
+    return min_key, filters.get("min_age", 14), filters.get("max_age", 100)
+
+
+class WaitingEntry:
+    __slots__ = ("user_id", "gender", "age", "filters", "rating", "seq", "since", "tags")
+
+    def __init__(self, user_id, gender, age, filters, rating, seq, since=None, tags=()):
+        self.user_id = user_id
+        self.gender = gender
+        self.age = age
+        self.filters = filters
+        self.rating = rating
+        self.seq = seq
+        self.since = since or time.time()  # когда встал в очередь (общее для всех воркеров время)
+        self.tags = frozenset(tags)
+
+    def __iter__(self):
+        # Совместимость со старым форматом очереди (user_id, gender, age, filters)
+        return iter((self.user_id, self.gender, self.age, self.filters))
+
+
+class MatchQueue:
+    """Очередь ожидания, разложенная по корзинам (возраст -> рейтинг -> пользователи).
+
+    Добавление, удаление и выход из поиска работают за O(1). Поиск пары
+    просматривает только корзины, подходящие под фильтры ищущего, и берет
+    из них того, кто ждет дольше всех.
+
+    Интересы лежат в обратном индексе тег -> ожидающие. Ищущий с тегами
+    получает партнера с наибольшим пересечением тегов; стоимость зависит от
+    числа его тегов, а не от длины очереди. Ожидающие с тегами первые
+    interest_timeout секунд достаются только тем, у кого есть общие теги.
+    """
+
+    def __init__(self, interest_timeout=0):
+        self.interest_timeout = interest_timeout
+        self._entries = {}  # user_id -> WaitingEntry (в порядке постановки)
+        self._by_age = {}  # age -> {(rating_key, есть ли теги) -> {user_id: seq}}
+        self._by_tag = {}  # тег -> {user_id: None} в порядке постановки
+        self._seq = itertools.count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, user_id):
+        return user_id in self._entries
+
+    def __iter__(self):
+        return iter(list(self._entries.values()))
+
+    def get(self, user_id):
+        return self._entries.get(user_id)
+
+    def add(self, user_id, gender, age, filters, rating=0, tags=(), since=None):
+        """Поставить в очередь. Повторная постановка не меняет место в очереди.
+        since - когда встал в очередь, если восстанавливаем ее после перезапуска"""
+        if user_id in self._entries:
+            return False
+        entry = WaitingEntry(user_id, gender, age or 0, filters, rating or 0, next(self._seq), since, tags)
+        self._entries[user_id] = entry
+        self._bucket(entry, create=True)[user_id] = entry.seq
+        for tag in entry.tags:
+            self._by_tag.setdefault(tag, {})[user_id] = None
+        return True
+
+    def remove(self, user_id):
+        """Убрать из очереди, вернуть запись или None"""
+        entry = self._entries.pop(user_id, None)
+        if entry is None:
+            return None
+        self._unbucket(entry)
+        for tag in entry.tags:
+            posting = self._by_tag[tag]
+            del posting[user_id]
+            if not posting:
+                del self._by_tag[tag]
+        return entry
+
+    def update_rating(self, user_id, rating):
+        """Переложить ожидающего в другую корзину после новой оценки, не меняя его места в очереди"""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return
+        if rating_key(entry.rating) == rating_key(rating):
+            entry.rating = rating
+            return
+        self._unbucket(entry)
+        entry.rating = rating
+        # find смотрит только начало корзины, поэтому корзина должна остаться упорядоченной по seq:
+        # снимаем с конца тех, кто встал позже, и возвращаем их после перекладываемого
+        bucket = self._bucket(entry, create=True)
+        later = []
+        while bucket:
+            uid, seq = bucket.popitem()
+            if seq < entry.seq:
+                bucket[uid] = seq
+                break
+            later.append((uid, seq))
+        bucket[user_id] = entry.seq
+        bucket.update(reversed(later))
+
+    def find(self, user_id, user_rating, filters=None, tags=(), plain=True):
+        """Найти подходящего партнера для user_id, не убирая его из очереди.
+
+        С tags сначала ищем по общим интересам; plain=False - только по ним.
+        """
+        min_key, min_age, max_age = match_bounds(user_rating, filters)
+        if tags:
+            entry = self._find_by_tags(user_id, min_key, min_age, max_age, tags)
+            if entry is not None or not plain:
+                return entry
+        # Ожидающие с тегами, которые встали в очередь позже cutoff, ждут общих интересов
+        cutoff = time.time() - self.interest_timeout if self.interest_timeout and self._by_tag else None
+
+        best_uid, best_seq = None, None
+        if max_age - min_age + 1 <= len(self._by_age):
+            ages = (self._by_age.get(a) for a in range(min_age, max_age + 1))
+        else:
+            ages = (r for a, r in self._by_age.items() if min_age <= a <= max_age)
+        for ratings in ages:
+            if not ratings:
+                continue
+            for (key, tagged), bucket in ratings.items():
+                if key < min_key:
+                    continue
+                for uid, seq in bucket.items():
+                    if uid == user_id:
+                        continue
+                    if tagged and cutoff is not None and self._entries[uid].since > cutoff:
+                        break  # дальше в корзине встали еще позже
+                    if best_seq is None or seq < best_seq:
+                        best_uid, best_seq = uid, seq
+                    break
+        return self._entries[best_uid] if best_uid is not None else None
+
+    def _find_by_tags(self, user_id, min_key, min_age, max_age, tags):
+        """Подходящий под фильтры ожидающий с наибольшим числом общих тегов (при равенстве - кто дольше ждет).
+
+        По каждому тегу смотрим TAG_SCAN самых давних ожидающих, поэтому обычно
+        время зависит от числа тегов ищущего, а не от размера очереди. Если
+        подходящего по фильтрам еще не нашлось, тег просматривается до конца:
+        ограничение не должно прятать единственного подходящего партнера.
+        """
+        tags = frozenset(tags)
+        best, best_overlap = None, 0
+        for tag in sorted(tags, key=lambda t: len(self._by_tag.get(t, ()))):
+            for scanned, uid in enumerate(self._by_tag.get(tag, ())):
+                if scanned >= TAG_SCAN and best is not None:
+                    break
+                entry = self._entries[uid]
+                if (uid == user_id or not min_age <= entry.age <= max_age
+                        or rating_key(entry.rating) < min_key):
+                    continue
+                overlap = len(entry.tags & tags)
+                if overlap > best_overlap or (overlap == best_overlap and entry.seq < best.seq):
+                    best, best_overlap = entry, overlap
+            if best_overlap == len(tags):
+                break  # больше общих тегов не бывает
+        return best
+
+    def pop_match(self, user_id, user_rating, filters=None, tags=(), plain=True):
+        """Найти партнера и атомарно убрать его из очереди"""
+        entry = self.find(user_id, user_rating, filters, tags, plain)
+        if entry is not None:
+            self.remove(entry.user_id)
+        return entry
+
+    def _unbucket(self, entry):
+        ratings = self._by_age[entry.age]
+        key = (rating_key(entry.rating), bool(entry.tags))
+        bucket = ratings[key]
+        del bucket[entry.user_id]
+        if not bucket:
+            del ratings[key]
+            if not ratings:
+                del self._by_age[entry.age]
+
+    def _bucket(self, entry, create=False):
+        ratings = self._by_age.get(entry.age)
+        if ratings is None:
+            if not create:
+                return None
+            ratings = self._by_age[entry.age] = {}
+        key = (rating_key(entry.rating), bool(entry.tags))
+        bucket = ratings.get(key)
+        if bucket is None and create:
+            bucket = ratings[key] = {}
+        return bucket
@@ -0,0 +1,224 @@
+import bisect
+import functools
+import time
+from collections import deque
+
+from aiohttp import web
+
+# Границы корзин гистограмм по умолчанию, секунды
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+WAIT_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+RECENT = 1000  # последних значений на ряд для p50/p99 в /perf: корзины копятся с запуска и сглаживают свежее замедление
+
+
+def _labels_text(names, values, extra=()):
+    pairs = [f'{n}="{v}"' for n, v in zip(names, values)] + [f'{n}="{v}"' for n, v in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _fmt(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(n, "") for n in self.label_names)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(labels.get(n, "") for n in self.label_names), 0)
+
+    def render(self):
+        lines = self.header()
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_labels_text(self.label_names, key)} {_fmt(value)}")
+        return lines
+
+
+class Gauge(Metric):
+    """Значение считается в момент запроса: func() -> число или {значение метки: число}"""
+    type = "gauge"
+
+    def __init__(self, name, help, func, labels=()):
+        super().__init__(name, help, labels)
+        self.func = func
+
+    def render(self):
+        lines = self.header()
+        value = self.func()
+        if isinstance(value, dict):
+            for key, v in sorted(value.items()):
+                lines.append(f"{self.name}{_labels_text(self.label_names, (key,))} {_fmt(v)}")
+        else:
+            lines.append(f"{self.name} {_fmt(value)}")
+        return lines
+
+
+class Histogram(Metric):
+    """window > 0 - хранить еще последние window значений каждого ряда (recent())"""
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, labels=(), window=0):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self.window = window
+        self._series = {}  # labels -> [counts по корзинам + Inf, sum, count, последние значения или None]
+
+    def observe(self, value, **labels):
+        self._observe(tuple([labels.get(n, "") for n in self.label_names]), value)
+
+    def _observe(self, key, value):
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0,
+                                          deque(maxlen=self.window) if self.window else None]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+        if series[3] is not None:
+            series[3].append(value)
+
+    def time(self, **labels):
+        """with histogram.time(...): - длительность блока"""
+        return _Timer(self, tuple([labels.get(n, "") for n in self.label_names]))
+
+    def count(self, **labels):
+        series = self._series.get(tuple(labels.get(n, "") for n in self.label_names))
+        return series[2] if series else 0
+
+    def recent(self):
+        """{значения меток: (всего с запуска, [последние значения по возрастанию])}"""
+        return {key: (series[2], sorted(series[3])) for key, series in self._series.items() if series[3]}
+
+    def render(self):
+        lines = self.header()
+        for key, (counts, total, count, _) in sorted(self._series.items()):
+            cumulative = 0
+            for le, c in zip(self.buckets + (float("inf"),), counts):
+                cumulative += c
+                labels = _labels_text(self.label_names, key, (("le", _fmt(le)),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _labels_text(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {_fmt(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class _Timer:
+    """Замер для Histogram.time: обычный класс дешевле генератора @contextmanager
+    на горячем пути (каждый обработчик и пересылка)"""
+    __slots__ = ("histogram", "key", "start")
+
+    def __init__(self, histogram, key):
+        self.histogram = histogram
+        self.key = key
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram._observe(self.key, time.perf_counter() - self.start)
+        return False
+
+
+def timed(histogram, **labels):
+    """Декоратор: записать длительность корутины в гистограмму"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, **labels)
+        return wrapper
+    return decorator
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# Метрики, которые пишут сами модули; датчики состояния регистрирует bot.py
+FIND_PAIR_SECONDS = REGISTRY.register(Histogram("anonchat_find_pair_seconds", "Длительность find_pair", window=RECENT))
+TIME_TO_MATCH_SECONDS = REGISTRY.register(
+    Histogram("anonchat_time_to_match_seconds", "Сколько партнер ждал в очереди до соединения", WAIT_BUCKETS)
+)
+RELAY_SECONDS = REGISTRY.register(
+    Histogram("anonchat_relay_seconds", "Пересылка сообщения в handle_chat_message", window=RECENT)
+)
+DB_QUERY_SECONDS = REGISTRY.register(
+    Histogram("anonchat_db_query_seconds", "Длительность запросов к SQLite", labels=("op",), window=RECENT)
+)
+HANDLER_SECONDS = REGISTRY.register(
+    Histogram("anonchat_handler_seconds", "Длительность обработчиков апдейтов (TimingMiddleware)", labels=("handler",), window=RECENT)
+)
+ACTION_SECONDS = REGISTRY.register(
+    Histogram("anonchat_action_seconds", "Ветки handle_text_message: обработчик состояния или кнопка меню", labels=("action",), window=RECENT)
+)
+TELEGRAM_SECONDS = REGISTRY.register(
+    Histogram("anonchat_telegram_seconds", "Запросы к Bot API без ожидания в очереди отправки", labels=("method",), window=RECENT)
+)
+LOOP_LAG_SECONDS = REGISTRY.register(
+    Histogram("anonchat_loop_lag_seconds", "Насколько позже обещанного просыпается цикл событий", window=RECENT)
+)
+LOOP_STALLS = REGISTRY.register(
+    Counter("anonchat_loop_stalls_total", "Случаи, когда один вызов держал цикл событий дольше PERF_SLOW_CALLBACK")
+)
+MATCHES = REGISTRY.register(
+    Counter("anonchat_matches_total", "Соединения по способу подбора: interests, filters, fallback", labels=("by",))
+)
+EXPIRED = REGISTRY.register(
+    Counter("anonchat_expired_total", "Истекшие сроки: очередь, неактивный чат, запрос оценки", labels=("kind",))
+)
+BROADCAST_MESSAGES = REGISTRY.register(
+    Counter("anonchat_broadcast_messages_total", "Сообщения рассылки админа: sent, failed", labels=("result",))
+)
+SEND_FAILURES = REGISTRY.register(
+    Counter("anonchat_send_failures_total", "Запросы к Telegram, завершившиеся ошибкой", labels=("lane",))
+)
+
+
+async def handle_metrics(request):
+    return web.Response(text=REGISTRY.render(), content_type="text/plain", charset="utf-8")
+
+
+def build_metrics_app():
+    """Отдельное приложение для /metrics, когда бот работает через polling"""
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    return app
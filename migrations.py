@@ -0,0 +1,145 @@
+"""Версионированные миграции схемы.
+
+Номер схемы хранится в PRAGMA user_version. Каждая миграция - список
+запросов (или async-функций от соединения, если нужен перенос данных),
+которые выполняются одной транзакцией вместе с повышением версии. Новые
+изменения схемы добавляются в конец MIGRATIONS, старые не редактируются.
+"""
+import ast
+
+from broadcast import RECIPIENTS_SQL, SCHEMA as BROADCAST_SCHEMA
+from export import CHUNK_SQL as EXPORT_CHUNK_SQL, FIRST_OPEN_CHAT_SQL, SCHEMA as EXPORT_SCHEMA, TABLES as EXPORT_TABLES
+from logs import get_logger
+from queries import CHAT_END_SQL, PROFILE_SQL, USERS_AFTER_SQL, USERS_BEFORE_SQL
+from stats import REBUILD as STATS_REBUILD, SCHEMA as STATS_SCHEMA
+
+logger = get_logger("db")
+
+BASE_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        banned INTEGER DEFAULT 0,
+        gender TEXT,
+        age INTEGER DEFAULT 0,
+        rating REAL DEFAULT 0.0,
+        rating_count INTEGER DEFAULT 0,
+        interests TEXT,
+        filters TEXT,
+        created_at TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS admin_actions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        admin_id INTEGER,
+        target_user INTEGER,
+        action TEXT,
+        ts TEXT DEFAULT CURRENT_TIMESTAMP
+    )""",
+    """CREATE TABLE IF NOT EXISTS ratings (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        from_user INTEGER,
+        to_user INTEGER,
+        rating INTEGER,
+        ts TEXT DEFAULT CURRENT_TIMESTAMP
+    )""",
+    """CREATE TABLE IF NOT EXISTS chats (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user1 INTEGER,
+        user2 INTEGER,
+        start_time TEXT,
+        end_time TEXT,
+        duration INTEGER DEFAULT 0
+    )""",
+)
+
+async def _filters_to_columns(conn):
+    """Перенести фильтры из текста str(dict) в колонки; literal_eval вместо eval"""
+    cur = await conn.execute("SELECT user_id, filters FROM users WHERE filters IS NOT NULL")
+    rows = await cur.fetchall()
+    await cur.close()
+    updates = []
+    for user_id, text in rows:
+        try:
+            filters = ast.literal_eval(text)
+        except (ValueError, SyntaxError):
+            continue
+        if isinstance(filters, dict):
+            updates.append((filters.get("min_rating"), filters.get("min_age"), filters.get("max_age"), user_id))
+    await conn.executemany(
+        "UPDATE users SET filter_min_rating=?, filter_min_age=?, filter_max_age=?, filters=NULL WHERE user_id=?",
+        updates
+    )
+
+
+# (версия, описание, запросы). Базы, созданные до миграций, имеют версию 0,
+# поэтому первые шаги написаны через IF NOT EXISTS.
+MIGRATIONS = (
+    (1, "базовые таблицы", BASE_SCHEMA),
+    (2, "счетчики статистики", STATS_SCHEMA + STATS_REBUILD),
+    (3, "фильтры поиска в колонках", (
+        "ALTER TABLE users ADD COLUMN filter_min_rating REAL",
+        "ALTER TABLE users ADD COLUMN filter_min_age INTEGER",
+        "ALTER TABLE users ADD COLUMN filter_max_age INTEGER",
+        _filters_to_columns,
+    )),
+    (4, "рассылки админа", BROADCAST_SCHEMA),
+    (5, "водяные знаки выгрузки", EXPORT_SCHEMA),
+)
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# Запросы горячего пути с примерными параметрами - те же константы, что выполняют
+# bot.py, broadcast.py и export.py: ни один не должен читать
+# растущую таблицу целиком: bot.py проверяет это при старте (check_plans), планы
+# показывает python bench.py plans. Вставки без WHERE не проверяем
+HOT_QUERIES = (
+    (PROFILE_SQL, (1,)),
+    (USERS_AFTER_SQL, (0, 1, 11)),
+    (USERS_BEFORE_SQL, (100, 1, 11)),
+    (CHAT_END_SQL, ("", 0, 1)),
+    (RECIPIENTS_SQL, (0, 500)),
+    # Выгрузка (export.py) не в горячем пути, но тоже не должна проходить таблицы целиком
+    (EXPORT_CHUNK_SQL.format(columns=", ".join(EXPORT_TABLES["chats"]), table="chats"), (0, 100, 10_000)),
+    (FIRST_OPEN_CHAT_SQL, (0, "2024-01-01")),
+)
+
+async def migrate(db):
+    """Довести схему до SCHEMA_VERSION, вернуть (было, стало).
+
+    BEGIN IMMEDIATE берет блокировку записи до чтения версии, поэтому
+    несколько воркеров, стартующих одновременно, не выполнят миграцию дважды.
+    """
+    async with db.transaction() as conn:
+        await conn.execute("BEGIN IMMEDIATE")
+        cur = await conn.execute("PRAGMA user_version")
+        (current,) = await cur.fetchone()
+        await cur.close()
+        for version, description, statements in MIGRATIONS:
+            if version <= current:
+                continue
+            for step in statements:
+                if callable(step):
+                    await step(conn)
+                else:
+                    await conn.execute(step)
+            await conn.execute(f"PRAGMA user_version={version}")
+            logger.info("Миграция %s: %s", version, description)
+    return current, max(current, SCHEMA_VERSION)
+
+
+async def full_scans(db, queries=HOT_QUERIES):
+    """Запросы, в плане которых есть полный проход (SCAN) по таблице или индексу -> [(sql, строка плана)]"""
+    found = []
+    for sql, params in queries:
+        for row in await db.fetchall(f"EXPLAIN QUERY PLAN {sql}", params):
+            detail = row[-1]
+            if detail.startswith("SCAN ") and not detail.startswith("SCAN json_each"):
+                found.append((sql, detail))
+    return found
+
+
+async def check_plans(db, queries=HOT_QUERIES):
+    """Упасть, если схема не покрывает индексом какой-то из горячих запросов"""
+    scans = await full_scans(db, queries)
+    if scans:
+        raise RuntimeError("Полный проход по таблице в горячих запросах: "
+                           + "; ".join(f"{detail}: {' '.join(sql.split())}" for sql, detail in scans))
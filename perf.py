@@ -0,0 +1,210 @@
+"""Профилирование работающего бота.
+
+TimingMiddleware меряет каждый обработчик апдейта (гистограмма
+anonchat_handler_seconds с меткой handler). LoopMonitor раз в interval
+секунд меряет задержку цикла событий, а его поток-сторож, если цикл не
+отвечает дольше slow секунд, снимает стек потока цикла: в лог попадает
+вызов, который его держит. Профиль по команде админа - cProfile (точные
+счетчики вызовов, но замедляет бота) или выборка стеков из отдельного
+потока (почти бесплатна, формат свернутых стеков для flamegraph).
+
+Сторож и выборка работают между шагами GIL: вызов на C, который не
+отпускает GIL, виден только после своего окончания - по задержке цикла.
+"""
+import asyncio
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime
+
+from aiogram import BaseMiddleware
+
+from logs import get_logger
+from metrics import HANDLER_SECONDS, LOOP_LAG_SECONDS, LOOP_STALLS
+
+logger = get_logger("perf")
+
+STACK_DEPTH = 8  # кадров стека в отчете о блокировке
+
+
+class TimingMiddleware(BaseMiddleware):
+    """Внутренний middleware на message/callback_query: время обработчика по имени функции"""
+
+    async def __call__(self, handler, event, data):
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, handler=data["handler"].callback.__name__)
+
+
+def _where(code, line=None):
+    where = f"{os.path.basename(code.co_filename)}:{code.co_name}"
+    return f"{where}:{line}" if line else where
+
+
+def _stack(frame, depth=STACK_DEPTH):
+    """Кадры от внешнего к текущему, последние depth"""
+    frames = []
+    while frame is not None and len(frames) < depth:
+        frames.append(_where(frame.f_code, frame.f_lineno))
+        frame = frame.f_back
+    return list(reversed(frames))
+
+
+class LoopMonitor:
+    """Задержка цикла событий и блокирующие вызовы дольше slow секунд"""
+
+    def __init__(self, interval=0.05, slow=0.1, keep=10):
+        self.interval = interval
+        self.slow = slow
+        self.stalls = deque(maxlen=keep)  # (когда, секунд, [кадры стека])
+        self._beat = time.monotonic()  # последнее пробуждение задачи в цикле
+        self._stack = None  # стек, снятый сторожем во время текущей блокировки
+        self._thread_id = None
+        self._task = None
+        self._watchdog = None
+        self._stopping = threading.Event()
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stopping.clear()
+        self._task = asyncio.create_task(self._run())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._stopping.set()
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        await asyncio.to_thread(self._watchdog.join)
+        self._task = self._watchdog = None
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - started - self.interval)
+            self._beat = time.monotonic()
+            LOOP_LAG_SECONDS.observe(lag)
+            stack, self._stack = self._stack, None
+            if lag >= self.slow:
+                LOOP_STALLS.inc()
+                self.stalls.append((time.time() - lag, lag, stack))
+                logger.warning("Цикл событий был занят %.0f мс: %s", lag * 1e3,
+                               " <- ".join(reversed(stack)) if stack else "стек не снят")
+
+    def _watch(self):
+        """Поток-сторож: цикл не просыпался дольше interval + slow - снять его стек"""
+        seen = None
+        while not self._stopping.wait(self.slow / 2):
+            beat = self._beat
+            if beat != seen and time.monotonic() - beat > self.interval + self.slow:
+                seen = beat  # одна блокировка - один стек, снятый как можно раньше
+                frame = sys._current_frames().get(self._thread_id)
+                if frame is not None:
+                    self._stack = _stack(frame)
+
+
+# --- ПРОФИЛЬ ПО КОМАНДЕ ---
+async def cprofile(seconds, limit=40):
+    """cProfile потока цикла на seconds секунд -> текстовый отчет pstats"""
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+    out = io.StringIO()
+    out.write(f"cProfile, {seconds:g} с, {datetime.now():%Y-%m-%d %H:%M:%S}\n")
+    stats = pstats.Stats(profiler, stream=out).strip_dirs()
+    for order in ("cumulative", "tottime"):
+        out.write(f"\n=== по {order} ===\n")
+        stats.sort_stats(order).print_stats(limit)
+    return out.getvalue()
+
+
+def sample_stacks(thread_id, seconds, interval=0.002):
+    """Выборка стеков потока раз в interval секунд -> Counter свернутых стеков "внешний;...;текущий".
+    Вызывать из другого потока (asyncio.to_thread)"""
+    folded = Counter()
+    deadline = time.monotonic() + seconds
+    # GIL переходит к ждущему потоку раз в switchinterval (5 мс), а раньше - только на
+    # select цикла: без этого выборка видела бы простой там, где были короткие обработчики
+    switch = sys.getswitchinterval()
+    sys.setswitchinterval(min(switch, interval / 10))
+    try:
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            names = []
+            while frame is not None:
+                names.append(_where(frame.f_code))
+                frame = frame.f_back
+            if names:
+                folded[";".join(reversed(names))] += 1
+            time.sleep(interval)
+    finally:
+        sys.setswitchinterval(switch)
+    return folded
+
+
+async def sample(seconds, interval=0.002, limit=30):
+    """Выборочный профиль потока цикла на seconds секунд -> текстовый отчет.
+    Сверху - функции по собственному и полному времени, ниже - свернутые стеки
+    (flamegraph.pl, speedscope.app). Простой цикл событий - это select в selectors"""
+    folded = await asyncio.to_thread(sample_stacks, threading.get_ident(), seconds, interval)
+    total = sum(folded.values()) or 1
+    own, inclusive = Counter(), Counter()
+    for stack, count in folded.items():
+        names = stack.split(";")
+        own[names[-1]] += count
+        for name in set(names):
+            inclusive[name] += count
+    out = io.StringIO()
+    out.write(f"Выборка стеков, {seconds:g} с, раз в {interval * 1e3:g} мс, {total} выборок, "
+              f"{datetime.now():%Y-%m-%d %H:%M:%S}\n")
+    for title, counter in (("собственное время", own), ("с вложенными вызовами", inclusive)):
+        out.write(f"\n=== {title} ===\n")
+        for name, count in counter.most_common(limit):
+            out.write(f"{count / total:6.1%}  {name}\n")
+    out.write("\n=== свернутые стеки ===\n")
+    for stack, count in folded.most_common():
+        out.write(f"{stack} {count}\n")
+    return out.getvalue()
+
+
+# --- ОТЧЕТ /perf ---
+def _ms(seconds):
+    return f"{seconds * 1e3:.1f}"
+
+
+def format_histogram(title, histogram, limit=15):
+    """Строки отчета: p50/p99/max по последним значениям каждого ряда, медленные сверху"""
+    rows = []
+    for key, (total, values) in histogram.recent().items():
+        p50 = values[len(values) // 2]
+        p99 = values[min(len(values) - 1, int(len(values) * 0.99))]
+        label = "/".join(key)
+        rows.append((p99, f"{label + ': ' if label else ''}p50 {_ms(p50)} p99 {_ms(p99)} max {_ms(values[-1])} мс (n={total})"))
+    if not rows:
+        return []
+    rows.sort(reverse=True)
+    return [title] + [line for _, line in rows[:limit]]
+
+
+def format_stalls(monitor):
+    lines = []
+    for when, seconds, stack in reversed(monitor.stalls):
+        lines.append(f"{datetime.fromtimestamp(when):%H:%M:%S} {_ms(seconds)} мс: "
+                     + (" <- ".join(reversed(stack[-3:])) if stack else "стек не снят"))
+    return lines
@@ -0,0 +1,39 @@
+"""Запросы к users, chats, ratings и admin_actions, которые выполняет bot.py.
+
+Они вынесены сюда, чтобы migrations.HOT_QUERIES проверял планы тех же
+строк, что уходят в базу (python bench.py plans): измененный запрос или
+удаленный индекс сразу покажет полный проход по таблице.
+"""
+
+PROFILE_SQL = """SELECT banned, rating, rating_count, gender, age, filter_min_rating, filter_min_age, filter_max_age, interests
+    FROM users WHERE user_id=?"""
+
+SET_BANNED_SQL = "INSERT INTO users(user_id, banned) VALUES(?,?) ON CONFLICT(user_id) DO UPDATE SET banned=excluded.banned"
+
+SAVE_USER_SQL = """INSERT INTO users(user_id, gender, age, created_at) VALUES(?,?,?,?)
+    ON CONFLICT(user_id) DO UPDATE SET gender=excluded.gender, age=excluded.age"""
+
+# В базу - приращение, а не итог из кэша: профиль мог выпасть из кэша или устареть
+# до записи пачки, и тогда итог из кэша затер бы уже учтенные оценки
+ADD_RATING_SQL = """INSERT INTO users(user_id, rating, rating_count, created_at) VALUES(?,?,1,?)
+    ON CONFLICT(user_id) DO UPDATE SET rating=(COALESCE(rating, 0) * COALESCE(rating_count, 0) + excluded.rating) / (COALESCE(rating_count, 0) + 1),
+        rating_count=COALESCE(rating_count, 0) + 1"""
+
+LOG_RATING_SQL = "INSERT INTO ratings(from_user, to_user, rating) VALUES(?,?,?)"
+
+SAVE_FILTERS_SQL = """INSERT INTO users(user_id, filter_min_rating, filter_min_age, filter_max_age) VALUES(?,?,?,?)
+    ON CONFLICT(user_id) DO UPDATE SET filter_min_rating=excluded.filter_min_rating,
+        filter_min_age=excluded.filter_min_age, filter_max_age=excluded.filter_max_age"""
+
+SAVE_INTERESTS_SQL = """INSERT INTO users(user_id, interests) VALUES(?,?)
+    ON CONFLICT(user_id) DO UPDATE SET interests=excluded.interests"""
+
+CHAT_START_SQL = "INSERT INTO chats(user1, user2, start_time) VALUES(?,?,?)"
+
+CHAT_END_SQL = "UPDATE chats SET end_time=?, duration=? WHERE id=?"
+
+# Панель админа: keyset-пагинация по user_id (после / до курсора, без самого админа)
+USERS_AFTER_SQL = "SELECT user_id, rating, rating_count, banned FROM users WHERE user_id > ? AND user_id != ? ORDER BY user_id LIMIT ?"
+USERS_BEFORE_SQL = "SELECT user_id, rating, rating_count, banned FROM users WHERE user_id < ? AND user_id != ? ORDER BY user_id DESC LIMIT ?"
+
+ADMIN_ACTION_SQL = "INSERT INTO admin_actions(admin_id, target_user, action) VALUES(?,?,?)"
@@ -0,0 +1,60 @@
+import asyncio
+
+from aiogram.types import InputMediaAudio, InputMediaDocument, InputMediaPhoto, InputMediaVideo
+
+
+def to_input_media(msg):
+    """Сообщение из альбома -> InputMedia для send_media_group (с подписью и разметкой)"""
+    caption = {"caption": msg.caption, "caption_entities": msg.caption_entities}
+    if msg.photo:
+        return InputMediaPhoto(media=msg.photo[-1].file_id, has_spoiler=msg.has_media_spoiler, **caption)
+    if msg.video:
+        return InputMediaVideo(media=msg.video.file_id, has_spoiler=msg.has_media_spoiler, **caption)
+    if msg.document:
+        return InputMediaDocument(media=msg.document.file_id, **caption)
+    if msg.audio:
+        return InputMediaAudio(media=msg.audio.file_id, **caption)
+    return None
+
+
+class AlbumBuffer:
+    """Копит сообщения одного альбома (media_group_id) и отдает их одной пачкой.
+
+    Telegram присылает альбом отдельными апдейтами почти одновременно, поэтому
+    ждем `delay` секунд после первого сообщения и вызываем
+    send(sender_id, partner_id, messages) один раз на весь альбом.
+    """
+
+    def __init__(self, send, delay=0.5):
+        self._send = send
+        self.delay = delay
+        self._albums = {}  # media_group_id -> [sender_id, partner_id, messages, timer]
+        self._tasks = set()
+
+    def __len__(self):
+        return len(self._albums)
+
+    def add(self, msg, partner_id):
+        album = self._albums.get(msg.media_group_id)
+        if album is None:
+            timer = asyncio.get_running_loop().call_later(self.delay, self._flush, msg.media_group_id)
+            album = self._albums[msg.media_group_id] = [msg.from_user.id, partner_id, [], timer]
+        album[2].append(msg)
+
+    def _flush(self, media_group_id):
+        album = self._albums.pop(media_group_id, None)
+        if album is None:
+            return
+        sender_id, partner_id, messages, timer = album
+        timer.cancel()
+        messages.sort(key=lambda m: m.message_id)
+        task = asyncio.create_task(self._send(sender_id, partner_id, messages))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def stop(self):
+        """Отправить недособранные альбомы и дождаться отправки"""
+        for media_group_id in list(self._albums):
+            self._flush(media_group_id)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
@@ -0,0 +1,298 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+from logs import get_logger
+from metrics import SEND_FAILURES, TELEGRAM_SECONDS
+
+logger = get_logger("outbox")
+
+# Полосы приоритета: чем меньше число, тем раньше уходит сообщение
+RELAY = 0  # пересылка сообщений между собеседниками
+NOTICE = 1  # системные уведомления, меню, оценки
+BULK = 2  # рассылка админа
+LANES = {RELAY: "relay", NOTICE: "notice", BULK: "bulk"}
+
+send_priority = ContextVar("send_priority", default=NOTICE)
+
+
+@contextmanager
+def lane(priority):
+    """Все отправки внутри блока идут в указанную полосу"""
+    token = send_priority.set(priority)
+    try:
+        yield
+    finally:
+        send_priority.reset(token)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now=None):
+        """Сколько ждать до следующего токена"""
+        self._refill(now or time.monotonic())
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self, now=None):
+        self._refill(now or time.monotonic())
+        self.tokens -= 1
+
+    def full(self, now=None):
+        self._refill(now or time.monotonic())
+        return self.tokens >= self.capacity
+
+
+class _Job:
+    __slots__ = ("chat_id", "call", "priority", "seq", "future", "enqueued")
+
+    def __init__(self, chat_id, call, priority, seq, future):
+        self.chat_id = chat_id
+        self.call = call
+        self.priority = priority
+        self.seq = seq
+        self.future = future
+        self.enqueued = time.monotonic()
+
+
+class OutboundScheduler:
+    """Планировщик исходящих сообщений с учетом лимитов Telegram.
+
+    Общий token bucket (~30 сообщений/с на бота) и по одному на каждый чат.
+    Сообщения в один чат уходят строго по порядку постановки: у каждого чата
+    своя очередь FIFO. Полоса решает только, какой чат обслужить следующим:
+    чат, где ждет пересылка (RELAY), обгоняет чаты с одними уведомлениями
+    (NOTICE), но уведомление, поставленное в этот же чат раньше, уйдет раньше.
+    Чат, исчерпавший свой лимит, ждет в стороне и не задерживает остальные.
+    На RetryAfter планировщик ставит отправку на паузу и повторяет запрос.
+    """
+
+    def __init__(self, rate=30, chat_rate=1, chat_burst=5, max_retries=3):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(rate, rate)
+        self._chats = {}  # chat_id -> TokenBucket
+        self._pending = {}  # chat_id -> deque[_Job] в порядке постановки
+        self._ready = []  # куча (полоса, seq, chat_id) чатов, которые можно обслужить
+        self._keys = {}  # chat_id -> актуальная запись этого чата в куче (остальные устарели)
+        self._throttled = set()  # чаты, ждущие своего лимита (call_later вернет их в кучу)
+        self._wakeup = asyncio.Event()
+        self._locks = {}  # chat_id -> [Lock, сколько отправок в полете]
+        self._paused_until = 0.0
+        self._seq = itertools.count()
+        self._task = None
+        self._inflight = set()
+        # Метрики
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.delay_sum = {p: 0.0 for p in LANES}
+        self.delay_count = {p: 0 for p in LANES}
+        self.delay_max = {p: 0.0 for p in LANES}
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._dispatch())
+
+    async def stop(self):
+        """Дождаться уже отправляемых сообщений и остановить диспетчер.
+        Ждавшие в очереди отменяются, иначе их отправители висели бы до конца процесса"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+        for jobs in self._pending.values():
+            for job in jobs:
+                job.future.cancel()
+        self._pending.clear()
+        self._ready.clear()
+        self._keys.clear()
+        self._throttled.clear()
+
+    async def send(self, chat_id, call, priority=None):
+        """Поставить запрос в очередь; call() должен вернуть корутину запроса к API"""
+        if self._task is None:
+            return await call()
+        if priority is None:
+            priority = send_priority.get()
+        future = asyncio.get_running_loop().create_future()
+        job = _Job(chat_id, call, priority, next(self._seq), future)
+        jobs = self._pending.get(chat_id)
+        if jobs is None:
+            jobs = self._pending[chat_id] = deque()
+        jobs.append(job)
+        key = self._keys.get(chat_id)
+        if chat_id not in self._throttled and (key is None or priority < key[0]):
+            self._push(chat_id, (priority, jobs[0].seq))  # срочное сообщение поднимает весь чат
+        return await future
+
+    def depth(self):
+        return sum(len(jobs) for jobs in self._pending.values())
+
+    def stats(self):
+        return {
+            "queue_depth": self.depth(),
+            "lanes": {
+                name: {
+                    "sent": self.delay_count[p],
+                    "avg_delay_ms": round(self.delay_sum[p] / self.delay_count[p] * 1000, 1) if self.delay_count[p] else 0.0,
+                    "max_delay_ms": round(self.delay_max[p] * 1000, 1),
+                }
+                for p, name in LANES.items()
+            },
+            "throttled_chats": len(self._throttled),
+            "in_flight": len(self._inflight),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retries": self.retries,
+        }
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _push(self, chat_id, key):
+        self._keys[chat_id] = key
+        heapq.heappush(self._ready, (*key, chat_id))
+        self._wakeup.set()
+
+    def _schedule(self, chat_id):
+        """Вернуть чат с ожидающими сообщениями в кучу: полоса - самая срочная из его очереди"""
+        jobs = self._pending.get(chat_id)
+        if jobs:
+            self._push(chat_id, (min(job.priority for job in jobs), jobs[0].seq))
+
+    def _release(self, chat_id):
+        self._throttled.discard(chat_id)
+        self._schedule(chat_id)
+
+    def _throttle(self, chat_id, wait):
+        self._throttled.add(chat_id)
+        asyncio.get_running_loop().call_later(wait, self._release, chat_id)
+
+    async def _dispatch(self):
+        handled = 0
+        while True:
+            now = time.monotonic()
+            wait = max(self._global.delay(now), self._paused_until - now)
+            if wait > 0:
+                await asyncio.sleep(wait)  # чат выбираем после паузы: за нее могли прийти срочные
+            while not self._ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            priority, seq, chat_id = heapq.heappop(self._ready)
+            if self._keys.get(chat_id) != (priority, seq):
+                continue  # чат поднят в более срочную полосу или уже обслужен
+            del self._keys[chat_id]
+
+            bucket = self._chat_bucket(chat_id)
+            wait = bucket.delay()
+            if wait > 0:
+                self._throttle(chat_id, wait)
+                continue
+            jobs = self._pending[chat_id]
+            job = jobs.popleft()
+            self._global.consume()
+            bucket.consume()
+            if not jobs:
+                del self._pending[chat_id]
+            elif (wait := bucket.delay()) > 0:
+                self._throttle(chat_id, wait)
+            else:
+                self._schedule(chat_id)
+
+            task = asyncio.create_task(self._deliver(job))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+            handled += 1
+            if handled % 1000 == 0:
+                self._prune()
+
+    async def _deliver(self, job):
+        delay = time.monotonic() - job.enqueued
+        p = job.priority
+        self.delay_sum[p] = self.delay_sum.get(p, 0.0) + delay
+        self.delay_count[p] = self.delay_count.get(p, 0) + 1
+        self.delay_max[p] = max(self.delay_max.get(p, 0.0), delay)
+
+        entry = self._locks.get(job.chat_id)
+        if entry is None:
+            entry = self._locks[job.chat_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:  # отправки в один чат не обгоняют друг друга
+                for attempt in range(self.max_retries + 1):
+                    try:
+                        result = await job.call()
+                    except TelegramRetryAfter as e:
+                        if attempt == self.max_retries:
+                            raise
+                        self.retries += 1
+                        self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                        logger.warning("Flood control, пауза %s с (чат %s)", e.retry_after, job.chat_id)
+                        await asyncio.sleep(e.retry_after)
+                    else:
+                        break
+        except Exception as e:
+            self.failed += 1
+            SEND_FAILURES.inc(lane=LANES.get(p, str(p)))
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            self.sent += 1
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[job.chat_id]
+
+    def _prune(self):
+        now = time.monotonic()
+        for chat_id in [c for c, b in self._chats.items() if c not in self._pending and b.full(now)]:
+            del self._chats[chat_id]
+
+
+class OutboundMiddleware(BaseRequestMiddleware):
+    """Пропускает через планировщик все запросы к API, адресованные чату, и
+    меряет сам запрос (без ожидания в очереди) по методу API"""
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
+    async def __call__(self, make_request, bot, method):
+        async def request():
+            started = time.perf_counter()
+            try:
+                return await make_request(bot, method)
+            finally:
+                TELEGRAM_SECONDS.observe(time.perf_counter() - started, method=method.__api_method__)
+
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await request()
+        return await self.scheduler.send(chat_id, request)
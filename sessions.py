@@ -0,0 +1,161 @@
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+from filters import filters_from_row, filters_to_row
+from matchmaking import DEFAULT_FILTERS
+
+
+class Session:
+    """Состояние диалога одного пользователя одной записью вместо пяти словарей"""
+    __slots__ = ("gender", "age", "state", "filters", "awaiting_rating", "seen")
+
+    def __init__(self, seen):
+        self.gender = None
+        self.age = None
+        self.state = None
+        self.filters = None  # (min_rating, min_age, max_age) - кортеж компактнее словаря
+        self.awaiting_rating = None
+        self.seen = seen
+
+
+class SessionStore:
+    """Сессии недавно активных пользователей, ограниченные по числу (LRU) и времени (ttl).
+
+    touch() при каждом апдейте переносит сессию в конец; из начала вытесняются
+    те, кто давно не писал. Закрепленные сессии (pinned(user_id) - в чате, в
+    очереди, ждет оценки, состояние из pinned_states) не вытесняются. Вытесненную
+    сессию бот восстанавливает из таблицы users при следующем апдейте пользователя.
+    """
+
+    EVICT_STEPS = 8  # сколько записей из начала смотреть за один touch()
+
+    def __init__(self, maxsize=100_000, ttl=0, pinned=None, pinned_states=(), clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.pinned = pinned or (lambda user_id: False)
+        self.pinned_states = frozenset(pinned_states)
+        self.clock = clock
+        self.evicted = 0
+        self._data = OrderedDict()  # user_id -> Session, от давно активных к недавним
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, user_id):
+        return user_id in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def get(self, user_id):
+        return self._data.get(user_id)
+
+    def setdefault(self, user_id):
+        """Сессия пользователя, новая пустая - если ее нет (место в LRU не меняется)"""
+        session = self._data.get(user_id)
+        if session is None:
+            session = self._data[user_id] = Session(self.clock())
+        return session
+
+    def touch(self, user_id):
+        """Отметить апдейт пользователя и вытеснить устаревшие сессии -> Session"""
+        now = self.clock()
+        session = self.setdefault(user_id)
+        session.seen = now
+        self._data.move_to_end(user_id)
+        self.evict(now)
+        return session
+
+    def evict(self, now=None):
+        now = self.clock() if now is None else now
+        for _ in range(self.EVICT_STEPS):
+            if not self._data:
+                return
+            user_id, session = next(iter(self._data.items()))
+            over = self.maxsize and len(self._data) > self.maxsize
+            stale = self.ttl and now - session.seen > self.ttl
+            if not over and not stale:
+                return
+            if session.awaiting_rating is not None or session.state in self.pinned_states or self.pinned(user_id):
+                self._data.move_to_end(user_id)  # занятых не трогаем, смотрим следующего
+                continue
+            del self._data[user_id]
+            self.evicted += 1
+
+
+class SessionField(MutableMapping):
+    """Одно поле сессий как словарь user_id -> значение (user_gender, user_state, ...)"""
+
+    def __init__(self, sessions, field, encode=None, decode=None):
+        self._sessions = sessions
+        self._field = field
+        self._encode = encode
+        self._decode = decode
+
+    def __getitem__(self, user_id):
+        session = self._sessions.get(user_id)
+        value = getattr(session, self._field) if session is not None else None
+        if value is None:
+            raise KeyError(user_id)
+        return self._decode(value) if self._decode else value
+
+    def __setitem__(self, user_id, value):
+        if self._encode:
+            value = self._encode(value)
+        setattr(self._sessions.setdefault(user_id), self._field, value)
+
+    def __delitem__(self, user_id):
+        session = self._sessions.get(user_id)
+        if session is None or getattr(session, self._field) is None:
+            raise KeyError(user_id)
+        setattr(session, self._field, None)
+
+    def __contains__(self, user_id):
+        session = self._sessions.get(user_id)
+        return session is not None and getattr(session, self._field) is not None
+
+    def __iter__(self):
+        field = self._field
+        return (user_id for user_id, session in list(self._sessions._data.items())
+                if getattr(session, field) is not None)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def columns(self):
+        """Ключи и значения двумя списками за один проход по сессиям (для снимка журнала).
+        Одинаковые значения декодируются один раз и общие у всех - их не изменять"""
+        field, decode = self._field, self._decode
+        keys, values = [], []
+        for user_id, session in self._sessions._data.items():
+            value = getattr(session, field)
+            if value is not None:
+                keys.append(user_id)
+                values.append(value)
+        if decode:
+            decoded = {}
+            values = [decoded[value] if value in decoded else decoded.setdefault(value, decode(value)) for value in values]
+        return keys, values
+
+    def items(self):
+        return list(zip(*self.columns()))
+
+
+DEFAULT_ROW = filters_to_row(DEFAULT_FILTERS)
+
+
+def _encode_filters(filters):
+    row = filters_to_row(filters)
+    return DEFAULT_ROW if row == DEFAULT_ROW else row  # у большинства фильтры по умолчанию - один общий кортеж
+
+
+def session_fields(sessions):
+    """Словари состояния поверх сессий: имя из state.NAMESPACES -> SessionField"""
+    return {
+        "user_gender": SessionField(sessions, "gender"),
+        "user_age": SessionField(sessions, "age"),
+        "user_state": SessionField(sessions, "state"),
+        "user_filters": SessionField(sessions, "filters", _encode_filters, lambda row: filters_from_row(*row)),
+        "awaiting_rating": SessionField(sessions, "awaiting_rating"),
+    }
@@ -0,0 +1,395 @@
+import asyncio
+import json
+import sqlite3
+import time
+from collections.abc import MutableMapping
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+
+from journal import UNJOURNALED, JournaledMap, JournaledQueue
+from matchmaking import MatchQueue, WaitingEntry, match_bounds, rating_key
+from sessions import SessionStore, session_fields
+
+# Словари состояния, которые хранилище отдает боту
+NAMESPACES = (
+    "active_chats",  # user_id -> partner_id
+    "user_gender",  # user_id -> "M"/"F"
+    "user_age",  # user_id -> возраст
+    "user_state",  # user_id -> состояние диалога
+    "awaiting_rating",  # user_id -> partner_id (кого нужно оценить)
+    "user_filters",  # user_id -> {"min_rating", "min_age", "max_age"}
+    "current_chat",  # user_id -> (id строки chats, start_time)
+    "chat_activity",  # user_id -> время последнего сообщения в чате
+    "rating_since",  # user_id -> когда попросили оценить собеседника
+)
+
+# Состояния регистрации: пол и возраст еще не записаны в users, поэтому вытесненную
+# сессию не из чего восстановить - такие сессии не вытесняются
+REGISTRATION_STATES = ("choosing_gender", "choosing_age")
+
+
+class MemoryStateStore:
+    """Состояние в памяти процесса: самый быстрый вариант для одного воркера.
+
+    Пол, возраст, состояние, фильтры и ожидание оценки лежат в сессиях
+    (sessions.py), ограниченных session_size записями и session_ttl секундами
+    простоя; остальные словари - обычные dict. С journal (journal.py) все
+    изменения пишутся в журнал, и recover() поднимает состояние после перезапуска.
+    """
+
+    def __init__(self, session_size=0, session_ttl=0, interest_timeout=0, journal=None):
+        self.waiting_users = MatchQueue(interest_timeout)
+        self.sessions = SessionStore(session_size, session_ttl, pinned=self._pinned, pinned_states=REGISTRATION_STATES)
+        fields = session_fields(self.sessions)
+        for name in NAMESPACES:
+            setattr(self, name, fields[name] if name in fields else {})
+        self.journal = journal
+        if journal is not None:
+            journal.bind({name: getattr(self, name) for name in NAMESPACES}, self.waiting_users)
+            self.waiting_users = JournaledQueue(self.waiting_users, journal)
+            for name in NAMESPACES:
+                if name not in UNJOURNALED:
+                    setattr(self, name, JournaledMap(getattr(self, name), name, journal))
+
+    def recover(self):
+        """Поднять состояние из снимка и журнала -> (записей снимка, операций журнала)"""
+        return self.journal.recover() if self.journal is not None else (0, 0)
+
+    def _pinned(self, user_id):
+        return user_id in self.active_chats or user_id in self.waiting_users
+
+    def locked(self):
+        """Как у SqliteStateStore; в одном процессе операции и так атомарны"""
+        return nullcontext()
+
+    def match_or_wait(self, user_id, gender, age, filters, rating, tags=(), plain=True):
+        """Одним шагом: забрать партнера и записать пару или встать в очередь.
+
+        tags - интересы ищущего; plain=False - только партнер с общими интересами.
+        -> (партнер, None) | (None, True) - ждет в очереди | (None, False) - уже в чате
+        """
+        if user_id in self.active_chats:
+            return None, False
+        partner = self.waiting_users.pop_match(user_id, rating, filters, tags, plain)
+        if partner is None:
+            self.waiting_users.add(user_id, gender, age, filters, rating, tags)
+            return None, True
+        self.waiting_users.remove(user_id)
+        self.active_chats[user_id] = partner.user_id
+        self.active_chats[partner.user_id] = user_id
+        return partner, None
+
+    def unpair(self, user_id):
+        """Разорвать пару, вернуть бывшего партнера или None"""
+        partner_id = self.active_chats.pop(user_id, None)
+        if partner_id is not None:
+            self.active_chats.pop(partner_id, None)
+        return partner_id
+
+    def close(self):
+        pass
+
+
+def _dump(value):
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+def _load(text):
+    value = json.loads(text)
+    return tuple(value) if isinstance(value, list) else value
+
+
+class SqliteMap(MutableMapping):
+    """Словарь поверх таблицы kv; ключи и значения хранятся в JSON.
+
+    Возвращаемые значения - копии: чтобы изменить вложенный словарь,
+    его нужно записать обратно целиком.
+    """
+
+    def __init__(self, conn, ns):
+        self._conn = conn
+        self._ns = ns
+
+    def __getitem__(self, key):
+        row = self._conn.execute("SELECT value FROM kv WHERE ns=? AND key=?", (self._ns, _dump(key))).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return _load(row[0])
+
+    def __setitem__(self, key, value):
+        self._conn.execute(
+            "INSERT INTO kv(ns, key, value) VALUES(?,?,?) ON CONFLICT(ns, key) DO UPDATE SET value=excluded.value",
+            (self._ns, _dump(key), _dump(value))
+        )
+
+    def __delitem__(self, key):
+        cur = self._conn.execute("DELETE FROM kv WHERE ns=? AND key=?", (self._ns, _dump(key)))
+        if cur.rowcount == 0:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return self._conn.execute(
+            "SELECT 1 FROM kv WHERE ns=? AND key=?", (self._ns, _dump(key))
+        ).fetchone() is not None
+
+    def __iter__(self):
+        rows = self._conn.execute("SELECT key FROM kv WHERE ns=?", (self._ns,)).fetchall()
+        return (_load(row[0]) for row in rows)
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM kv WHERE ns=?", (self._ns,)).fetchone()[0]
+
+    def values(self):
+        rows = self._conn.execute("SELECT value FROM kv WHERE ns=?", (self._ns,)).fetchall()
+        return [_load(row[0]) for row in rows]
+
+    def items(self):
+        rows = self._conn.execute("SELECT key, value FROM kv WHERE ns=?", (self._ns,)).fetchall()
+        return [(_load(k), _load(v)) for k, v in rows]
+
+
+class SqliteMatchQueue:
+    """Очередь ожидания в общей базе; интерфейс как у MatchQueue"""
+
+    _COLUMNS = "user_id, gender, age, filters, rating, seq, since, tags"
+
+    def __init__(self, store, interest_timeout=0):
+        self._store = store
+        self._conn = store._conn
+        self.interest_timeout = interest_timeout
+
+    def _entry(self, row):
+        user_id, gender, age, filters, rating, seq, since, tags = row[:8]
+        return WaitingEntry(
+            user_id, gender, age, json.loads(filters) if filters else None, rating, seq, since,
+            json.loads(tags) if tags else ()
+        )
+
+    def _delete(self, user_id):
+        self._conn.execute("DELETE FROM waiting WHERE user_id=?", (user_id,))
+        self._conn.execute("DELETE FROM waiting_tags WHERE user_id=?", (user_id,))
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM waiting").fetchone()[0]
+
+    def __contains__(self, user_id):
+        return self._conn.execute("SELECT 1 FROM waiting WHERE user_id=?", (user_id,)).fetchone() is not None
+
+    def __iter__(self):
+        rows = self._conn.execute(f"SELECT {self._COLUMNS} FROM waiting ORDER BY seq").fetchall()
+        return iter([self._entry(row) for row in rows])
+
+    def get(self, user_id):
+        row = self._conn.execute(f"SELECT {self._COLUMNS} FROM waiting WHERE user_id=?", (user_id,)).fetchone()
+        return self._entry(row) if row else None
+
+    def add(self, user_id, gender, age, filters, rating=0, tags=(), since=None):
+        with self._store.immediate():
+            cur = self._conn.execute(
+                """INSERT OR IGNORE INTO waiting(user_id, gender, age, filters, rating, rating_key, since, tags)
+                VALUES(?,?,?,?,?,?,?,?)""",
+                (user_id, gender, age or 0, _dump(filters) if filters else None, rating or 0, rating_key(rating),
+                 since or time.time(), _dump(list(tags)) if tags else None)
+            )
+            added = cur.rowcount == 1
+            if added and tags:
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO waiting_tags(tag, user_id) VALUES(?,?)", [(tag, user_id) for tag in tags]
+                )
+        return added
+
+    def remove(self, user_id):
+        with self._store.immediate():
+            entry = self.get(user_id)
+            if entry is not None:
+                self._delete(user_id)
+        return entry
+
+    def update_rating(self, user_id, rating):
+        self._conn.execute(
+            "UPDATE waiting SET rating=?, rating_key=? WHERE user_id=?", (rating, rating_key(rating), user_id)
+        )
+
+    def find(self, user_id, user_rating, filters=None, tags=(), plain=True):
+        min_key, min_age, max_age = match_bounds(user_rating, filters)
+        if tags:
+            # Общие интересы: больше совпавших тегов, затем кто дольше ждет
+            columns = ", ".join(f"w.{column}" for column in self._COLUMNS.split(", "))
+            row = self._conn.execute(
+                f"""SELECT {columns}, COUNT(*) AS overlap FROM waiting_tags t JOIN waiting w ON w.user_id = t.user_id
+                WHERE t.tag IN ({",".join("?" * len(tags))})
+                  AND w.user_id != ? AND w.age BETWEEN ? AND ? AND w.rating_key >= ?
+                GROUP BY w.user_id ORDER BY overlap DESC, w.seq LIMIT 1""",
+                (*tags, user_id, min_age, max_age, min_key)
+            ).fetchone()
+            if row or not plain:
+                return self._entry(row) if row else None
+        # Ожидающие с тегами первые interest_timeout секунд ждут общих интересов
+        cutoff = time.time() - self.interest_timeout if self.interest_timeout else None
+        row = self._conn.execute(
+            f"""SELECT {self._COLUMNS} FROM waiting
+            WHERE user_id != ? AND age BETWEEN ? AND ? AND rating_key >= ?
+              AND (? IS NULL OR tags IS NULL OR since <= ?)
+            ORDER BY seq LIMIT 1""",
+            (user_id, min_age, max_age, min_key, cutoff, cutoff)
+        ).fetchone()
+        return self._entry(row) if row else None
+
+    def pop_match(self, user_id, user_rating, filters=None, tags=(), plain=True):
+        with self._store.immediate():
+            entry = self.find(user_id, user_rating, filters, tags, plain)
+            if entry is not None:
+                self._delete(entry.user_id)
+        return entry
+
+
+class SqliteStateStore:
+    """Общее состояние для нескольких воркеров в отдельном файле SQLite.
+
+    Соединение синхронное: каждая операция - один короткий запрос по
+    первичному ключу. Подбор пары (match_or_wait) выполняется одной транзакцией
+    BEGIN IMMEDIATE, поэтому два воркера не могут забрать одного и того же
+    пользователя.
+
+    Запрос идет в потоке цикла событий, поэтому занятую другим воркером базу
+    он ждет не дольше busy_timeout секунд. Транзакции из нескольких запросов
+    бот открывает через locked(): блокировку записи она ждет до lock_timeout
+    секунд, отпуская цикл между попытками.
+    """
+
+    def __init__(self, path, interest_timeout=0, busy_timeout=0.1, lock_timeout=5):
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=busy_timeout)
+        # Отдельное соединение без ожидания: через него locked() проверяет, свободна ли
+        # блокировка записи, не трогая busy_timeout общего соединения
+        self._probe = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=0)
+        self.lock_timeout = lock_timeout
+        self._lock = asyncio.Lock()  # одна транзакция locked() на соединение
+        self._depth = 0
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS kv (
+            ns TEXT,
+            key TEXT,
+            value TEXT,
+            PRIMARY KEY (ns, key)
+        ) WITHOUT ROWID""")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS waiting (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER UNIQUE,
+            gender TEXT,
+            age INTEGER,
+            filters TEXT,
+            rating REAL,
+            rating_key INTEGER,
+            since REAL,
+            tags TEXT
+        )""")
+        if "tags" not in {row[1] for row in self._conn.execute("PRAGMA table_info(waiting)")}:
+            self._conn.execute("ALTER TABLE waiting ADD COLUMN tags TEXT")  # файл состояния до интересов
+        self._conn.execute("CREATE INDEX IF NOT EXISTS waiting_age_rating ON waiting(age, rating_key)")
+        # Обратный индекс интересов: тег -> ожидающие
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS waiting_tags (
+            tag TEXT,
+            user_id INTEGER,
+            PRIMARY KEY (tag, user_id)
+        ) WITHOUT ROWID""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS waiting_tags_user ON waiting_tags(user_id)")
+        self.waiting_users = SqliteMatchQueue(self, interest_timeout)
+        self.sessions = None  # состояние и так на диске, в памяти ничего не копится
+        self.journal = None
+        for name in NAMESPACES:
+            setattr(self, name, SqliteMap(self._conn, name))
+
+    def recover(self):
+        return 0, 0  # состояние и так в файле
+
+    @contextmanager
+    def immediate(self):
+        """Транзакция с блокировкой записи с самого начала (вложенные вызовы - часть внешней)"""
+        if self._depth:
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+            return
+        self._conn.execute("BEGIN IMMEDIATE")
+        self._depth = 1
+        try:
+            yield
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        else:
+            self._conn.execute("COMMIT")
+        finally:
+            self._depth = 0
+
+    @asynccontextmanager
+    async def locked(self):
+        """Транзакция BEGIN IMMEDIATE, блокировка которой ждется без остановки цикла событий.
+
+        Внутри - только синхронные вызовы хранилища (они станут частью транзакции),
+        без await: иначе чужие запросы этого процесса попали бы в ту же транзакцию.
+        """
+        async with self._lock:
+            deadline = time.monotonic() + self.lock_timeout
+            delay = 0.001
+            while True:
+                try:
+                    self._probe.execute("BEGIN IMMEDIATE")
+                    self._probe.execute("ROLLBACK")
+                    # Блокировка была свободна; если другой воркер успел ее взять,
+                    # общее соединение подождет не дольше busy_timeout
+                    self._conn.execute("BEGIN IMMEDIATE")
+                    break
+                except sqlite3.OperationalError as e:
+                    if "locked" not in str(e) or time.monotonic() + delay > deadline:
+                        raise
+                await asyncio.sleep(delay)  # базу держит другой воркер
+                delay = min(delay * 2, 0.05)
+            self._depth = 1
+            try:
+                yield
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            else:
+                self._conn.execute("COMMIT")
+            finally:
+                self._depth = 0
+
+    def match_or_wait(self, user_id, gender, age, filters, rating, tags=(), plain=True):
+        with self.immediate():
+            if user_id in self.active_chats:
+                return None, False
+            partner = self.waiting_users.pop_match(user_id, rating, filters, tags, plain)
+            if partner is None:
+                self.waiting_users.add(user_id, gender, age, filters, rating, tags)
+                return None, True
+            self.waiting_users._delete(user_id)
+            self.active_chats[user_id] = partner.user_id
+            self.active_chats[partner.user_id] = user_id
+        return partner, None
+
+    def unpair(self, user_id):
+        with self.immediate():
+            partner_id = self.active_chats.get(user_id)
+            if partner_id is not None:
+                self._conn.execute(
+                    "DELETE FROM kv WHERE ns='active_chats' AND key IN (?,?)", (_dump(user_id), _dump(partner_id))
+                )
+        return partner_id
+
+    def close(self):
+        self._conn.close()
+        self._probe.close()
+
+
+def create_store(backend="memory", path=None, session_size=0, session_ttl=0, interest_timeout=0, journal=None,
+                 busy_timeout=0.1, lock_timeout=5):
+    """journal - только для memory: у sqlite состояние и так переживает перезапуск"""
+    if backend == "memory":
+        return MemoryStateStore(session_size, session_ttl, interest_timeout, journal)
+    if backend == "sqlite":
+        return SqliteStateStore(path, interest_timeout, busy_timeout, lock_timeout)
+    raise ValueError(f"Неизвестное хранилище состояния: {backend}")
@@ -0,0 +1,91 @@
+"""Счетчики для /stats, которые поддерживает сама база.
+
+Триггеры на users и chats обновляют stats_counters и stats_hourly при каждой
+записи, поэтому статистика читается за O(1) и O(24) строк вместо полного
+прохода по таблицам. Таблицы и триггеры создает миграция 2 (migrations.py),
+rebuild_stats() пересчитывает все с нуля.
+"""
+
+COUNTERS = ("total_users", "banned_users", "total_chats", "duration_sum", "duration_count")
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS stats_counters (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID""",
+    """CREATE TABLE IF NOT EXISTS stats_hourly (
+        hour TEXT PRIMARY KEY,
+        chats INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID""",
+
+    # Пользователи: новая строка и смена бана (upsert по конфликту идет как UPDATE)
+    """CREATE TRIGGER IF NOT EXISTS stats_users_insert AFTER INSERT ON users BEGIN
+        UPDATE stats_counters SET value = value + 1 WHERE name = 'total_users';
+        UPDATE stats_counters SET value = value + 1 WHERE name = 'banned_users' AND NEW.banned = 1;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS stats_users_ban AFTER UPDATE OF banned ON users
+    WHEN OLD.banned IS NOT NEW.banned BEGIN
+        UPDATE stats_counters SET value = value + (NEW.banned = 1) - (OLD.banned = 1) WHERE name = 'banned_users';
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS stats_users_delete AFTER DELETE ON users BEGIN
+        UPDATE stats_counters SET value = value - 1 WHERE name = 'total_users';
+        UPDATE stats_counters SET value = value - 1 WHERE name = 'banned_users' AND OLD.banned = 1;
+    END""",
+
+    # Диалоги: начало (счетчик и час), конец (длительность)
+    """CREATE TRIGGER IF NOT EXISTS stats_chats_insert AFTER INSERT ON chats BEGIN
+        UPDATE stats_counters SET value = value + 1 WHERE name = 'total_chats';
+        INSERT INTO stats_hourly(hour, chats) SELECT strftime('%H', NEW.start_time), 1
+            WHERE strftime('%H', NEW.start_time) IS NOT NULL
+            ON CONFLICT(hour) DO UPDATE SET chats = chats + 1;
+        UPDATE stats_counters SET value = value + CASE name WHEN 'duration_sum' THEN NEW.duration ELSE 1 END
+            WHERE name IN ('duration_sum', 'duration_count') AND NEW.duration > 0;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS stats_chats_duration AFTER UPDATE OF duration ON chats
+    WHEN OLD.duration IS NOT NEW.duration BEGIN
+        UPDATE stats_counters SET value = value - CASE name WHEN 'duration_sum' THEN OLD.duration ELSE 1 END
+            WHERE name IN ('duration_sum', 'duration_count') AND OLD.duration > 0;
+        UPDATE stats_counters SET value = value + CASE name WHEN 'duration_sum' THEN NEW.duration ELSE 1 END
+            WHERE name IN ('duration_sum', 'duration_count') AND NEW.duration > 0;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS stats_chats_delete AFTER DELETE ON chats BEGIN
+        UPDATE stats_counters SET value = value - 1 WHERE name = 'total_chats';
+        UPDATE stats_hourly SET chats = chats - 1 WHERE hour = strftime('%H', OLD.start_time);
+        UPDATE stats_counters SET value = value - CASE name WHEN 'duration_sum' THEN OLD.duration ELSE 1 END
+            WHERE name IN ('duration_sum', 'duration_count') AND OLD.duration > 0;
+    END""",
+)
+
+# Пересчет из сырых таблиц; выполняется одной транзакцией
+REBUILD = (
+    "DELETE FROM stats_counters",
+    "DELETE FROM stats_hourly",
+    """INSERT INTO stats_counters(name, value)
+        SELECT 'total_users', COUNT(*) FROM users
+        UNION ALL SELECT 'banned_users', COUNT(*) FROM users WHERE banned = 1
+        UNION ALL SELECT 'total_chats', COUNT(*) FROM chats
+        UNION ALL SELECT 'duration_sum', COALESCE(SUM(duration), 0) FROM chats WHERE duration > 0
+        UNION ALL SELECT 'duration_count', COUNT(*) FROM chats WHERE duration > 0""",
+    """INSERT INTO stats_hourly(hour, chats)
+        SELECT strftime('%H', start_time) AS hour, COUNT(*) FROM chats
+        WHERE hour IS NOT NULL GROUP BY hour""",
+)
+
+
+async def rebuild_stats(db):
+    async with db.transaction() as conn:
+        for sql in REBUILD:
+            await conn.execute(sql)
+
+
+async def read_counters(db):
+    rows = await db.fetchall("SELECT name, value FROM stats_counters")
+    counters = dict.fromkeys(COUNTERS, 0)
+    counters.update(rows)
+    return counters
+
+
+async def read_popular_hours(db, limit=3):
+    return await db.fetchall(
+        "SELECT hour, chats FROM stats_hourly WHERE chats > 0 ORDER BY chats DESC LIMIT ?", (limit,)
+    )
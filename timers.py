@@ -0,0 +1,102 @@
+import asyncio
+import math
+import time
+
+from logs import get_logger
+
+logger = get_logger("timers")
+
+
+class TimerWheel:
+    """Хешированное колесо таймеров.
+
+    Таймер - ключ (например ("chat", user_id)) и тик срабатывания; лежит в
+    слоте тик % slots. arm() и cancel() - O(1), каждый тик обходит один слот
+    (таймеры на следующие обороты колеса остаются в нем). Повторный arm()
+    того же ключа переносит таймер.
+
+    Колесо только говорит, что срок вышел; обработчик сам проверяет по
+    хранилищу, актуален ли таймер (состояние могло смениться в другом воркере).
+    """
+
+    def __init__(self, tick=1.0, slots=512, clock=time.monotonic):
+        self.tick = tick
+        self.clock = clock
+        self._slots = [{} for _ in range(slots)]  # слот -> {ключ: тик срабатывания}
+        self._where = {}  # ключ -> слот
+        self._now = int(clock() / tick)  # последний обработанный тик
+        self._task = None
+        self._running = set()  # задачи обработчиков, которые еще выполняются
+        self._slots_free = None  # asyncio.Semaphore на concurrency обработчиков
+
+    def __len__(self):
+        return len(self._where)
+
+    def __contains__(self, key):
+        return key in self._where
+
+    def arm(self, key, delay):
+        """Запустить (или перенести) таймер key через delay секунд"""
+        self.cancel(key)
+        deadline = max(self._now + 1, math.ceil((self.clock() + delay) / self.tick))
+        slot = deadline % len(self._slots)
+        self._slots[slot][key] = deadline
+        self._where[key] = slot
+
+    def cancel(self, key):
+        slot = self._where.pop(key, None)
+        if slot is not None:
+            del self._slots[slot][key]
+
+    def advance(self):
+        """Провернуть колесо до текущего времени -> ключи истекших таймеров"""
+        target = int(self.clock() / self.tick)
+        expired = []
+        # После долгой паузы хватает одного оборота: срок любого истекшего
+        # таймера лежит в одном из слотов
+        for now in range(self._now + 1, self._now + 1 + min(target - self._now, len(self._slots))):
+            slot = self._slots[now % len(self._slots)]
+            for key in [key for key, deadline in slot.items() if deadline <= target]:
+                del slot[key]
+                del self._where[key]
+                expired.append(key)
+        self._now = max(self._now, target)
+        return expired
+
+    def start(self, on_expire, concurrency=1000):
+        """Фоновая задача: раз в тик запускает on_expire(key) для истекших таймеров.
+
+        Каждый обработчик - своя задача: массовое истечение (например, очередь
+        после перезапуска) не задерживает остальные таймеры, пока обработчики
+        ждут отправки. Одновременно выполняется не больше concurrency обработчиков.
+        """
+        if self._task is None:
+            self._slots_free = asyncio.Semaphore(concurrency)
+            self._task = asyncio.create_task(self._run(on_expire))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for task in list(self._running):
+            task.cancel()
+        await asyncio.gather(*self._running, return_exceptions=True)
+
+    async def _run(self, on_expire):
+        while True:
+            await asyncio.sleep(self.tick)
+            for key in self.advance():
+                await self._slots_free.acquire()  # все заняты - ждем, колесо догонит пропущенные тики
+                task = asyncio.create_task(on_expire(key))
+                self._running.add(task)
+                task.add_done_callback(lambda task, key=key: self._done(task, key))
+
+    def _done(self, task, key):
+        self._running.discard(task)
+        self._slots_free.release()
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Ошибка обработчика таймера %s", key, exc_info=task.exception())
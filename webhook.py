@@ -0,0 +1,92 @@
+import asyncio
+from contextlib import nullcontext
+
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+from logs import get_logger
+from mailbox import update_user_id
+from metrics import handle_metrics
+
+logger = get_logger("webhook")
+
+
+class WebhookHandler(SimpleRequestHandler):
+    """Принимает апдейты от Telegram по HTTP.
+
+    Секрет из заголовка X-Telegram-Bot-Api-Secret-Token проверяет
+    SimpleRequestHandler. Telegram сразу получает 200, а апдейт
+    обрабатывается в фоне, не больше max_concurrency одновременно.
+
+    С mailboxes апдейт сначала ждет ящик отправителя и только потом слот
+    семафора: очередь одного пользователя не занимает слоты остальных.
+    """
+
+    def __init__(self, dispatcher, bot, secret_token=None, max_concurrency=100, mailboxes=None, **data):
+        super().__init__(dispatcher, bot, handle_in_background=True, secret_token=secret_token, **data)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._mailboxes = mailboxes
+        self._tasks = set()
+
+    async def _handle_request_background(self, bot, request):
+        update = await request.json(loads=bot.session.json_loads)
+        task = asyncio.create_task(self._feed(bot, update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    async def _feed(self, bot, update):
+        user_id = update_user_id(update) if self._mailboxes is not None else None
+        async with self._mailboxes.hold(user_id) if user_id is not None else nullcontext():
+            async with self._semaphore:
+                try:
+                    await self._background_feed_update(bot, update)
+                except Exception:
+                    logger.exception("Ошибка обработки апдейта %s", update.get("update_id"))
+
+    async def close(self):
+        # Дожидаемся апдейтов, которые уже приняли, потом закрываем сессию бота
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        await super().close()
+
+
+async def health(request):
+    return web.Response(text="ok")
+
+
+def build_app(dispatcher, bot, path="/webhook", secret_token=None, max_concurrency=100, mailboxes=None):
+    app = web.Application()
+    WebhookHandler(dispatcher, bot, secret_token=secret_token, max_concurrency=max_concurrency,
+                   mailboxes=mailboxes).register(app, path=path)
+    app.router.add_get("/", health)
+    app.router.add_get("/metrics", handle_metrics)
+    setup_application(app, dispatcher, bot=bot)
+    return app
+
+
+async def serve(app, host, port, reuse_port=False):
+    """Запустить aiohttp-приложение и держать его до отмены задачи.
+
+    reuse_port=True позволяет нескольким процессам слушать один порт (SO_REUSEPORT).
+    """
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port, reuse_port=reuse_port or None).start()
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+async def run_webhook(dispatcher, bot, host, port, path="/webhook", url=None, secret_token=None, max_concurrency=100,
+                      reuse_port=False, mailboxes=None):
+    """Режим вебхука. Без url вебхук в Telegram не регистрируется - удобно для локальной проверки"""
+    app = build_app(dispatcher, bot, path, secret_token, max_concurrency, mailboxes)
+    if url:
+        await bot.set_webhook(
+            url.rstrip("/") + path,
+            secret_token=secret_token,
+            allowed_updates=dispatcher.resolve_used_update_types(),
+        )
+    await serve(app, host, port, reuse_port)
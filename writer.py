@@ -0,0 +1,133 @@
+import asyncio
+import json
+import time
+from datetime import datetime
+
+from logs import get_logger
+
+logger = get_logger("db")
+
+_STOP = object()
+
+
+class WriteBehind:
+    """Фоновая запись в SQLite с групповым коммитом.
+
+    Хелперы кладут (sql, params) в очередь и не ждут диск. Фоновая задача
+    собирает записи за окно `window` секунд (или пока не наберется
+    `max_batch`) и пишет их одной транзакцией: подряд идущие одинаковые
+    запросы уходят одним executemany. Порядок записей сохраняется.
+
+    Если транзакция не прошла, пачка повторяется `retries` раз, затем
+    записи пишутся по одной: одна плохая строка не теряет остальные.
+    Не записанные и так строки дописываются в `dead_letter` (JSON по строке).
+    """
+
+    def __init__(self, db, window=0.05, max_batch=500, retries=2, retry_delay=0.1, dead_letter=None):
+        self.db = db
+        self.window = window
+        self.max_batch = max_batch
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.dead_letter = dead_letter
+        self.batches = 0
+        self.rows = 0
+        self.dead = 0  # строк, ушедших в dead_letter
+        self._queue = asyncio.Queue()
+        self._task = None
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def submit(self, sql, params=()):
+        self._queue.put_nowait((sql, params))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Дописать все, что осталось в очереди, и остановить фоновую задачу"""
+        if self._task is not None:
+            self._queue.put_nowait(_STOP)
+            await self._task
+            self._task = None
+        await self.flush()
+
+    async def flush(self):
+        batch = []
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is not _STOP:
+                batch.append(item)
+        if batch:
+            await self._write_safely(batch)
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            batch = [await self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch and batch[-1] is not _STOP:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            if batch[-1] is _STOP:
+                batch.pop()
+                stopping = True
+            if not batch:
+                continue
+            await self._write_safely(batch)
+
+    async def _write_safely(self, batch):
+        for attempt in range(self.retries + 1):
+            try:
+                await self._write(batch)
+                return
+            except Exception as e:
+                logger.warning("Пачка из %d запросов не записана (попытка %d): %s", len(batch), attempt + 1, e)
+            if attempt < self.retries:
+                await asyncio.sleep(self.retry_delay)
+        dead = []
+        for item in batch:
+            try:
+                await self._write([item])
+            except Exception as e:
+                dead.append((item, e))
+        if dead:
+            self._bury(dead)
+
+    def _bury(self, dead):
+        """Строки, которые не пишутся и по одной: в лог и в dead_letter, чтобы их можно было дописать руками"""
+        self.dead += len(dead)
+        logger.error("Не записано %d из пачки, первая ошибка: %s", len(dead), dead[0][1])
+        if not self.dead_letter:
+            return
+        now = datetime.now().isoformat()
+        try:
+            with open(self.dead_letter, "a", encoding="utf-8") as f:
+                for (sql, params), error in dead:
+                    f.write(json.dumps({"ts": now, "sql": sql, "params": params, "error": str(error)},
+                                       ensure_ascii=False, default=str) + "\n")
+        except OSError:
+            logger.exception("Не удалось дописать %s", self.dead_letter)
+
+    async def _write(self, batch):
+        async with self.db.transaction() as conn:
+            i = 0
+            while i < len(batch):
+                sql = batch[i][0]
+                j = i
+                while j < len(batch) and batch[j][0] == sql:
+                    j += 1
+                if j - i == 1:
+                    await conn.execute(sql, batch[i][1])
+                else:
+                    await conn.executemany(sql, [params for _, params in batch[i:j]])
+                i = j
+        self.batches += 1
+        self.rows += len(batch)